@@ -27,19 +27,31 @@ If you managed to get your hands on the FHS dataset, you can run:
         "data/pole_emploi/FHS/FHS*201512" \
         2015-12-01 \
         ABC \
-        data/fhs_category_abc_duration_motann.csv
+        data/fhs_category_abc_duration_motann.csv \
+        vectorized
+
+The last argument is optional: with "vectorized", the periods are computed
+for a whole region at once with NumPy instead of job seeker by job seeker.
+Both engines output the same CSV.
+
+To write the datacube as a Parquet file, see datacube, use an output path
+ending with ".parquet", e.g. data/fhs_category_abc_duration_motann.parquet.
 """
 import collections
-import csv
 import datetime
+import functools
 import sys
+
+import numpy
 import tqdm
 
+from bob_emploi.lib import datacube
 from bob_emploi.lib import fhs
+from bob_emploi.lib import fhs_periods
 
 # TODO: Add tests.
 
-_CollectionMode = collections.namedtuple('CollectionMode', ['categories', 'only_last'])
+_CollectionMode = collections.namedtuple('_CollectionMode', ['categories', 'only_last'])
 _MODES = {
     # Extract the last contiguous period for which a job seeker was in category A unemployment.
     'A': _CollectionMode(categories='A', only_last=True),
@@ -107,34 +119,97 @@ _CRITERIA_HEADERS = (
     'duration',
 )
 
+# Columns of the datacube stored as categories in a Parquet file.
+_CATEGORICAL_HEADERS = ('code_rome', 'city_id', 'sex', 'reason_begin', 'reason_end')
+
+
+# Columns of the FHS tables needed to compute the unemployment periods.
+_COLUMNS = {
+    fhs.UNEMPLOYMENT_PERIOD_TABLE: (
+        fhs.REGISRATION_DATE_FIELD,
+        fhs.CANCELATION_DATE_FIELD,
+        fhs.PERIOD_CATEGORY_FIELD,
+        fhs.REGISTRATION_REASON_FIELD,
+        fhs.CANCELATION_REASON_FIELD,
+        fhs.JOB_GROUP_ID_FIELD,
+        fhs.CITY_ID_FIELD,
+        fhs.GENDER_FIELD,
+    ),
+    fhs.PART_TIME_WORK_TABLE: (fhs.PART_TIME_WORK_MONTH_FIELD,),
+}
 
-def main(fhs_folder, now, mode_name, csv_output):
+
+def _job_seeker_rows_as_lists(job_seeker, now, mode):
+    return [list(row) for row in job_seeker_rows(job_seeker, now, mode.categories, mode.only_last)]
+
+
+def _vectorized_region_rows(now, mode, fhs_folder, region):
+    de_frame = fhs.read_data_frame(
+        fhs.table_files_pattern(fhs_folder, fhs.UNEMPLOYMENT_PERIOD_TABLE, region),
+        _COLUMNS[fhs.UNEMPLOYMENT_PERIOD_TABLE])
+    e0_frame = None
+    if mode.categories == 'A':
+        e0_frame = fhs.read_data_frame(
+            fhs.table_files_pattern(fhs_folder, fhs.PART_TIME_WORK_TABLE, region),
+            _COLUMNS[fhs.PART_TIME_WORK_TABLE])
+    periods = fhs_periods.unemployment_periods(
+        de_frame, e0_frame, mode.categories.lower(), cover_holes_up_to=27, now=now)
+    if mode.only_last:
+        periods = fhs_periods.last_periods(periods)
+
+    begin = periods.begin.values.astype('datetime64[D]')
+    end = periods.end.values.astype('datetime64[D]')
+    return zip(
+        periods[fhs.JOB_GROUP_ID_FIELD],
+        periods[fhs.CITY_ID_FIELD],
+        periods[fhs.GENDER_FIELD],
+        periods[fhs.REGISTRATION_REASON_FIELD],
+        periods[fhs.CANCELATION_REASON_FIELD],
+        numpy.datetime_as_string(begin),
+        numpy.datetime_as_string(end),
+        (end - begin).astype('int64'),
+    )
+
+
+def main(fhs_folder, now, mode_name, csv_output, engine='python', processes=None):
     """Extract the salaries information from FHS and bucketize them.
 
     Args:
         fhs_folder: path of the root folder of the FHS files.
         now: the date at which the FHS data was extracted, e.g. 2015-12-31.
         mode_name: the mode of extraction, see _MODES.
-        csv_output: path to the file to write to.
+        csv_output: path to the file to write to, a Parquet file if it ends
+            with ".parquet", a CSV file otherwise.
+        engine: "python" to compute the periods of each job seeker with
+            fhs.JobSeeker, or "vectorized" to compute them for each region
+            with fhs_periods.
+        processes: the number of processes to use, one region at a time, by
+            default the number of CPUs.
     """
     if mode_name not in _MODES:
         raise ValueError('Unsupported mode: [%s], want one of [%s]' % (mode_name, _MODES.keys()))
+    if engine not in ('python', 'vectorized'):
+        raise ValueError('Unsupported engine: [%s]' % engine)
     mode = _MODES[mode_name]
     now = datetime.datetime.strptime(now, '%Y-%m-%d').date()
 
-    job_seekers = fhs.job_seeker_iterator(
-        fhs_folder,
-        (fhs.UNEMPLOYMENT_PERIOD_TABLE, fhs.PART_TIME_WORK_TABLE))
-
-    # Estimation of the total # of job seekers in the FHS.
-    total = 2522364
-
-    with open(csv_output, 'w') as csv_file:
-        writer = csv.writer(csv_file)
+    with datacube.csv_writer(csv_output, _CATEGORICAL_HEADERS) as writer:
         writer.writerow(_CRITERIA_HEADERS)
-        for job_seeker in tqdm.tqdm(job_seekers, total=total):
-            for row in job_seeker_rows(job_seeker, now, mode.categories, mode.only_last):
-                writer.writerow(list(row))
+        with tqdm.tqdm(unit='region') as progress_bar:
+            def _progress(value, total):
+                progress_bar.total = total
+                progress_bar.update(value - progress_bar.n)
+            if engine == 'vectorized':
+                fhs.write_region_rows(
+                    fhs_folder, functools.partial(_vectorized_region_rows, now, mode), writer,
+                    processes=processes, progress=_progress)
+                return
+            fhs.write_job_seeker_rows(
+                fhs_folder,
+                functools.partial(_job_seeker_rows_as_lists, now=now, mode=mode),
+                writer,
+                (fhs.UNEMPLOYMENT_PERIOD_TABLE, fhs.PART_TIME_WORK_TABLE),
+                processes=processes, progress=_progress, columns=_COLUMNS)
 
 
 if __name__ == '__main__':
@@ -15,8 +15,8 @@ You can try it out on a local instance:
 """
 import locale
 import numpy
-import pandas
 
+from bob_emploi.lib import datacube
 from bob_emploi.lib import importer_helpers
 from bob_emploi.lib import mongo
 
@@ -38,9 +38,9 @@ def fhs2dicts(durations_csv):
     """Import stats from FHS as gobal diagnosis.
 
     Args:
-        durations_csv: path to a CSV file containing one line for each job
-        seeker, some of their properties and the duration of their last
-        unemployment period. See the full doc in the
+        durations_csv: path to a CSV or Parquet file containing one line for
+        each job seeker, some of their properties and the duration of their
+        last unemployment period. See the full doc in the
         `fhs_category_duration.py` script.
 
     Returns:
@@ -48,7 +48,7 @@ def fhs2dicts(durations_csv):
         TODO: Add proto here
         with an additional unique "_id" field.
     """
-    job_seekers = pandas.read_csv(durations_csv, dtype={'city_id': str})
+    job_seekers = datacube.read(durations_csv, columns=['code_rome', 'duration'])
 
     global_diagnoses = []
     for rome_id, group in job_seekers.groupby('code_rome'):
@@ -15,16 +15,13 @@ If you managed to get your hands on the FHS dataset, you can run:
         "data/pole_emploi/FHS/FHS*201512" \
         data/jobs_frequency.json
 """
-import collections
 import json
-from os import path
 import sys
 
 import numpy
 import pandas
 
 from bob_emploi.lib import fhs
-from bob_emploi.lib import migration_helpers
 
 # Field in the FHS "de" table for the end date of the job request.
 _END_DATE_FIELD = fhs.CANCELATION_REASON_FIELD
@@ -44,38 +41,31 @@ def _print_progress(value, total, bar_length=100):
     sys.stdout.flush()
 
 
-def main(fhs_folder, json_output, progress=_print_progress):
+def _open_job_code(de_dict):
+    if de_dict[_END_DATE_FIELD]:
+        return None
+    return de_dict[_JOB_CODE_FIELD]
+
+
+def main(fhs_folder, json_output, progress=_print_progress, processes=None):
     """Extract the job OGR codes from FHS and count them.
 
     Args:
         fhs_folder: path of the root folder of the FHS files.
         json_output: path to the file to write to.
+        progress: an optional function called with the number of regions
+            processed and the total number of regions.
+        processes: the number of processes to use, one region at a time, by
+            default the number of CPUs.
     """
     # Check that the output file is writeable before starting the long process
     # of collecting data.
     with open(json_output, 'w'):
         pass
 
-    de_rows = migration_helpers.flatten_iterator(
-        path.join(fhs_folder, '*/de_*.csv'))
-
-    # Estimation of the total # of rows in the FHS "de" table.
-    total = 7000001
-
-    # If we need to do that often we could replace this code by a simple Map
-    # Reduce to use multiple threads or multiple computers.
-    job_counts = collections.defaultdict(int)
-    counted = 0
-    for de_dict in de_rows:
-        counted += 1
-        if counted % 1000 == 0 and progress:
-            progress(counted, total)
-        if de_dict[_END_DATE_FIELD]:
-            continue
-        job_code = de_dict[_JOB_CODE_FIELD]
-        job_counts[job_code] += 1
-
-    _print_progress(total, total)
+    # Each region is counted in a separate process.
+    job_counts = fhs.count_rows(
+        fhs_folder, _open_job_code, processes=processes, progress=progress)
 
     job_count_series = pandas.Series(job_counts)
     # Add random gaussian noise so that numbers do not reveal initial data.
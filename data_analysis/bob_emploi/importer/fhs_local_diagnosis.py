@@ -10,9 +10,11 @@ You can try it out on a local instance:
         --mongo_url mongodb://plan-comparator-db/test
 """
 import locale
+import numpy
 import pandas
 
 from bob_emploi.lib import cleaned_data
+from bob_emploi.lib import datacube
 from bob_emploi.lib import mongo
 
 locale.setlocale(locale.LC_ALL, 'fr_FR.UTF-8')
@@ -24,9 +26,9 @@ def fhs2dicts(durations_csv, data_folder='data'):
     """Import stats from FHS as local diagnosis.
 
     Args:
-        durations_csv: path to a CSV file containing one line for each job
-        seeker, some of their properties and the duration of their last
-        category A unemployment period. See the full doc in the
+        durations_csv: path to a CSV or Parquet file containing one line for
+        each job seeker, some of their properties and the duration of their
+        last category A unemployment period. See the full doc in the
         `fhs_category_a_duration.py` script.
 
     Returns:
@@ -54,7 +56,11 @@ def fhs2dicts(durations_csv, data_folder='data'):
 
 def _local_durations(data_folder, durations_csv):
     # See http://go/pe:notebooks/datasets/FHS_category_A_duration.ipynb
-    job_seekers = pandas.read_csv(durations_csv, dtype={'city_id': str})
+    job_seekers = datacube.read(
+        durations_csv, columns=['city_id', 'code_rome', 'duration'], dtype={'city_id': str})
+    # IDs are updated and concatenated below, so they cannot stay categories.
+    for field in ('city_id', 'code_rome'):
+        job_seekers[field] = job_seekers[field].astype(object)
 
     _augment_cities(data_folder, job_seekers, 'city_id')
 
@@ -108,74 +114,69 @@ def _find_best_cities(area_diagnoses, grouping_field, id_prefix):
 
 
 def _city_durations(job_seekers):
-    # Assign ghost town IDs at the département level.
-    groups = job_seekers.groupby(
-        ['city_id', 'code_rome'], sort=False, group_keys=False)
-    ghosts = groups.filter(lambda d: len(d) < _MINIMUM_GROUP_SIZE)
-    job_seekers.loc[ghosts.index, 'city_id'] = (
-        'ghost-d' + ghosts['departement_id'])
-    job_seekers.loc[ghosts.index, 'city_name'] = ''
-
-    # Assign ghost town IDs at the région level.
-    groups = job_seekers.loc[ghosts.index].groupby(
-        ['city_id', 'code_rome'], sort=False, group_keys=False)
-    ghosts = groups.filter(lambda d: len(d) < _MINIMUM_GROUP_SIZE)
-    job_seekers.loc[ghosts.index, 'city_id'] = 'ghost-r' + ghosts['region_id']
-    job_seekers.loc[ghosts.index, 'city_name'] = ''
-
-    # Assign ghost town IDs at the country level.
-    groups = job_seekers.loc[ghosts.index].groupby(
-        ['city_id', 'code_rome'], sort=False, group_keys=False)
-    ghosts = groups.filter(lambda d: len(d) < _MINIMUM_GROUP_SIZE)
-    job_seekers.loc[ghosts.index, 'city_id'] = 'ghost'
-    job_seekers.loc[ghosts.index, 'city_name'] = ''
-
-    # Compute diagnoses across real and ghost cities.
-    groups = job_seekers.groupby(
-        ['city_id', 'code_rome'], sort=False, group_keys=False)
-    city_diagnoses = groups.apply(_duration_diagnosis)
-    return city_diagnoses
+    """Compute the diagnoses of each city and job group.
 
-
-def _duration_diagnosis(job_seekers):
-    """Compute the diagnosis from a group of actual job seekers.
-
-    This function might be surprising as it returns a DataFrame with only one
-    row: this is because it is meant to be called in a GroupBy.apply method
-    that will call this function repeatedly with different group of job seekers
-    and aggregate the output in one big DataFrame.
+    Groups of job seekers that are too small are first moved to ghost towns
+    at the département, then région, then country level.
 
     Args:
-        job_seekers: a DataFrame of job seekers that share the same job group
-            and some kind of locality.
+        job_seekers: a DataFrame of job seekers with the fields "city_id",
+            "city_name", "code_rome", "duration", "departement_id" and
+            "region_id". Its "city_id" and "city_name" are updated for the
+            job seekers moved to ghost towns.
     Returns:
-        A DataFrame with the following columns:
+        A DataFrame with one row per city and job group with at least
+        _MINIMUM_GROUP_SIZE job seekers, indexed by <city_id>:<code_rome>,
+        with the following columns:
+            - city_id: the ID of the city or the ghost town
+            - city_name: the name of the city, empty for ghost towns
             - code_rome: the ID of the job group
             - duration: the unemployment duration estimation
             - departement_id: the ID of the département or None if the group
               covers multiple départements.
             - region_id: the ID of the région or None if the group covers
               multiple régions.
-        The DataFrame has only one row indexed with <city_id>:<code_rome>.
     """
-    if len(job_seekers) < _MINIMUM_GROUP_SIZE:
-        return None
-    estimation = {
-        'days': int(job_seekers.duration.median()),
-    }
-    departement_ids = job_seekers.departement_id.unique()
-    region_ids = job_seekers.region_id.unique()
-    code_rome = job_seekers.iloc[0]['code_rome']
-    group_index = job_seekers.iloc[0]['city_id'] + ':' + code_rome
+    # Assign ghost town IDs at the département level.
+    is_ghost = _group_sizes(job_seekers) < _MINIMUM_GROUP_SIZE
+    job_seekers.loc[is_ghost, 'city_id'] = 'ghost-d' + job_seekers.departement_id[is_ghost]
+    job_seekers.loc[is_ghost, 'city_name'] = ''
+
+    # Assign ghost town IDs at the région level. Only job seekers of ghost
+    # towns have those IDs so they are the only ones in their groups.
+    is_ghost &= _group_sizes(job_seekers) < _MINIMUM_GROUP_SIZE
+    job_seekers.loc[is_ghost, 'city_id'] = 'ghost-r' + job_seekers.region_id[is_ghost]
+    job_seekers.loc[is_ghost, 'city_name'] = ''
+
+    # Assign ghost town IDs at the country level.
+    is_ghost &= _group_sizes(job_seekers) < _MINIMUM_GROUP_SIZE
+    job_seekers.loc[is_ghost, 'city_id'] = 'ghost'
+    job_seekers.loc[is_ghost, 'city_name'] = ''
+
+    # Compute diagnoses across real and ghost cities.
+    groups = job_seekers.groupby(['city_id', 'code_rome'], sort=False)
+    is_large = (groups.size() >= _MINIMUM_GROUP_SIZE).values
+    first_rows = groups.head(1)[is_large]
+    medians = groups.duration.median().values[is_large]
+    num_departements = groups.departement_id.nunique(dropna=False).values[is_large]
+    num_regions = groups.region_id.nunique(dropna=False).values[is_large]
     return pandas.DataFrame({
-        'city_id': [job_seekers.iloc[0]['city_id']],
-        'city_name': [job_seekers.iloc[0]['city_name']],
-        'code_rome': [code_rome],
-        'duration': [estimation],
-        'departement_id': [
-            departement_ids[0] if len(departement_ids) == 1 else None],
-        'region_id': [region_ids[0] if len(region_ids) == 1 else None],
-    }, index=[group_index])
+        'city_id': first_rows.city_id.values,
+        'city_name': first_rows.city_name.values,
+        'code_rome': first_rows.code_rome.values,
+        'duration': [{'days': int(median)} for median in medians],
+        'departement_id': numpy.where(
+            num_departements == 1, first_rows.departement_id.values, None),
+        'region_id': numpy.where(num_regions == 1, first_rows.region_id.values, None),
+    }, index=first_rows.city_id.values + ':' + first_rows.code_rome.values)
+
+
+def _group_sizes(job_seekers):
+    """Count the job seekers in the same city and job group as each one.
+
+    Job seekers without a city get a NaN count.
+    """
+    return job_seekers.groupby(['city_id', 'code_rome'], sort=False).duration.transform('size')
 
 
 if __name__ == "__main__":
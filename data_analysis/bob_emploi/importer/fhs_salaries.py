@@ -11,15 +11,24 @@ If you managed to get your hands on the FHS dataset, you can run:
     docker-compose run --rm data-analysis-prepare python \
         bob_emploi/importer/fhs_salaries.py \
         "data/pole_emploi/FHS/FHS*201512" \
-        data/fhs_salaries.csv
+        data/fhs_salaries.csv \
+        vectorized
+
+The last argument is optional: with "vectorized", the salaries are parsed and
+bucketized for whole chunks of the FHS at once with NumPy instead of row by
+row. Both engines output the same CSV.
+
+To write the datacube as a Parquet file, see datacube, use an output path
+ending with ".parquet", e.g. data/fhs_salaries.parquet.
 """
 import collections
-import csv
-from os import path
 import sys
 
+import numpy
+import pandas
+
+from bob_emploi.lib import datacube
 from bob_emploi.lib import fhs
-from bob_emploi.lib import migration_helpers
 
 # Field in the FHS "de" table for the end date of the job request.
 _END_DATE_FIELD = fhs.CANCELATION_DATE_FIELD
@@ -56,6 +65,22 @@ _SALARY_BUCKET_SIZES = [
     _BucketRange(lower_bound=100000, bucket_size=10000),
 ]
 
+# Columns of the FHS "de" table needed to compute the criteria of job seekers.
+_CRITERIA_COLUMNS = [
+    fhs.JOB_GROUP_ID_FIELD,
+    fhs.CITY_ID_FIELD,
+    fhs.SALARY_AMOUNT_FIELD,
+    fhs.SALARY_UNIT_FIELD,
+    _END_DATE_FIELD,
+]
+
+# Columns of the datacube stored as categories in a Parquet file.
+_CATEGORICAL_HEADERS = ('code_rome', 'departement_id', 'salary_unit')
+
+# Number of rows of the FHS "de" table processed at once by the vectorized
+# engine.
+_CHUNK_SIZE = 100000
+
 
 # TODO: Move to a library.
 def _print_progress(value, total, bar_length=100):
@@ -83,6 +108,51 @@ def compute_annual_salary(amt, unit):
     return amt
 
 
+def compute_annual_salaries(amounts, units):
+    """Compute annual salaries for arrays of amounts and units.
+
+    This is the vectorized version of compute_annual_salary.
+
+    Args:
+        amounts: an array-like of amounts, as numbers or strings.
+        units: an array-like of units, in the same order.
+    Returns:
+        a numpy array of annual salaries as floats.
+    """
+    amounts = pandas.to_numeric(pandas.Series(amounts), errors='coerce').fillna(0).values
+    units = numpy.asarray(units)
+    return numpy.select(
+        [units == 'H', units == 'M'], [amounts * 52 * 35, amounts * 12], default=amounts)
+
+
+def bucketize_salaries(salaries):
+    """Bucketize an array of annual salaries.
+
+    This is the vectorized version of bucketize_salary.
+
+    Args:
+        salaries: a numpy array of annual salaries, see compute_annual_salaries.
+    Returns:
+        two numpy arrays of integers with the lower and higher thresholds of
+        the bucket of each salary. Salaries that are not positive or not
+        finite are in the (0, 0) bucket.
+    """
+    is_invalid = ~(numpy.isfinite(salaries) & (salaries > 0))
+    salaries = numpy.where(is_invalid, 0, salaries)
+    lower_bounds = numpy.array([salary_range.lower_bound for salary_range in _SALARY_BUCKET_SIZES])
+    bucket_sizes = numpy.array([salary_range.bucket_size for salary_range in _SALARY_BUCKET_SIZES])
+    # The range of a salary is the last one whose lower bound is strictly
+    # below it.
+    ranges = numpy.searchsorted(lower_bounds, salaries, side='left') - 1
+    bucket_size = bucket_sizes[numpy.maximum(ranges, 0)]
+
+    bucket_lower = (salaries - salaries % bucket_size).astype(int)
+    bucket_higher = bucket_lower + bucket_size
+    bucket_lower[is_invalid] = 0
+    bucket_higher[is_invalid] = 0
+    return bucket_lower, bucket_higher
+
+
 def bucketize_salary(de_dict):
     """Bucketize the salary of a job seeker.
 
@@ -131,7 +201,59 @@ def job_seeker_criteria(de_dict):
         salary_high)
 
 
-def main(fhs_folder, csv_output, progress=_print_progress):
+def _open_job_seeker_criteria(de_dict):
+    # Discard historical job requests, only work on the ones that are still
+    # open.
+    if de_dict[_END_DATE_FIELD]:
+        return None
+    return job_seeker_criteria(de_dict)
+
+
+def count_open_job_seeker_criteria(de_frame):
+    """Count open job requests by criteria.
+
+    This is the vectorized version of job_seeker_criteria.
+
+    Args:
+        de_frame: a chunk of the FHS "de" table as read by
+            fhs.data_frame_iterator, with at least the _CRITERIA_COLUMNS.
+    Returns:
+        a Counter of criteria tuples as returned by job_seeker_criteria, in
+        the order of the rows.
+    """
+    de_frame = de_frame[de_frame[_END_DATE_FIELD].isnull()]
+    salaries = compute_annual_salaries(
+        de_frame[fhs.SALARY_AMOUNT_FIELD].values, de_frame[fhs.SALARY_UNIT_FIELD].values)
+    salary_low, salary_high = bucketize_salaries(salaries)
+    city_ids = de_frame[fhs.CITY_ID_FIELD].str
+    departement_ids = numpy.where(city_ids[:2] == '97', city_ids[:3], city_ids[:2])
+    return collections.Counter(zip(
+        de_frame[fhs.JOB_GROUP_ID_FIELD].tolist(),
+        departement_ids.tolist(),
+        de_frame[fhs.SALARY_UNIT_FIELD].tolist(),
+        salary_low.tolist(),
+        salary_high.tolist()))
+
+
+def _count_region_criteria(fhs_folder, region):
+    counts = collections.Counter()
+    for de_frame in fhs.data_frame_iterator(
+            fhs.table_files_pattern(fhs_folder, fhs.UNEMPLOYMENT_PERIOD_TABLE, region),
+            _CRITERIA_COLUMNS, chunk_size=_CHUNK_SIZE):
+        counts.update(count_open_job_seeker_criteria(de_frame))
+    return counts
+
+
+def _count_criteria(fhs_folder, processes, progress):
+    counts = collections.Counter()
+    for region_counts in fhs.map_regions(
+            fhs_folder, _count_region_criteria, processes=processes, progress=progress):
+        counts.update(region_counts)
+    return counts
+
+
+def main(
+        fhs_folder, csv_output, engine='python', progress=_print_progress, processes=None):
     """Extract the salaries information from FHS and bucketize them.
 
     In order to avoid issues about jobseekers being counted several times, we
@@ -140,37 +262,32 @@ def main(fhs_folder, csv_output, progress=_print_progress):
 
     Args:
         fhs_folder: path of the root folder of the FHS files.
-        csv_output: path to the file to write to.
+        csv_output: path to the file to write to, a Parquet file if it ends
+            with ".parquet", a CSV file otherwise.
+        engine: "python" to handle job seekers one row at a time, or
+            "vectorized" to handle chunks of rows with NumPy.
+        progress: an optional function called with the number of regions
+            processed and the total number of regions.
+        processes: the number of processes to use, one region at a time, by
+            default the number of CPUs.
     """
     # TODO: Factorize this code with fhs_job_frequency.
+    if engine not in ('python', 'vectorized'):
+        raise ValueError('Unsupported engine: [%s]' % engine)
 
     # Check that the output file is writeable before starting the long process
     # of collecting data.
     with open(csv_output, 'w'):
         pass
 
-    de_rows = migration_helpers.flatten_iterator(
-        path.join(fhs_folder, '*/de_*.csv'))
-
-    # Estimation of the total # of rows in the FHS "de" table.
-    total = 7000001
-
-    job_seeker_counts = collections.defaultdict(int)
-    counted = 0
-    for de_dict in de_rows:
-        counted += 1
-        if counted % 10000 == 0 and progress:
-            progress(counted, total)
-        # Discard historical job requests, only work on the ones that are still
-        # open.
-        if de_dict[_END_DATE_FIELD]:
-            continue
-        job_seeker_counts[job_seeker_criteria(de_dict)] += 1
-
-    _print_progress(total, total)
+    # Each region is counted in a separate process.
+    if engine == 'vectorized':
+        job_seeker_counts = _count_criteria(fhs_folder, processes, progress)
+    else:
+        job_seeker_counts = fhs.count_rows(
+            fhs_folder, _open_job_seeker_criteria, processes=processes, progress=progress)
 
-    with open(csv_output, 'w') as csv_file:
-        writer = csv.writer(csv_file)
+    with datacube.csv_writer(csv_output, _CATEGORICAL_HEADERS) as writer:
         writer.writerow((
             'code_rome',
             'departement_id',
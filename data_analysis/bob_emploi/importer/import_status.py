@@ -146,6 +146,16 @@ IMPORTERS = {
         is_imported=True,
         proto_type=job_pb2.LocalJobStats,
         key='<département ID>:<job group ID>'),
+    'local_market_scores': Importer(
+        name='Local Market Scores',
+        command="""docker-compose run --rm data-analysis-prepare \\
+            python bob_emploi/importer/local_market_scores.py \\
+            --job_imt_json data/scraped_imt_local_job_stats.json \\
+            --mongo_url "%(mongo_url)s"
+        """,
+        is_imported=True,
+        proto_type=job_pb2.LocalMarketScores,
+        key='<département ID>:<job group ID>'),
     'user': Importer(
         name='App User', command='', is_imported=False, proto_type=user_pb2.User, key='user_id'),
     'user_auth': Importer(
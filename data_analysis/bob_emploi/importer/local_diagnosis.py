@@ -27,6 +27,7 @@ import numpy
 import pandas
 
 from bob_emploi.lib import cleaned_data
+from bob_emploi.lib import datacube
 from bob_emploi.lib import mongo
 from bob_emploi.lib import read_data
 
@@ -125,15 +126,16 @@ def _get_unemployment_durations(unemployment_duration_csv):
     Returns: A dataframe with `local_id` and one column with
         unemployment_duration objects that fit the DurationEstimation proto.
     """
-    last_periods = pandas.read_csv(
-        unemployment_duration_csv, dtype={'city_id': str})
+    last_periods = datacube.read(
+        unemployment_duration_csv, columns=['city_id', 'code_rome', 'duration'],
+        dtype={'city_id': str})
     last_periods['departement_id'] = last_periods.city_id.str[:2]
     # Oversee départements are 3 digits long.
     last_periods.loc[last_periods.departement_id == '97', 'departement_id'] = (
         last_periods.city_id.str[:3])
     group_cols = ['code_rome', 'departement_id']
     unemployment_durations = last_periods.groupby(
-        group_cols).duration.median().reset_index()
+        group_cols, observed=True).duration.median().reset_index()
     local_id = unemployment_durations.departement_id.str.cat(
         unemployment_durations.code_rome, sep=':')
     return pandas.DataFrame({
@@ -204,19 +206,22 @@ def _get_fhs_salaries(salaries_csv):
     """Get salary estimates from FHS dataset.
 
     Args:
-        salaries_csv: path to a CSV file prepared by the fhs_salaries script.
+        salaries_csv: path to a CSV or Parquet file prepared by the
+            fhs_salaries script.
 
     Returns:
         A dataframe with a `local_id` added for joining to other datasets.
     """
     # See http://go/pe:notebooks/datasets/FHS_salaries.ipynb
-    salaries = pandas.read_csv(salaries_csv, dtype={'departement_id': str})
+    salaries = datacube.read(salaries_csv, columns=[
+        'departement_id', 'code_rome', 'salary_low', 'salary_high', 'count',
+    ], dtype={'departement_id': str})
     # TODO: Make a better filter or clean up the data.
     salaries = salaries[
         (salaries.salary_high > 1000) & (salaries.salary_high < 100000)]
     # TODO: Fallback on nation-wide stats.
     salaries_groups = salaries.groupby(
-        ['departement_id', 'code_rome'], sort=False, group_keys=False)
+        ['departement_id', 'code_rome'], sort=False, group_keys=False, observed=True)
     fhs_salaries = salaries_groups.apply(
         _salaries_diagnosis).dropna().to_frame(name='salary').reset_index()
     fhs_salaries['local_id'] = fhs_salaries.departement_id.str.cat(
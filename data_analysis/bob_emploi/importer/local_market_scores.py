@@ -0,0 +1,81 @@
+# encoding: utf-8
+"""Importer for the market dependent parts of the scoring to MongoDB.
+
+The data will be imported into the `local_market_scores` collection and follows
+the structure of LocalMarketScores from job.proto.
+
+The data from this importer is indexed by `departement_id` and `rome_id` and
+contains the market stress and the application modes. The scoring of a
+project combines them with the user's own data instead of loading and
+deriving them from the `local_diagnosis` collection.
+
+You can try it out on a local instance:
+ - Start your local environment with `docker-compose up frontend-dev`.
+ - Run this script:
+    docker-compose run --rm data-analysis-prepare \
+        python bob_emploi/importer/local_market_scores.py \
+        --job_imt_json data/scraped_imt_local_job_stats.json \
+        --mongo_url mongodb://frontend-db/test
+"""
+from bob_emploi.lib import cleaned_data
+from bob_emploi.lib import mongo
+
+# Market stress when there are no job offers at all, see
+# ScoringProject.market_stress.
+_MAX_MARKET_STRESS = 1000
+
+
+def csv2dicts(job_imt_json):
+    """Precompute the market dependent parts of the scoring.
+
+    Args:
+        job_imt_json: path to the file scraped from the IMT website. Can be
+            generated by `make data/scraped_imt_local_job_stats.json`.
+
+    Returns:
+        A list of dict compatible with the JSON version of
+        job_pb2.LocalMarketScores with an additional unique "_id" field.
+    """
+    imt = cleaned_data.scraped_imt(filename=job_imt_json)
+    # If multiple values for the same local ID, just keep the last one as in
+    # the local_diagnosis importer.
+    imt = imt[~imt.index.duplicated(keep='last')]
+    market_scores = []
+    for (departement_id, rome_id), local_imt in imt.iterrows():
+        scores = _imt_scores(local_imt)
+        if scores:
+            scores['_id'] = '%s:%s' % (departement_id, rome_id)
+            market_scores.append(scores)
+    return market_scores
+
+
+def _imt_scores(local_imt):
+    scores = {}
+
+    denominator = local_imt.get('yearlyAvgOffersDenominator')
+    if _isset(denominator):
+        offers = local_imt.get('yearlyAvgOffersPer10Candidates')
+        if not _isset(offers):
+            offers = local_imt.get('yearlyAvgOffersPer10Openings')
+        scores['marketStress'] = (
+            float(denominator) / offers if _isset(offers) else _MAX_MARKET_STRESS)
+
+    application_modes = local_imt.get('applicationModes')
+    if isinstance(application_modes, dict):
+        for rank in ('first', 'second'):
+            modes = set(mode.get(rank) for mode in application_modes.values())
+            modes.discard(None)
+            modes.discard('UNDEFINED_APPLICATION_MODE')
+            if modes:
+                scores['%sApplicationModes' % rank] = sorted(modes)
+
+    return scores
+
+
+def _isset(value):
+    """Check whether a numeric IMT value is set and not 0 (nor NaN)."""
+    return bool(value) and value == value
+
+
+if __name__ == "__main__":
+    mongo.importer_main(csv2dicts, 'local_market_scores')  # pragma: no cover
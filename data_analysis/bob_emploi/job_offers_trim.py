@@ -10,18 +10,30 @@ docker-compose run --rm data-analysis-prepare \
     data/job_offers/column_names.txt \
     data/job_offers/trimmed_offers.csv \
     2015-06-01 \
-    rome_profession_card_code,experience_min_duration,creation_date
+    rome_profession_card_code,experience_min_duration,creation_date \
+    100000
+
+The last argument is optional: if set, only a uniform sample of that many job
+offers is kept, see sampling.reservoir_sample.
 """
 import csv
+import itertools
 import sys
 
+import pandas
+
 from bob_emploi.lib import job_offers
+from bob_emploi.lib import sampling
 
 _DEFAULT_FIELDS = 'rome_profession_card_code,experience_min_duration,creation_date'
 
+# Number of job offers handled at once when sampling.
+_CHUNK_SIZE = 100000
+
 
 def trim_job_offers_csv(
-        in_csv, colnames_txt, out_csv, min_creation_date='', fields=_DEFAULT_FIELDS):
+        in_csv, colnames_txt, out_csv, min_creation_date='', fields=_DEFAULT_FIELDS,
+        sample_size=None, seed=0):
     """Trim job offers CSV.
 
     Args:
@@ -30,10 +42,21 @@ def trim_job_offers_csv(
         colnames_txt: the TXT file containing the list of column names.
         out_csv: the path where to store the output CSV file.
         fields: the list of fields to keep, separated by commas.
+        sample_size: if set, only keep a uniform sample of that many job
+            offers, in their original order.
+        seed: an integer to get a different sample.
     """
     fieldnames = fields.split(',')
     all_job_offers = job_offers.iterate(
         in_csv, colnames_txt, required_fields=set(fieldnames + ['creation_date']))
+    if sample_size:
+        recent_job_offers = (
+            [getattr(job_offer, field) for field in fieldnames]
+            for job_offer in all_job_offers if job_offer.creation_date >= min_creation_date)
+        sample = sampling.reservoir_sample(
+            _data_frames(recent_job_offers, fieldnames), int(sample_size), seed=int(seed))
+        sample.reindex(columns=fieldnames).to_csv(out_csv, index=False)
+        return
     with open(out_csv, 'w') as out_file:
         writer = csv.DictWriter(out_file, fieldnames=fieldnames)
         writer.writeheader()
@@ -43,5 +66,14 @@ def trim_job_offers_csv(
             writer.writerow({field: getattr(job_offer, field) for field in fieldnames})
 
 
+def _data_frames(rows, columns):
+    while True:
+        data_frame = pandas.DataFrame.from_records(
+            list(itertools.islice(rows, _CHUNK_SIZE)), columns=columns)
+        if data_frame.empty:
+            return
+        yield data_frame
+
+
 if __name__ == "__main__":
     trim_job_offers_csv(*sys.argv[1:])
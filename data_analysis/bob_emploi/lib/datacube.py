@@ -0,0 +1,135 @@
+"""Storage of the datacubes computed from the FHS.
+
+The FHS scripts (e.g. fhs_category_duration or fhs_salaries) aggregate the
+very large FHS in smaller tables, the datacubes, that are then read by the
+importers. A datacube is written as CSV, or, if its filename ends with
+".parquet", as a compressed Parquet file: columns are then stored typed, with
+the ID-like columns as categories, so that they can be read again without
+parsing and with only the needed columns and rows.
+"""
+import contextlib
+import csv
+import operator
+import tempfile
+
+import pandas
+
+try:
+    import pyarrow
+    from pyarrow import parquet
+except ImportError:
+    # Parquet is optional: without pyarrow, datacubes can only be CSV files.
+    pyarrow = None
+
+# Compression codec of the Parquet files.
+_COMPRESSION = 'snappy'
+
+# Operators that can be used in the filters of the read function.
+_OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda column, values: column.isin(values),
+    'not in': lambda column, values: ~column.isin(values),
+}
+
+
+def is_parquet(filename):
+    """Check whether a datacube file uses the Parquet format."""
+    return filename.endswith('.parquet')
+
+
+def write(data_frame, filename, categorical_columns=()):
+    """Write a datacube.
+
+    Args:
+        data_frame: the datacube as a pandas.DataFrame, its index is not
+            written.
+        filename: the path of the file to write, a Parquet file if it ends
+            with ".parquet", a CSV file otherwise.
+        categorical_columns: columns to store as categories in a Parquet
+            file, e.g. job group or city IDs.
+    """
+    if not is_parquet(filename):
+        data_frame.to_csv(filename, index=False)
+        return
+    if pyarrow is None:
+        raise ImportError('pyarrow is needed to write %s.' % filename)
+    data_frame = data_frame.reset_index(drop=True)
+    for column in categorical_columns:
+        data_frame[column] = data_frame[column].astype('category')
+    parquet.write_table(
+        pyarrow.Table.from_pandas(data_frame, preserve_index=False), filename,
+        compression=_COMPRESSION)
+
+
+@contextlib.contextmanager
+def csv_writer(filename, categorical_columns=(), dtype=None):
+    """Open a datacube to write it row by row with a csv.writer.
+
+    For a Parquet file, the rows are first written in a temporary CSV file
+    which is then converted when closing the datacube.
+
+    Args:
+        filename: the path of the file to write, see write.
+        categorical_columns: columns to store as categories, see write.
+        dtype: the types of the other columns if they should not be
+            inferred, as in pandas.read_csv.
+    Yields:
+        a csv.writer to write the header and the rows.
+    """
+    if not is_parquet(filename):
+        with open(filename, 'w') as csv_file:
+            yield csv.writer(csv_file)
+        return
+    with tempfile.NamedTemporaryFile('w', suffix='.csv') as csv_file:
+        yield csv.writer(csv_file)
+        csv_file.flush()
+        data_frame = pandas.read_csv(csv_file.name, dtype=dict(
+            dtype or {}, **{column: str for column in categorical_columns}))
+    write(data_frame, filename, categorical_columns)
+
+
+def read(filename, columns=None, filters=None, dtype=None):
+    """Read a datacube.
+
+    Args:
+        filename: the path of the datacube, a Parquet file if it ends with
+            ".parquet", a CSV file otherwise.
+        columns: the columns to read, by default all of them. For a Parquet
+            file, the other columns are not even loaded.
+        filters: a list of (column, operator, value) conditions that the rows
+            must all match, e.g. [('code_rome', '==', 'A1234')]. The
+            operators are '==', '!=', '<', '<=', '>', '>=', 'in' and
+            'not in'. For a Parquet file, the rows are filtered while reading.
+        dtype: the types of the columns of a CSV file, as in
+            pandas.read_csv. Parquet files are already typed.
+    Returns:
+        a pandas.DataFrame. The categorical columns of a Parquet file only
+        keep the categories of the rows that were read.
+    """
+    filters = [tuple(condition) for condition in filters or []]
+    for unused_column, operator_name, unused_value in filters:
+        if operator_name not in _OPERATORS:
+            raise ValueError('Unsupported operator: [%s], want one of [%s]' % (
+                operator_name, sorted(_OPERATORS)))
+
+    if is_parquet(filename):
+        data_frame = parquet.read_table(
+            filename, columns=columns and list(columns), filters=filters or None).to_pandas()
+        for column, values in data_frame.items():
+            if isinstance(values.dtype, pandas.CategoricalDtype):
+                data_frame[column] = values.cat.remove_unused_categories()
+        return data_frame
+
+    filter_columns = [column for column, unused_operator, unused_value in filters]
+    usecols = columns and list(columns) + [c for c in filter_columns if c not in columns]
+    data_frame = pandas.read_csv(filename, usecols=usecols, dtype=dtype)
+    for column, operator_name, value in filters:
+        data_frame = data_frame[_OPERATORS[operator_name](data_frame[column], value)]
+    if columns:
+        data_frame = data_frame[list(columns)]
+    return data_frame.reset_index(drop=True)
@@ -1,10 +1,22 @@
 # encoding: utf-8
 """Module for helpers to work with the FHS dataset."""
 import collections
+import csv
 import datetime
+import functools
+import glob
+import heapq
+import itertools
+import multiprocessing
+import operator
+import os
 from os import path
 import re
+import tempfile
 
+import pandas
+
+from bob_emploi.lib import fhs_cache
 from bob_emploi.lib import migration_helpers
 
 # The tables in the FHS.
@@ -72,7 +84,8 @@ GENDER_FIELD = 'SEXE'
 _REGION_MATCHER = re.compile(r'/Reg(\d+)/')
 
 
-def job_seeker_iterator(fhs_folder, tables=(UNEMPLOYMENT_PERIOD_TABLE,)):
+def job_seeker_iterator(
+        fhs_folder, tables=(UNEMPLOYMENT_PERIOD_TABLE,), region=None, columns=None):
     """Iterator on job seekers based of the FHS.
 
     This function assumes that the FHS has a specific structure:
@@ -85,6 +98,12 @@ def job_seeker_iterator(fhs_folder, tables=(UNEMPLOYMENT_PERIOD_TABLE,)):
     Args:
         fhs_folder: path of the root folder of the FHS files.
         tables: list of tables to join.
+        region: the region of the job seekers to iterate on, e.g. "27", see
+            list_regions. By default, iterates on all regions.
+        columns: an optional dict of the columns to read for each table. If
+            set, rows only contain those columns, the job seeker's index as
+            an int and the dates as datetime.date, see read_table. Otherwise
+            rows contain all the columns as strings.
 
     Yields:
         one dict per job seeker containing the IDX of the job_seeker and for
@@ -92,31 +111,352 @@ def job_seeker_iterator(fhs_folder, tables=(UNEMPLOYMENT_PERIOD_TABLE,)):
         tables is 'de', 'e0' the function will yield {'de': [...], 'e0': [...],
         'IDX': ...}
     """
-    def _table_iterator(table):
-        return PeekIterator(migration_helpers.flatten_iterator(
-            path.join(fhs_folder, '*/%s_*.csv' % table)))
-    iterators = {table: _table_iterator(table) for table in set(tables)}
-
-    while any(not i.done for i in iterators.values()):
-        # Find the next job seeker to process: look at all iterators that still
-        # have data and pick the one that has the smallest key.
-        key = min(
-            job_seeker_key(i.peek())
-            for i in iterators.values() if not i.done)
-        job_seeker = {}
-        for table, i in iterators.items():
-            values = []
-            while not i.done:
-                current = i.peek()
-                if job_seeker_key(current) != key:
-                    break
-                values.append(current)
-                next(i)
-            job_seeker[table] = values
+    tables = sorted(set(tables))
+
+    # Merge the rows of all tables, sorted by key: ties are kept in the order
+    # of the tables and, within a table, in the order of the files.
+    def _table_rows(table):
+        files_pattern = table_files_pattern(fhs_folder, table, region)
+        if columns is None:
+            return migration_helpers.flatten_iterator(files_pattern)
+        return read_table(files_pattern, columns[table])
+
+    keyed_rows = heapq.merge(
+        *[_keyed_rows(table, _table_rows(table)) for table in tables], key=_ROW_KEY)
+
+    for key, rows in itertools.groupby(keyed_rows, key=_ROW_KEY):
+        job_seeker = {table: [] for table in tables}
+        for unused_key, table, row in rows:
+            job_seeker[table].append(row)
         job_seeker[JOBSEEKER_ID_FIELD] = str(key.IDX)
         yield JobSeeker(job_seeker)
 
 
+# Key of the tuples yielded by _keyed_rows.
+_ROW_KEY = operator.itemgetter(0)
+
+
+def _keyed_rows(table, rows):
+    """Add the job seeker key to each row, parsing each file's region once."""
+    filename = None
+    region = None
+    for row in rows:
+        if row['__file__'] != filename:
+            filename = row['__file__']
+            region = extract_region(filename)
+        yield _JobSeekerKey(region, int(float(row[JOBSEEKER_ID_FIELD]))), table, row
+
+
+def table_files_pattern(fhs_folder, table, region=None):
+    """Get the glob pattern of the CSV files of an FHS table.
+
+    Args:
+        fhs_folder: path of the root folder of the FHS files.
+        table: the table, e.g. "de".
+        region: the region, e.g. "27". By default, files of all regions match.
+    """
+    region_folder = '*' if region is None else 'Reg%s' % region
+    return path.join(fhs_folder, '%s/%s_*.csv' % (region_folder, table))
+
+
+# Columns of the FHS tables containing dates as YYYY-MM-DD.
+DATE_COLUMNS = frozenset([REGISRATION_DATE_FIELD, CANCELATION_DATE_FIELD, 'JOURFV'])
+
+
+def read_table(files_pattern, columns):
+    """Iterate over the rows of an FHS table, reading only some columns.
+
+    This is a lighter version of migration_helpers.flatten_iterator for the
+    FHS: rows are smaller and their values are already parsed. If a file has
+    an up-to-date columnar cache (see fhs_cache), only the requested columns
+    are read from the cache.
+
+    Args:
+        files_pattern: a glob pattern for the CSV files of the table.
+        columns: the columns to read. The job seeker's index is always read.
+
+    Yields:
+        each record as a dict with the requested columns, the job seeker's
+        index as an int, the dates as datetime.date (or '' if empty), and the
+        '__file__' field with the filename from which the record was
+        extracted.
+    """
+    files = sorted(glob.glob(files_pattern))
+    if not files:
+        raise ValueError('No files found matching %s' % files_pattern)
+    columns = [JOBSEEKER_ID_FIELD] + [c for c in columns if c != JOBSEEKER_ID_FIELD]
+    date_indices = [i for i, column in enumerate(columns) if column in DATE_COLUMNS]
+
+    for current_file in files:
+        if fhs_cache.is_fresh(current_file):
+            for record in fhs_cache.read_rows(current_file, columns):
+                record['__file__'] = current_file
+                yield record
+            continue
+        with open(current_file) as csv_file:
+            reader = csv.reader(csv_file)
+            header_line = next(reader)
+            try:
+                indices = [header_line.index(column) for column in columns]
+            except ValueError:
+                raise ValueError('Missing columns in file %s. Was expecting:\n%s\n  got:\n%s' % (
+                    current_file, columns, header_line))
+            for line in reader:
+                values = [line[i] for i in indices]
+                values[0] = int(float(values[0]))
+                for i in date_indices:
+                    values[i] = parse_date(values[i])
+                record = dict(zip(columns, values))
+                record['__file__'] = current_file
+                yield record
+
+
+def read_data_frame(files_pattern, columns):
+    """Read some columns of an FHS table in a pandas.DataFrame.
+
+    Args:
+        files_pattern: a glob pattern for the CSV files of the table.
+        columns: the columns to read. The job seeker's index is always read.
+
+    Returns:
+        a DataFrame with a row for each record, in the order of the files,
+        the job seeker's index as int, the dates as datetime64 (NaT if empty)
+        and the other columns as strings.
+    """
+    return pandas.concat(list(data_frame_iterator(files_pattern, columns)), ignore_index=True)
+
+
+def data_frame_iterator(files_pattern, columns, chunk_size=None):
+    """Read some columns of an FHS table in chunks.
+
+    Args:
+        files_pattern: a glob pattern for the CSV files of the table.
+        columns: the columns to read. The job seeker's index is always read.
+        chunk_size: the maximum number of rows of each chunk, by default a
+            chunk per file.
+
+    Yields:
+        DataFrames of consecutive records, typed as in read_data_frame.
+    """
+    files = sorted(glob.glob(files_pattern))
+    if not files:
+        raise ValueError('No files found matching %s' % files_pattern)
+    columns = [JOBSEEKER_ID_FIELD] + [c for c in columns if c != JOBSEEKER_ID_FIELD]
+
+    for current_file in files:
+        if fhs_cache.is_fresh(current_file):
+            for frame in fhs_cache.data_frame_iterator(current_file, columns, chunk_size):
+                yield frame
+            continue
+        frames = pandas.read_csv(
+            current_file, usecols=columns, dtype=str, keep_default_na=False,
+            chunksize=chunk_size)
+        for frame in [frames] if chunk_size is None else frames:
+            frame = frame[columns]
+            frame[JOBSEEKER_ID_FIELD] = frame[JOBSEEKER_ID_FIELD].astype(float).astype('int64')
+            for column in DATE_COLUMNS.intersection(columns):
+                # Empty dates are parsed as NaT.
+                frame[column] = pandas.to_datetime(frame[column], format='%Y-%m-%d')
+            yield frame
+
+
+@functools.lru_cache(maxsize=None)
+def parse_date(value):
+    """Parse a date from the FHS.
+
+    The FHS contains a lot of rows for only a few thousands different days so
+    parsed dates are cached.
+
+    Args:
+        value: a date as YYYY-MM-DD, or an empty string.
+    Returns:
+        a datetime.date, or '' if the value was empty.
+    """
+    if not value:
+        return ''
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def list_regions(fhs_folder, table=UNEMPLOYMENT_PERIOD_TABLE):
+    """List the regions of the FHS.
+
+    Args:
+        fhs_folder: path of the root folder of the FHS files.
+        table: the table whose files are used to find the regions.
+    Returns:
+        a sorted list of regions, e.g. ['01', '27'], in the order in which
+        job_seeker_iterator iterates on them.
+    """
+    return sorted({
+        extract_region(filename)
+        for filename in glob.glob(table_files_pattern(fhs_folder, table))})
+
+
+def map_regions(fhs_folder, region_func, processes=None, progress=None):
+    """Apply a function on each region of the FHS in parallel.
+
+    As the data of a job seeker is always in a single region, regions can be
+    processed independently.
+
+    Args:
+        fhs_folder: path of the root folder of the FHS files.
+        region_func: a function called with fhs_folder and a region, e.g.
+            region_func(fhs_folder, '27'). It is run in a separate process so
+            it must be picklable, e.g. a module-level function or a
+            functools.partial of one.
+        processes: the number of processes to use, by default the number of
+            CPUs. With 1 process, the regions are processed in the current
+            process.
+        progress: an optional function called with the number of regions
+            processed and the total number of regions.
+    Returns:
+        the list of the results of region_func for each region, in the order
+        of list_regions.
+    """
+    regions = list_regions(fhs_folder)
+    func = functools.partial(region_func, fhs_folder)
+    if processes == 1 or len(regions) <= 1:
+        return _collect_results(map(func, regions), len(regions), progress)
+    with multiprocessing.Pool(processes) as pool:
+        # imap returns the results in the order of the regions, whichever
+        # process finishes first.
+        return _collect_results(pool.imap(func, regions, chunksize=1), len(regions), progress)
+
+
+def _collect_results(results, total, progress):
+    collected = []
+    for result in results:
+        collected.append(result)
+        if progress:
+            progress(len(collected), total)
+    return collected
+
+
+def _count_job_seekers_in_region(keys_func, tables, columns, fhs_folder, region):
+    counts = collections.Counter()
+    for job_seeker in job_seeker_iterator(fhs_folder, tables, region=region, columns=columns):
+        counts.update(keys_func(job_seeker))
+    return counts
+
+
+def count_job_seekers(
+        fhs_folder, keys_func, tables=(UNEMPLOYMENT_PERIOD_TABLE,), processes=None,
+        progress=None, columns=None):
+    """Count job seekers by keys, processing regions in parallel.
+
+    Args:
+        fhs_folder: path of the root folder of the FHS files.
+        keys_func: a function returning an iterable of keys for a JobSeeker.
+            It must be picklable, see map_regions.
+        tables: list of tables to join, see job_seeker_iterator.
+        processes: the number of processes to use, see map_regions.
+        progress: an optional function to follow the progress, see map_regions.
+        columns: the columns to read for each table, see job_seeker_iterator.
+    Returns:
+        a Counter of keys, whose keys are in the same order as if the job
+        seekers had been processed sequentially.
+    """
+    counts = collections.Counter()
+    for region_counts in map_regions(
+            fhs_folder,
+            functools.partial(_count_job_seekers_in_region, keys_func, tables, columns),
+            processes=processes, progress=progress):
+        counts.update(region_counts)
+    return counts
+
+
+def _count_rows_in_region(key_func, table, fhs_folder, region):
+    counts = collections.Counter()
+    for row in migration_helpers.flatten_iterator(
+            table_files_pattern(fhs_folder, table, region)):
+        key = key_func(row)
+        if key is not None:
+            counts[key] += 1
+    return counts
+
+
+def count_rows(
+        fhs_folder, key_func, table=UNEMPLOYMENT_PERIOD_TABLE, processes=None, progress=None):
+    """Count the rows of an FHS table by key, processing regions in parallel.
+
+    Args:
+        fhs_folder: path of the root folder of the FHS files.
+        key_func: a function returning the key of a row as a dict, or None to
+            skip the row. It must be picklable, see map_regions.
+        table: the table to read.
+        processes: the number of processes to use, see map_regions.
+        progress: an optional function to follow the progress, see map_regions.
+    Returns:
+        a Counter of keys, whose keys are in the same order as if the rows had
+        been processed sequentially.
+    """
+    counts = collections.Counter()
+    for region_counts in map_regions(
+            fhs_folder, functools.partial(_count_rows_in_region, key_func, table),
+            processes=processes, progress=progress):
+        counts.update(region_counts)
+    return counts
+
+
+def _job_seeker_rows_in_region(rows_func, tables, columns, fhs_folder, region):
+    for job_seeker in job_seeker_iterator(fhs_folder, tables, region=region, columns=columns):
+        for row in rows_func(job_seeker):
+            yield row
+
+
+def write_job_seeker_rows(
+        fhs_folder, rows_func, csv_writer, tables=(UNEMPLOYMENT_PERIOD_TABLE,), processes=None,
+        progress=None, columns=None):
+    """Write CSV rows for each job seeker, processing regions in parallel.
+
+    Args:
+        fhs_folder: path of the root folder of the FHS files.
+        rows_func: a function returning an iterable of rows for a JobSeeker.
+            It must be picklable, see map_regions.
+        csv_writer: a csv.writer to write the rows to.
+        tables: list of tables to join, see job_seeker_iterator.
+        processes: the number of processes to use, see map_regions.
+        progress: an optional function to follow the progress, see map_regions.
+        columns: the columns to read for each table, see job_seeker_iterator.
+    """
+    write_region_rows(
+        fhs_folder, functools.partial(_job_seeker_rows_in_region, rows_func, tables, columns),
+        csv_writer, processes=processes, progress=progress)
+
+
+def _write_region_rows(region_rows_func, tmp_folder, fhs_folder, region):
+    filename = path.join(tmp_folder, '%s.csv' % region)
+    with open(filename, 'w') as csv_file:
+        csv.writer(csv_file).writerows(region_rows_func(fhs_folder, region))
+    return filename
+
+
+def write_region_rows(fhs_folder, region_rows_func, csv_writer, processes=None, progress=None):
+    """Write CSV rows for each region, processing regions in parallel.
+
+    Each region is written to a temporary file, then they are concatenated in
+    the order of the regions, so the output does not depend on the number of
+    processes.
+
+    Args:
+        fhs_folder: path of the root folder of the FHS files.
+        region_rows_func: a function called with fhs_folder and a region,
+            returning an iterable of rows. It must be picklable, see
+            map_regions.
+        csv_writer: a csv.writer to write the rows to.
+        processes: the number of processes to use, see map_regions.
+        progress: an optional function to follow the progress, see map_regions.
+    """
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        region_files = map_regions(
+            fhs_folder, functools.partial(_write_region_rows, region_rows_func, tmp_folder),
+            processes=processes, progress=progress)
+        for region_file in region_files:
+            with open(region_file) as csv_file:
+                csv_writer.writerows(csv.reader(csv_file))
+            os.remove(region_file)
+
+
 # A key representing a job seeker.
 #
 # The key has the following property:
@@ -265,18 +605,16 @@ class JobSeeker(object):
 
     def _exclude_worked_months(self, periods):
         """Exlude months where the job seeker worked at least one hour."""
+        exclusions = []
         for work_time_month in self._data[PART_TIME_WORK_TABLE]:
             begin, end = _month_bounds(work_time_month[PART_TIME_WORK_MONTH_FIELD])
-            periods.exclude_period(
+            exclusions.append((
                 begin,
                 end,
-                lambda m: dict(m, **{
-                    REGISTRATION_REASON_FIELD: RegistrationReason.END_OF_PART_TIME_WORK,
-                    REGISRATION_DATE_FIELD: end}),  # pylint: disable=cell-var-from-loop
-                lambda m: dict(m, **{
-                    CANCELATION_REASON_FIELD: CancellationReason.STARTING_PART_TIME_WORK,
-                    CANCELATION_DATE_FIELD: begin}),  # pylint: disable=cell-var-from-loop
-            )
+                functools.partial(_end_part_time_work, end),
+                functools.partial(_start_part_time_work, begin),
+            ))
+        periods.exclude_periods(exclusions)
 
     def state_at_date(self, when):
         """Computes the state of the job seeker at a given date.
@@ -298,6 +636,18 @@ class JobSeeker(object):
             return period
 
 
+def _end_part_time_work(end, metadata):
+    return dict(metadata, **{
+        REGISTRATION_REASON_FIELD: RegistrationReason.END_OF_PART_TIME_WORK,
+        REGISRATION_DATE_FIELD: end})
+
+
+def _start_part_time_work(begin, metadata):
+    return dict(metadata, **{
+        CANCELATION_REASON_FIELD: CancellationReason.STARTING_PART_TIME_WORK,
+        CANCELATION_DATE_FIELD: begin})
+
+
 class RegistrationReason(object):
     """Class enumerating reason for job seeker registration.
 
@@ -363,9 +713,9 @@ class Period(object):
     def __init__(self, begin, end, metadata):
         """Initialize with begin/end dates (or string dates) and metadata."""
         if isinstance(begin, str):
-            begin = datetime.datetime.strptime(begin, "%Y-%m-%d").date()
+            begin = parse_date(begin)
         if isinstance(end, str):
-            end = datetime.datetime.strptime(end, "%Y-%m-%d").date()
+            end = parse_date(end)
         self.begin = begin
         self.end = end
         self.metadata = metadata
@@ -465,6 +815,40 @@ class DateIntervals(object):
 
         self._periods = periods_before + modified_periods + periods_after
 
+    def exclude_periods(self, exclusions):
+        """Exclude several periods from the existing interval.
+
+        This is equivalent to calling exclude_period for each exclusion in the
+        order of their beginning, but it processes all of them in one pass.
+
+        Args:
+            exclusions: a list of 4-tuples with the arguments of
+                exclude_period: begin, end, metadata_cut_begin and
+                metadata_cut_end.
+        """
+        if not exclusions or not self._periods:
+            return
+        done = []
+        pending = collections.deque(self._periods)
+        for begin, end, metadata_cut_begin, metadata_cut_end in sorted(
+                exclusions, key=lambda exclusion: exclusion[0]):
+            # Periods finishing before this exclusion also finish before all
+            # the next ones.
+            while pending and pending[0].end and pending[0].end < begin:
+                done.append(pending.popleft())
+            modified_periods = []
+            while pending and pending[0].begin <= end:
+                period = pending.popleft()
+                if period.begin < begin:
+                    modified_periods.append(Period(
+                        period.begin, begin, metadata_cut_end(period.metadata)))
+                if period.end is None or end < period.end:
+                    modified_periods.append(Period(
+                        end, period.end, metadata_cut_begin(period.metadata)))
+            # The modified periods may still be cut by the next exclusions.
+            pending.extendleft(reversed(modified_periods))
+        self._periods = done + list(pending)
+
     def exclude_after(self, date, update_metadata):
         """Exclude all dates after a given date."""
         periods = []
@@ -491,20 +875,33 @@ class DateIntervals(object):
         if not self._periods:
             return
         periods = []
-        period = self._periods[0]
+        # Collect each run of periods separated by small holes, and only
+        # create a new Period once the run is over.
+        run_begin = self._periods[0]
+        merged = []
         for next_period in self._periods[1:]:
-            if period.end + max_duration < next_period.begin:
+            run_end = merged[-1] if merged else run_begin
+            if run_end.end + max_duration < next_period.begin:
                 # The hole is too big.
-                periods.append(period)
-                period = next_period
+                periods.append(_merge_run(run_begin, merged, merge_metadata))
+                run_begin = next_period
+                merged = []
                 continue
-            period = Period(
-                period.begin, next_period.end,
-                merge_metadata(period.metadata, next_period.metadata))
-        periods.append(period)
+            merged.append(next_period)
+        periods.append(_merge_run(run_begin, merged, merge_metadata))
         self._periods = periods
 
 
+def _merge_run(first_period, next_periods, merge_metadata):
+    """Merge a run of periods separated by small holes in a single period."""
+    if not next_periods:
+        return first_period
+    metadata = first_period.metadata
+    for period in next_periods:
+        metadata = merge_metadata(metadata, period.metadata)
+    return Period(first_period.begin, next_periods[-1].end, metadata)
+
+
 def _month_bounds(year_month):
     """Compute a month's bounds.
 
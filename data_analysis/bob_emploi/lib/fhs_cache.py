@@ -0,0 +1,201 @@
+"""Columnar cache of the FHS tables.
+
+Each file of an FHS table, e.g. "Reg27/de_ech201512.csv", can be converted
+once to a Parquet file next to it, "Reg27/de_ech201512.parquet", so that the
+cache is partitioned by region as the FHS itself. See fhs_to_parquet.
+
+In the cache, rows are kept in the order of the file, the job seeker's index
+is stored as an int, dates as dates and all other columns as strings. The FHS readers use
+the cache of a file instead of the file itself when it is more recent.
+"""
+import datetime
+import os
+from os import path
+
+import pandas
+
+try:
+    import pyarrow
+    from pyarrow import parquet
+except ImportError:
+    # The cache is optional: without pyarrow, the FHS readers use the source
+    # files directly.
+    pyarrow = None
+
+# Number of rows read at once from a cache file.
+_READ_BATCH_SIZE = 10000
+
+
+def cache_filename(source_filename):
+    """Get the name of the cache file of an FHS file."""
+    return path.splitext(source_filename)[0] + '.parquet'
+
+
+def is_fresh(source_filename):
+    """Check whether an FHS file has an up-to-date cache that can be read.
+
+    Args:
+        source_filename: the path of the FHS file, e.g. a CSV file.
+    Returns:
+        True if the cache exists, is more recent than the source file, and
+        pyarrow is available to read it.
+    """
+    if pyarrow is None:
+        return False
+    try:
+        return path.getmtime(cache_filename(source_filename)) >= path.getmtime(source_filename)
+    except OSError:
+        return False
+
+
+def write_table(source_filename, header, rows, id_column, date_columns=()):
+    """Write the cache of an FHS file.
+
+    Args:
+        source_filename: the path of the FHS file, e.g. a CSV file.
+        header: the list of columns of the file.
+        rows: an iterable of lists of values, in the order of the header.
+            They are written in the same order.
+        id_column: the column with the job seeker's index, stored as an int.
+        date_columns: the columns to store as dates. Their values can be
+            dates or strings formatted as YYYY-MM-DD.
+    """
+    if pyarrow is None:
+        raise ImportError('pyarrow is needed to write the FHS cache.')
+    columns = {column: [] for column in header}
+    for row in rows:
+        for column, value in zip(header, row):
+            columns[column].append(value)
+
+    arrays = []
+    for column in header:
+        values = columns[column]
+        if column == id_column:
+            arrays.append(pyarrow.array([int(float(value)) for value in values], pyarrow.int64()))
+        elif column in date_columns:
+            arrays.append(pyarrow.array([_to_date(value) for value in values], pyarrow.date32()))
+        else:
+            arrays.append(pyarrow.array(
+                ['' if value is None else str(value) for value in values], pyarrow.string()))
+    table = pyarrow.Table.from_arrays(arrays, names=list(header))
+
+    # Write to a temporary file first so that an interrupted conversion never
+    # leaves a fresh but incomplete cache.
+    filename = cache_filename(source_filename)
+    parquet.write_table(table, filename + '.tmp')
+    os.replace(filename + '.tmp', filename)
+
+
+def _to_date(value):
+    if not value:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def read_header(source_filename):
+    """Read the list of columns from the cache of an FHS file."""
+    return parquet.read_schema(cache_filename(source_filename)).names
+
+
+def read_rows(source_filename, columns=None, as_strings=False):
+    """Read the rows from the cache of an FHS file.
+
+    Args:
+        source_filename: the path of the FHS file, e.g. a CSV file.
+        columns: the columns to read, by default all of them.
+        as_strings: whether to format the values as in a CSV file, instead
+            of using their types in the cache.
+    Yields:
+        each record as a dict using the columns as keys. Missing dates are
+        empty strings.
+    """
+    cache_file = parquet.ParquetFile(cache_filename(source_filename))
+    if columns is None:
+        columns = cache_file.schema_arrow.names
+    else:
+        _check_columns(source_filename, cache_file.schema_arrow.names, columns)
+    for batch in cache_file.iter_batches(batch_size=_READ_BATCH_SIZE, columns=list(columns)):
+        values = batch.to_pydict()
+        if as_strings:
+            values = {
+                column: [_to_string(value) for value in column_values]
+                for column, column_values in values.items()}
+        else:
+            values = {
+                column: ['' if value is None else value for value in column_values]
+                for column, column_values in values.items()}
+        for row in zip(*[values[column] for column in columns]):
+            yield dict(zip(columns, row))
+
+
+def read_data_frame(source_filename, columns):
+    """Read some columns from the cache of an FHS file in a pandas.DataFrame.
+
+    Args:
+        source_filename: the path of the FHS file, e.g. a CSV file.
+        columns: the columns to read.
+    Returns:
+        a DataFrame with the types of the cache, dates as datetime64.
+    """
+    return next(data_frame_iterator(source_filename, columns))
+
+
+def data_frame_iterator(
+        source_filename, columns=None, chunk_size=None, as_strings=False, id_filter=None):
+    """Read some columns from the cache of an FHS file in chunks.
+
+    Args:
+        source_filename: the path of the FHS file, e.g. a CSV file.
+        columns: the columns to read, by default all of them.
+        chunk_size: the maximum number of rows of each chunk, by default the
+            whole file is read in a single chunk.
+        as_strings: whether to format the values as in a CSV file, instead
+            of using their types in the cache.
+        id_filter: a tuple (id_column, func) to only keep some rows: func is
+            called with the indices of the job seekers of a chunk as a numpy
+            array and returns a mask of the rows to keep. The rows are
+            filtered before being converted to pandas.
+    Yields:
+        DataFrames with the types of the cache, dates as datetime64, or only
+        strings if as_strings is set.
+    """
+    cache_file = parquet.ParquetFile(cache_filename(source_filename))
+    if columns is None:
+        columns = cache_file.schema_arrow.names
+    else:
+        _check_columns(source_filename, cache_file.schema_arrow.names, columns)
+    if chunk_size is None:
+        batches = [cache_file.read(columns=list(columns))]
+    else:
+        batches = cache_file.iter_batches(batch_size=chunk_size, columns=list(columns))
+    for batch in batches:
+        if id_filter:
+            id_column, func = id_filter
+            ids = batch.column(batch.schema.get_field_index(id_column)).to_numpy()
+            batch = batch.filter(pyarrow.array(func(ids)))
+        if as_strings:
+            yield pandas.DataFrame({
+                name: column.cast(pyarrow.string()).to_pandas().fillna('')
+                for name, column in zip(batch.schema.names, batch.columns)
+            }, columns=batch.schema.names)
+            continue
+        yield batch.to_pandas(date_as_object=False)
+
+
+def _check_columns(source_filename, cached_columns, columns):
+    missing_columns = set(columns) - set(cached_columns)
+    if missing_columns:
+        raise ValueError('Missing columns in the cache of %s: %s' % (
+            source_filename, sorted(missing_columns)))
+
+
+def _to_string(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return str(value)
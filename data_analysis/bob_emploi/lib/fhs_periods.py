@@ -0,0 +1,229 @@
+"""Vectorized computation of the unemployment periods of the FHS.
+
+This computes the same periods as JobSeeker.unemployment_a_periods or
+unemployment_abc_periods followed by DateIntervals.exclude_after, but for all
+the job seekers of a region at once, with NumPy arrays instead of a
+DateIntervals object per job seeker.
+
+As DateIntervals, it assumes that the unemployment periods of a job seeker do
+not overlap.
+"""
+import numpy
+
+from bob_emploi.lib import fhs
+
+# Day number used as the end of unfinished periods.
+_OPEN_END = 2 ** 30
+
+# Offset of day numbers in the keys, so that they are always positive.
+_DAY_OFFSET = 2 ** 31
+
+# Categories of the unemployment periods in ABC.
+_ABC_CATEGORIES = ('1', '2', '3')
+
+
+def unemployment_periods(de_frame, e0_frame, period_type, cover_holes_up_to, now):
+    """Compute the unemployment periods of all job seekers.
+
+    Args:
+        de_frame: the "de" table as read by fhs.read_data_frame, with at least
+            the DATINS, DATANN, CATREGR, MOTINS and MOTANN columns.
+        e0_frame: the "e0" table as read by fhs.read_data_frame, with the MOIS
+            column. It is only needed if period_type is "a".
+        period_type: "a" for the periods of category A unemployment, "abc"
+            for the periods of category A, B or C.
+        cover_holes_up_to: consecutive unemployment periods with up to
+            cover_holes_up_to days in between are merged into a single
+            unemployment period.
+        now: the date at which the FHS was extracted: periods are cut at this
+            date.
+
+    Returns:
+        a DataFrame with a row for each period, sorted by job seeker and date,
+        with the "begin" and "end" dates of the period and the columns of
+        de_frame except DATINS and DATANN. As in the metadata of the
+        DateIntervals, the MOTINS column comes from the first "de" row of the
+        period, and the other ones from the last.
+    """
+    is_abc = de_frame[fhs.PERIOD_CATEGORY_FIELD].isin(_ABC_CATEGORIES).values
+    positions = numpy.flatnonzero(is_abc)
+    idx = de_frame[fhs.JOBSEEKER_ID_FIELD].values[positions].astype('int64')
+    begin = _days(de_frame[fhs.REGISRATION_DATE_FIELD].values[positions])
+    end = _days(de_frame[fhs.CANCELATION_DATE_FIELD].values[positions])
+    order = numpy.lexsort((begin, idx))
+    periods = _Periods(
+        idx[order], begin[order], end[order], positions[order],
+        de_frame[fhs.REGISTRATION_REASON_FIELD].values[positions[order]],
+        de_frame[fhs.CANCELATION_REASON_FIELD].values[positions[order]])
+
+    if period_type == 'a':
+        periods = _exclude_worked_months(periods, e0_frame)
+    periods = _cover_holes(periods, cover_holes_up_to)
+    periods = _exclude_after(periods, _days(numpy.array([now], dtype='datetime64[D]'))[0])
+
+    result = de_frame.iloc[periods.rows].drop(
+        [fhs.REGISRATION_DATE_FIELD, fhs.CANCELATION_DATE_FIELD], axis=1).reset_index(drop=True)
+    result[fhs.REGISTRATION_REASON_FIELD] = periods.registration_reasons
+    result[fhs.CANCELATION_REASON_FIELD] = periods.cancelation_reasons
+    result['begin'] = periods.begin.astype('datetime64[D]')
+    result['end'] = periods.end.astype('datetime64[D]')
+    return result
+
+
+class _Periods(object):
+    """Periods of many job seekers, as arrays sorted by job seeker and date.
+
+    Attributes:
+        idx: the index of the job seeker of each period.
+        begin: the first day of each period, as a day number.
+        end: the first day after each period, or _OPEN_END.
+        rows: the position in the "de" table of the row of each period.
+        registration_reasons: the MOTINS of each period.
+        cancelation_reasons: the MOTANN of each period.
+    """
+
+    def __init__(self, idx, begin, end, rows, registration_reasons, cancelation_reasons):
+        self.idx = idx
+        self.begin = begin
+        self.end = end
+        self.rows = rows
+        self.registration_reasons = registration_reasons
+        self.cancelation_reasons = cancelation_reasons
+
+    def take(self, indices):
+        """Select some of the periods."""
+        return _Periods(
+            self.idx[indices], self.begin[indices], self.end[indices], self.rows[indices],
+            self.registration_reasons[indices], self.cancelation_reasons[indices])
+
+
+def _days(dates):
+    """Convert datetime64 values to day numbers, NaT becoming _OPEN_END."""
+    days = dates.astype('datetime64[D]').astype('int64')
+    days[numpy.isnat(dates)] = _OPEN_END
+    return days
+
+
+def _keys(idx, days):
+    """Compute keys sorted as (job seeker, day)."""
+    return (idx << 32) + (days + _DAY_OFFSET)
+
+
+def _exclude_worked_months(periods, e0_frame):
+    """Exclude the months where the job seekers worked, see DateIntervals.exclude_periods."""
+    months = e0_frame[fhs.PART_TIME_WORK_MONTH_FIELD].astype(str)
+    month_numbers = (months.str[:4].astype(int) - 1970) * 12 + months.str[4:].astype(int) - 1
+    month_begin = month_numbers.values.astype('int64').astype('datetime64[M]')
+    month_idx = e0_frame[fhs.JOBSEEKER_ID_FIELD].values.astype('int64')
+    order = numpy.lexsort((month_begin, month_idx))
+    month_idx = month_idx[order]
+    month_end = _days(month_begin[order] + 1)
+    month_begin = _days(month_begin[order])
+
+    # Merge the months of each job seeker that follow each other.
+    is_new_union = numpy.ones(len(month_idx), dtype=bool)
+    is_new_union[1:] = (month_idx[1:] != month_idx[:-1]) | (month_begin[1:] > month_end[:-1])
+    union_starts = numpy.flatnonzero(is_new_union)
+    union_idx = month_idx[union_starts]
+    union_begin_keys = _keys(union_idx, month_begin[union_starts])
+    union_end_keys = _keys(union_idx, numpy.maximum.reduceat(month_end, union_starts)) \
+        if len(union_starts) else union_begin_keys
+
+    # For each period, the worked months in it are between first_union and
+    # last_union. It is split in one more piece than there are such months.
+    begin_keys = _keys(periods.idx, periods.begin)
+    first_union = numpy.searchsorted(union_end_keys, begin_keys, side='right')
+    last_union = numpy.searchsorted(
+        union_begin_keys, _keys(periods.idx, periods.end), side='left')
+    # Empty periods are never split: they are dropped if they touch a worked
+    # month, and kept as they are otherwise.
+    is_empty = periods.begin == periods.end
+    last_union[is_empty] = first_union[is_empty]
+    is_empty_dropped = is_empty & _is_in_closed_union(
+        begin_keys, union_begin_keys, union_end_keys)
+    num_pieces = last_union - first_union + 1
+    piece_periods = numpy.repeat(numpy.arange(len(num_pieces)), num_pieces)
+    piece_index = numpy.arange(len(piece_periods)) - numpy.repeat(
+        numpy.cumsum(num_pieces) - num_pieces, num_pieces)
+    union_before = first_union[piece_periods] + piece_index - 1
+    union_after = union_before + 1
+    is_first = piece_index == 0
+    is_last = union_after == last_union[piece_periods]
+    max_union = max(len(union_starts) - 1, 0)
+    piece_begin = numpy.where(
+        is_first, periods.begin[piece_periods],
+        _key_days(union_end_keys, numpy.clip(union_before, 0, max_union)))
+    piece_end = numpy.where(
+        is_last, periods.end[piece_periods],
+        _key_days(union_begin_keys, numpy.clip(union_after, 0, max_union)))
+    is_kept = (piece_begin < piece_end) | (is_empty & ~is_empty_dropped)[piece_periods]
+    pieces = periods.take(piece_periods[is_kept])
+    pieces.begin = piece_begin[is_kept]
+    pieces.end = piece_end[is_kept]
+
+    # Periods starting right after a worked month, or stopping right before
+    # one, were updated even if they were not cut.
+    pieces.registration_reasons = numpy.where(
+        _is_in(_keys(pieces.idx, pieces.begin), union_end_keys),
+        fhs.RegistrationReason.END_OF_PART_TIME_WORK, pieces.registration_reasons)
+    pieces.cancelation_reasons = numpy.where(
+        _is_in(_keys(pieces.idx, pieces.end), union_begin_keys),
+        fhs.CancellationReason.STARTING_PART_TIME_WORK, pieces.cancelation_reasons)
+    return pieces
+
+
+def _key_days(keys, indices):
+    if not len(keys):
+        return numpy.zeros(len(indices), dtype='int64')
+    return (keys[indices] & (2 ** 32 - 1)) - _DAY_OFFSET
+
+
+def _is_in_closed_union(keys, union_begin_keys, union_end_keys):
+    """Check whether days are in a union of worked months or at its bounds."""
+    positions = numpy.searchsorted(union_begin_keys, keys, side='right') - 1
+    is_in = positions >= 0
+    is_in[is_in] = union_end_keys[positions[is_in]] >= keys[is_in]
+    return is_in
+
+
+def _is_in(keys, sorted_keys):
+    positions = numpy.searchsorted(sorted_keys, keys)
+    is_in = positions < len(sorted_keys)
+    is_in[is_in] = sorted_keys[positions[is_in]] == keys[is_in]
+    return is_in
+
+
+def _cover_holes(periods, max_days):
+    """Merge periods separated by small holes, see DateIntervals.cover_holes."""
+    if not len(periods.idx):
+        return periods
+    is_new_run = numpy.ones(len(periods.idx), dtype=bool)
+    is_new_run[1:] = (periods.idx[1:] != periods.idx[:-1]) | \
+        (periods.begin[1:] - periods.end[:-1] > max_days)
+    run_starts = numpy.flatnonzero(is_new_run)
+    run_ends = numpy.append(run_starts[1:], len(is_new_run)) - 1
+    runs = periods.take(run_ends)
+    runs.begin = periods.begin[run_starts]
+    runs.registration_reasons = periods.registration_reasons[run_starts]
+    return runs
+
+
+def _exclude_after(periods, day):
+    """Cut periods at a given day, see DateIntervals.exclude_after."""
+    is_before = periods.end <= day
+    is_cut = ~is_before & (periods.begin < day)
+    runs = periods.take(is_before | is_cut)
+    is_cut = is_cut[is_before | is_cut]
+    runs.end = numpy.where(is_cut, day, runs.end)
+    runs.cancelation_reasons = numpy.where(
+        is_cut, fhs.CancellationReason.NOW, runs.cancelation_reasons)
+    return runs
+
+
+def last_periods(periods):
+    """Keep only the last period of each job seeker.
+
+    Args:
+        periods: a DataFrame as returned by unemployment_periods.
+    """
+    return periods[~periods[fhs.JOBSEEKER_ID_FIELD].duplicated(keep='last')]
@@ -0,0 +1,33 @@
+"""Convert FHS files to their columnar cache, see fhs_cache.
+
+If you managed to get your hands on the FHS dataset, you can run:
+    docker-compose run --rm data-analysis-prepare python \
+        bob_emploi/lib/fhs_to_parquet.py \
+        "data/pole_emploi/FHS/FHS 201512/"*/{de,e0,rome}_*.csv
+"""
+import sys
+
+from bob_emploi.lib import fhs
+from bob_emploi.lib import fhs_cache
+from bob_emploi.lib import migration_helpers
+
+
+def convert_files(files):
+    """Create or update the cache of each FHS file."""
+    num_files = len(files)
+    print('Attempting to convert %d files' % num_files)
+
+    for i, filename in enumerate(sorted(files)):
+        print('%d/%d: Converting %s to %s' % (
+            i + 1, num_files, filename, fhs_cache.cache_filename(filename)))
+        if fhs_cache.is_fresh(filename):
+            print('Skipping, cache is up to date')
+            continue
+        lines = migration_helpers.read_file(filename)
+        fhs_cache.write_table(
+            filename, next(lines), lines,
+            id_column=fhs.JOBSEEKER_ID_FIELD, date_columns=fhs.DATE_COLUMNS)
+
+
+if __name__ == '__main__':
+    convert_files(sys.argv[1:])  # pragma: no-cover
@@ -1,6 +1,7 @@
 """helper functions for migrating data into the postgres database."""
 
 import csv
+import functools
 import glob
 import itertools
 import logging
@@ -10,8 +11,14 @@ import re
 import pandas as pd
 from sas7bdat import SAS7BDAT
 
+from bob_emploi.lib import fhs_cache
+from bob_emploi.lib import sampling as sampling_lib
+
 _LOGGER = logging.getLogger('alembic')
 
+# Number of rows of a SAS file loaded at once when sampling it.
+_SAS_CHUNK_SIZE = 100000
+
 
 def region_iteratior(base_path, file_name):
     """Iterate over all region folders.
@@ -46,6 +53,9 @@ def flatten_iterator(files_pattern):
     extra field at the end '__file__' which contains the filename from which the
     record was extracted.
 
+    If a file has an up-to-date columnar cache (see fhs_cache), the cache is
+    read instead of the file.
+
     Args:
         files_pattern: a glob pattern for the files to flatten. They should all
             have the same schema. Must end with .csv or .sas7bdat.
@@ -62,52 +72,115 @@ def flatten_iterator(files_pattern):
     print('Flattening %d files' % len(files))
 
     for current_file in sorted(files):
-        reader = None
-        if files_pattern.endswith('sas7bdat'):
-            reader = SAS7BDAT(current_file).readlines()
-        elif files_pattern.endswith('csv'):
-            reader = csv.reader(open(current_file))
+        if fhs_cache.is_fresh(current_file):
+            header_line = fhs_cache.read_header(current_file)
+            lines = None
         else:
-            raise ValueError(
-                'Can only process .csv and .sas7bdat files. Got pattern %s'
-                % files_pattern)
-        header_line = next(reader)
+            reader = read_file(current_file)
+            header_line = next(reader)
+            lines = reader
         if headers is None:
             headers = header_line + ['__file__']
-        elif headers[:-1] != header_line:
-            raise ValueError(
-                'Headers from file %s don\'t match those of previous '
-                'files. Was expecting:\n%s\n  got:\n%s'
-                % (current_file,
-                   headers[:-1],  # pylint: disable=unsubscriptable-object
-                   header_line))
-        for line in reader:
+        else:
+            _check_header(current_file, headers[:-1], header_line)
+        if lines is None:
+            for record in fhs_cache.read_rows(current_file, as_strings=True):
+                record['__file__'] = current_file
+                yield record
+            continue
+        for line in lines:
             yield dict(zip(headers, line + [current_file]))
 
 
+def read_file(filename):
+    """Read the lines of an FHS file.
+
+    Args:
+        filename: the path of the file. Must end with .csv or .sas7bdat.
+
+    Returns:
+        an iterator on the lines of the file as lists of values, starting
+        with the header line.
+    """
+    if filename.endswith('sas7bdat'):
+        return iter(SAS7BDAT(filename).readlines())
+    if filename.endswith('csv'):
+        return csv.reader(open(filename))
+    raise ValueError(
+        'Can only process .csv and .sas7bdat files. Got file %s' % filename)
+
+
 def sample_data_frame(files_pattern, sampling=100, seed=97, limit=None):
     """Create a pandas.DataFrame from a sample of a full FHS table.
 
     Args:
         files_pattern: a glob pattern for the files to flatten. They should all
-            have the same schema.
+            have the same schema. Must end with .csv or .sas7bdat.
         sampling: we examine 1 out of N jobseekers only (sampling using
-            the mod of the person's index).
-        seed: we will get only the values that are equal to seed modulo
-            sampling.
+            a hash of the person's index, see sampling.is_job_seeker_sampled).
+        seed: which of the N disjoint samples of jobseekers to keep.
         limit: if set, overrides sampling, and only take the first rows.
 
     Returns:
-        a pandas.DataFrame.
+        a pandas.DataFrame with an extra '__file__' column with the file
+        from which the record was extracted. Values of CSV files are kept as
+        strings, values of SAS files as typed by the SAS reader.
     """
-    seed = seed % sampling
-    iterator = flatten_iterator(files_pattern)
-    columns = next(iterator)
+    files = sorted(glob.glob(files_pattern))
+    if not files:
+        raise ValueError('No files found matching %s' % files_pattern)
+
     if limit:
-        data = [r for r in itertools.islice(iterator, limit)]
+        id_filter = None
     else:
-        data = [r for r in iterator if float(r['IDX']) % sampling == seed]
-    return pd.DataFrame(data, columns=columns)
+        id_filter = ('IDX', functools.partial(
+            sampling_lib.is_job_seeker_sampled, sampling=sampling, seed=seed))
+    headers = None
+    data_frames = []
+    num_rows = 0
+    for current_file in files:
+        if fhs_cache.is_fresh(current_file):
+            header_line = fhs_cache.read_header(current_file)
+        else:
+            header_line = next(read_file(current_file))
+        if headers is None:
+            headers = header_line
+        else:
+            _check_header(current_file, headers, header_line)
+        for data_frame in _read_data_frames(current_file, id_filter):
+            if limit:
+                data_frame = data_frame.iloc[:limit - num_rows]
+            data_frames.append(data_frame.assign(__file__=current_file))
+            num_rows += len(data_frame)
+            if limit and num_rows >= limit:
+                return pd.concat(data_frames, ignore_index=True)
+    return pd.concat(data_frames, ignore_index=True)
+
+
+def _check_header(filename, expected_header, header):
+    if expected_header != header:
+        raise ValueError(
+            'Headers from file %s don\'t match those of previous '
+            'files. Was expecting:\n%s\n  got:\n%s' % (filename, expected_header, header))
+
+
+def _read_data_frames(filename, id_filter):
+    if fhs_cache.is_fresh(filename) or not filename.endswith('sas7bdat'):
+        return sampling_lib.fhs_file_iterator(filename, id_filter=id_filter)
+    return _read_sas_data_frames(filename, id_filter)
+
+
+def _read_sas_data_frames(filename, id_filter):
+    lines = read_file(filename)
+    header = next(lines)
+    while True:
+        data_frame = pd.DataFrame(list(itertools.islice(lines, _SAS_CHUNK_SIZE)), columns=header)
+        if data_frame.empty:
+            return
+        if id_filter:
+            id_column, func = id_filter
+            data_frame = data_frame[func(data_frame[id_column])]
+        yield data_frame
 
 
 def transform_categorial_vars(data_frame, codebook_or_path):
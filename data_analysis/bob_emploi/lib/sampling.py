@@ -0,0 +1,191 @@
+"""Streaming samplers for the large datasets, e.g. to build dev fixtures.
+
+Two kinds of samples are available:
+ - by job seeker, for the FHS: a job seeker is kept if a hash of their index
+   falls in the right bucket, so that all the rows of a job seeker are kept
+   together, in all the tables, whatever the order in which they are read.
+ - by row, for any table: a reservoir keeps a uniform sample of a fixed
+   number of rows without loading the whole table.
+
+Both are deterministic: the same inputs and seed always give the same sample.
+
+If you managed to get your hands on the FHS dataset, you can create a 1%
+sample of it by running:
+    docker-compose run --rm data-analysis-prepare python \
+        bob_emploi/lib/sampling.py \
+        "data/pole_emploi/FHS/FHS 201512" \
+        data/pole_emploi/FHS/sample \
+        100
+"""
+import functools
+import glob
+import multiprocessing
+import os
+from os import path
+import sys
+
+import numpy
+import pandas
+
+from bob_emploi.lib import fhs_cache
+
+# Number of rows read at once from a file.
+_CHUNK_SIZE = 100000
+
+# Constants of the splitmix64 hash function.
+_GOLDEN_GAMMA = numpy.uint64(0x9e3779b97f4a7c15)
+_MIX_MULTIPLIERS = (numpy.uint64(0xbf58476d1ce4e5b9), numpy.uint64(0x94d049bb133111eb))
+
+
+def hash_ids(ids, seed=0):
+    """Hash integers to pseudo-random 64-bit integers.
+
+    Args:
+        ids: an array-like of integers, e.g. job seekers' indices.
+        seed: an integer to get different hashes for the same IDs.
+    Returns:
+        a numpy array of uint64, the same for the same IDs and seed.
+    """
+    values = numpy.asarray(ids, dtype='int64').astype('uint64')
+    # Integer overflows are expected: arithmetic is modulo 2 ** 64.
+    with numpy.errstate(over='ignore'):
+        values = values + _GOLDEN_GAMMA * numpy.uint64(seed + 1)
+        for shift, multiplier in zip((30, 27), _MIX_MULTIPLIERS):
+            values = (values ^ (values >> numpy.uint64(shift))) * multiplier
+        return values ^ (values >> numpy.uint64(31))
+
+
+def is_job_seeker_sampled(ids, sampling, seed=0):
+    """Check which job seekers are in a sample.
+
+    Args:
+        ids: an array-like of job seekers' indices, as integers or as strings
+            as found in the FHS CSV files, e.g. "12.0".
+        sampling: we keep 1 out of N job seekers.
+        seed: which of the N disjoint samples to keep.
+    Returns:
+        a numpy array of booleans.
+    """
+    ids = pandas.to_numeric(pandas.Series(ids)).values.astype('int64')
+    return hash_ids(ids) % numpy.uint64(sampling) == numpy.uint64(seed % sampling)
+
+
+def reservoir_sample(data_frames, size, seed=0):
+    """Sample uniformly a fixed number of rows from a stream of DataFrames.
+
+    Each row gets a pseudo-random key from a hash of its position in the
+    stream and the rows with the smallest keys are kept, so the sample does
+    not depend on how the stream is chunked.
+
+    Args:
+        data_frames: an iterable of DataFrames with the same columns.
+        size: the number of rows to keep.
+        seed: an integer to get a different sample.
+    Returns:
+        a DataFrame with up to size rows, in the order of the stream.
+    """
+    sample = None
+    sample_keys = numpy.array([], dtype='uint64')
+    position = 0
+    for data_frame in data_frames:
+        keys = hash_ids(numpy.arange(position, position + len(data_frame)), seed)
+        position += len(data_frame)
+        if sample is not None:
+            data_frame = pandas.concat([sample, data_frame])
+            keys = numpy.concatenate([sample_keys, keys])
+        if len(keys) > size:
+            kept = numpy.sort(numpy.argpartition(keys, size)[:size])
+            data_frame = data_frame.iloc[kept]
+            keys = keys[kept]
+        sample = data_frame
+        sample_keys = keys
+    if sample is None:
+        return pandas.DataFrame()
+    return sample.reset_index(drop=True)
+
+
+def fhs_file_iterator(filename, chunk_size=_CHUNK_SIZE, id_filter=None):
+    """Read an FHS file as strings, in chunks.
+
+    Args:
+        filename: the path of the CSV file. Its columnar cache is used if it
+            is up to date, see fhs_cache.
+        chunk_size: the maximum number of rows of each chunk.
+        id_filter: a tuple (id_column, func) to only keep some rows: func is
+            called with the indices of the job seekers of a chunk and returns
+            a mask of the rows to keep. With the columnar cache, the other
+            rows are never converted to pandas.
+    Yields:
+        DataFrames of consecutive rows with all the columns as strings, as in
+        the CSV file.
+    """
+    if fhs_cache.is_fresh(filename):
+        for data_frame in fhs_cache.data_frame_iterator(
+                filename, chunk_size=chunk_size, as_strings=True, id_filter=id_filter):
+            yield data_frame
+        return
+    if not filename.endswith('.csv'):
+        raise ValueError('Can only read .csv files. Got file %s' % filename)
+    for data_frame in pandas.read_csv(
+            filename, dtype=str, keep_default_na=False, chunksize=chunk_size):
+        if id_filter:
+            id_column, func = id_filter
+            data_frame = data_frame[func(data_frame[id_column])]
+        yield data_frame
+
+
+def sample_fhs_file(filename, sampling, seed=0, id_column='IDX'):
+    """Sample the job seekers of an FHS file.
+
+    Args:
+        filename: the path of the CSV file, see fhs_file_iterator.
+        sampling: we keep 1 out of N job seekers.
+        seed: which of the N disjoint samples to keep.
+        id_column: the column with the job seeker's index.
+    Returns:
+        an iterator of DataFrames of the rows of the sampled job seekers.
+    """
+    return fhs_file_iterator(filename, id_filter=(id_column, functools.partial(
+        is_job_seeker_sampled, sampling=sampling, seed=seed)))
+
+
+def sample_fhs(fhs_folder, output_folder, sampling=100, seed=0, processes=None):
+    """Write a sample of the FHS by job seeker, processing files in parallel.
+
+    Args:
+        fhs_folder: path of the root folder of the FHS files.
+        output_folder: path of the folder in which to write the sample. Each
+            CSV file of the FHS is sampled to the same relative path.
+        sampling: we keep 1 out of N job seekers.
+        seed: which of the N disjoint samples to keep.
+        processes: the number of processes to use, by default the number of
+            CPUs. With 1 process, the files are sampled in the current
+            process.
+    Returns:
+        the total number of rows written.
+    """
+    files = sorted(glob.glob(path.join(fhs_folder, '*', '*.csv')))
+    if not files:
+        raise ValueError('No files found in %s' % fhs_folder)
+    sample_file = functools.partial(
+        _write_fhs_file_sample, fhs_folder, output_folder, sampling, seed)
+    if processes == 1:
+        return sum(map(sample_file, files))
+    with multiprocessing.Pool(processes) as pool:
+        return sum(pool.imap_unordered(sample_file, files))
+
+
+def _write_fhs_file_sample(fhs_folder, output_folder, sampling, seed, filename):
+    output_filename = path.join(output_folder, path.relpath(filename, fhs_folder))
+    os.makedirs(path.dirname(output_filename), exist_ok=True)
+    num_rows = 0
+    with open(output_filename, 'w') as output_file:
+        for index, data_frame in enumerate(sample_fhs_file(filename, sampling, seed)):
+            # The header is written with the first chunk, even if it is empty.
+            data_frame.to_csv(output_file, header=not index, index=False)
+            num_rows += len(data_frame)
+    return num_rows
+
+
+if __name__ == '__main__':
+    sample_fhs(sys.argv[1], sys.argv[2], *[int(arg) for arg in sys.argv[3:]])  # pragma: no-cover
@@ -3,6 +3,9 @@
 from os import path
 import unittest
 
+import numpy
+import pandas
+
 from bob_emploi.lib import mongo
 from bob_emploi.importer import fhs_local_diagnosis
 from bob_emploi.frontend.api import job_pb2
@@ -41,6 +44,34 @@ class FHSLocalDiagnosisTestCase(unittest.TestCase):
         self.assertEqual('74002', proto.best_city.city_id)
         self.assertEqual('Alby-sur-Chéran', proto.best_city.name)
 
+    def test_city_durations(self):
+        """Small groups are moved to ghost towns before being diagnosed."""
+        job_seekers = pandas.DataFrame(
+            [('c1', 'One', 'A', 10 + i, '01', 'r1') for i in range(10)] +
+            [('c2', 'Two', 'A', 20, '01', 'r1')] * 5 +
+            [('c3', 'Three', 'A', 30, '01', 'r1')] * 5 +
+            [('c4', 'Four', 'A', 40, '02', 'r1')] * 4 +
+            [('c5', 'Five', 'A', 50, '03', 'r1')] * 6 +
+            [('c6', 'Six', 'A', 60, '04', 'r2')] * 3 +
+            [('c7', 'Seven', 'B', 70, numpy.nan, 'r2')] * 10 +
+            [('c8', 'Eight', 'B', 80, numpy.nan, 'r2')] * 9,
+            columns=['city_id', 'city_name', 'code_rome', 'duration', 'departement_id',
+                     'region_id'])
+
+        city_diagnoses = fhs_local_diagnosis._city_durations(  # pylint: disable=protected-access
+            job_seekers)
+
+        self.assertEqual(
+            ['c1:A', 'ghost-d01:A', 'ghost-rr1:A', 'c7:B'], city_diagnoses.index.tolist())
+        self.assertEqual(
+            [('c1', 'One', 'A', {'days': 14}, '01', 'r1'),
+             ('ghost-d01', '', 'A', {'days': 25}, '01', 'r1'),
+             ('ghost-rr1', '', 'A', {'days': 50}, None, 'r1')],
+            [tuple(row) for row in city_diagnoses[[
+                'city_id', 'city_name', 'code_rome', 'duration', 'departement_id',
+                'region_id']].iloc[:3].itertuples(index=False)])
+        self.assertTrue(pandas.isnull(city_diagnoses.departement_id['c7:B']))
+
 
 if __name__ == '__main__':
     unittest.main()  # pragma: no cover
@@ -2,6 +2,8 @@
 import collections
 import unittest
 
+import pandas
+
 from bob_emploi.importer import fhs_salaries
 
 
@@ -92,6 +94,45 @@ class FHSSalariesTestCase(unittest.TestCase):
             'SALUNIT': 'A'})
         self.assertEqual(('N4101', '44', 'A', 17600, 17800), criteria)
 
+    def test_compute_annual_salaries(self):
+        """Salaries are the same with the vectorized version."""
+        salaries = fhs_salaries.compute_annual_salaries(
+            [test.SALMT for test in SALARY_TESTS], [test.SALUNIT for test in SALARY_TESTS])
+        self.assertEqual(
+            [fhs_salaries.compute_annual_salary(test.SALMT, test.SALUNIT)
+             for test in SALARY_TESTS],
+            salaries.tolist())
+
+    def test_bucketize_salaries(self):
+        """Buckets are the same with the vectorized version."""
+        salaries = [0, 0.1, 100, 17600, 17600.5, 24999, 25000, 49999.9, 250000]
+        low, high = fhs_salaries.bucketize_salaries(pandas.Series(salaries).values)
+        self.assertEqual(
+            [fhs_salaries.bucketize_salary({'SALMT': salary, 'SALUNIT': 'A'})
+             for salary in salaries],
+            list(zip(low.tolist(), high.tolist())))
+
+    def test_bucketize_invalid_salaries(self):
+        """Salaries that are not positive or not finite are in the (0, 0) bucket."""
+        low, high = fhs_salaries.bucketize_salaries(
+            pandas.Series([-100, -0.5, float('inf'), float('-inf'), float('nan'), 100]).values)
+        self.assertEqual(
+            [(0, 0)] * 5 + [fhs_salaries.bucketize_salary({'SALMT': 100, 'SALUNIT': 'A'})],
+            list(zip(low.tolist(), high.tolist())))
+
+    def test_count_open_job_seeker_criteria(self):
+        """Only open job requests are counted, by criteria."""
+        counts = fhs_salaries.count_open_job_seeker_criteria(pandas.DataFrame({
+            'ROME': ['N4101', 'N4101', 'A1234', 'N4101'],
+            'DEPCOM': ['44055', '44109', '97411', '44055'],
+            'SALMT': ['17650.1', '17700', '2000', '17650.1'],
+            'SALUNIT': ['A', 'A', 'M', 'A'],
+            'DATANN': pandas.to_datetime([None, None, None, '2015-01-01']),
+        }))
+        self.assertEqual(
+            [(('N4101', '44', 'A', 17600, 17800), 2), (('A1234', '974', 'M', 24000, 24200), 1)],
+            list(counts.items()))
+
 
 if __name__ == '__main__':
     unittest.main()  # pragma: no cover
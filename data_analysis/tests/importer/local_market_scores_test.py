@@ -0,0 +1,39 @@
+# encoding: utf-8
+"""Tests for the bob_emploi.importer.local_market_scores module."""
+from os import path
+import unittest
+
+from bob_emploi.lib import mongo
+from bob_emploi.importer import local_market_scores
+from bob_emploi.frontend.api import job_pb2
+
+
+class LocalMarketScoresTestCase(unittest.TestCase):
+    """Unit tests for the tested module functions."""
+
+    job_imt_json = path.join(path.dirname(__file__), 'testdata/imt_application_modes.json')
+
+    def test_csv2dicts(self):
+        """Basic usage of csv2dicts."""
+        market_scores = local_market_scores.csv2dicts(self.job_imt_json)
+        protos = dict(mongo.collection_to_proto_mapping(
+            market_scores, job_pb2.LocalMarketScores))
+
+        # No scores at all for 69 as its market stress is unknown.
+        self.assertEqual(['01:A1203', '74:A1203'], sorted(protos.keys()))
+
+        proto = protos['74:A1203']
+        self.assertAlmostEqual(2.5, proto.market_stress)
+        self.assertEqual(
+            [job_pb2.PERSONAL_OR_PROFESSIONAL_CONTACTS, job_pb2.SPONTANEOUS_APPLICATION],
+            proto.first_application_modes)
+        self.assertEqual([job_pb2.PLACEMENT_AGENCY], proto.second_application_modes)
+
+        proto = protos['01:A1203']
+        # No job offers at all.
+        self.assertEqual(1000, proto.market_stress)
+        self.assertFalse(proto.first_application_modes)
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
@@ -41,6 +41,24 @@ class JobOffersTrimTestCase(unittest.TestCase):
             '000BLZH,1\n',
             output)
 
+    def test_trim_sample(self):
+        """Only a sample of the job offers is kept."""
+        job_offers_trim.trim_job_offers_csv(
+            path.join(self.testdata_dir, 'job_offers.csv'),
+            path.join(self.testdata_dir, 'column_names.txt'),
+            self.tmpfile_name,
+            '2015-08-01',
+            'id_offre,experience_min_duration',
+            sample_size=2)
+
+        with open(self.tmpfile_name) as output_file:
+            output = output_file.read().split('\n')
+
+        self.assertEqual('id_offre,experience_min_duration', output[0])
+        self.assertEqual(4, len(output), msg=output)
+        all_rows = ['000053Q,5', '000185Q,6', '000BFNN,0', '000BLZH,1']
+        self.assertLess(all_rows.index(output[1]), all_rows.index(output[2]))
+
 
 if __name__ == '__main__':
     unittest.main()  # pragma: no cover
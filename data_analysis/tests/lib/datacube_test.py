@@ -0,0 +1,76 @@
+"""Tests for the bob_emploi.lib.datacube module."""
+from os import path
+import shutil
+import tempfile
+import unittest
+
+import pandas
+
+from bob_emploi.lib import datacube
+
+
+class DatacubeTestCase(unittest.TestCase):
+    """Unit tests for the datacube functions."""
+
+    def setUp(self):
+        super(DatacubeTestCase, self).setUp()
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.data_frame = pandas.DataFrame({
+            'code_rome': ['A1234', 'B1234', 'A1234'],
+            'city_id': ['01001', '97411', '01001'],
+            'duration': [10, 20, 30],
+        })
+
+    def test_write_read_parquet(self):
+        """Parquet datacubes keep their types."""
+        filename = path.join(self.folder, 'cube.parquet')
+        datacube.write(self.data_frame, filename, ['code_rome', 'city_id'])
+
+        data_frame = datacube.read(filename)
+        self.assertEqual('category', data_frame.city_id.dtype.name)
+        self.assertEqual('int64', data_frame.duration.dtype.name)
+        self.assertEqual(['01001', '97411', '01001'], data_frame.city_id.tolist())
+
+    def test_read_columns_and_filters(self):
+        """Only the requested columns and rows are read, in both formats."""
+        for filename in ('cube.csv', 'cube.parquet'):
+            filename = path.join(self.folder, filename)
+            datacube.write(self.data_frame, filename, ['code_rome', 'city_id'])
+
+            data_frame = datacube.read(
+                filename, columns=['duration', 'city_id'], dtype={'city_id': str},
+                filters=[('code_rome', '==', 'A1234'), ('duration', '>', 15)])
+            self.assertEqual(['duration', 'city_id'], list(data_frame.columns), msg=filename)
+            self.assertEqual([(30, '01001')], list(data_frame.itertuples(index=False)))
+
+    def test_read_unused_categories(self):
+        """Categories of the filtered out rows are dropped."""
+        filename = path.join(self.folder, 'cube.parquet')
+        datacube.write(self.data_frame, filename, ['code_rome'])
+
+        data_frame = datacube.read(filename, filters=[('city_id', 'not in', ['01001'])])
+        self.assertEqual(['B1234'], data_frame.code_rome.cat.categories.tolist())
+
+    def test_read_unsupported_operator(self):
+        """Unknown operators in filters are rejected."""
+        filename = path.join(self.folder, 'cube.csv')
+        datacube.write(self.data_frame, filename)
+
+        with self.assertRaises(ValueError):
+            datacube.read(filename, filters=[('duration', '~', 10)])
+
+    def test_csv_writer(self):
+        """Rows written one by one are converted to Parquet."""
+        filename = path.join(self.folder, 'cube.parquet')
+        with datacube.csv_writer(filename, ['code_rome', 'city_id']) as writer:
+            writer.writerow(('code_rome', 'city_id', 'duration'))
+            writer.writerow(('A1234', '01001', 10))
+
+        data_frame = datacube.read(filename)
+        self.assertEqual('category', data_frame.code_rome.dtype.name)
+        self.assertEqual([('A1234', '01001', 10)], list(data_frame.itertuples(index=False)))
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
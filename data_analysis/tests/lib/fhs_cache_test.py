@@ -0,0 +1,109 @@
+"""Tests for the bob_emploi.lib.fhs_cache module."""
+import datetime
+import os
+from os import path
+import shutil
+import tempfile
+import unittest
+
+from bob_emploi.lib import fhs
+from bob_emploi.lib import fhs_cache
+from bob_emploi.lib import fhs_to_parquet
+from bob_emploi.lib import migration_helpers
+
+
+class FhsCacheTestCase(unittest.TestCase):
+    """Unit tests for the FHS cache."""
+
+    def setUp(self):
+        super(FhsCacheTestCase, self).setUp()
+        self.fhs_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.fhs_folder)
+        os.mkdir(path.join(self.fhs_folder, 'Reg01'))
+        self.de_file = path.join(self.fhs_folder, 'Reg01/de_1.csv')
+        with open(self.de_file, 'w') as de_file:
+            de_file.write(
+                'IDX,ROME,DATINS,DATANN\n'
+                '2.0,A1234,2015-01-01,\n'
+                '1,B1234,2015-03-01,2015-06-01\n')
+
+    def test_convert_files(self):
+        """Converted files keep the order of the rows and are typed."""
+        fhs_to_parquet.convert_files([self.de_file])
+
+        self.assertTrue(path.exists(path.join(self.fhs_folder, 'Reg01/de_1.parquet')))
+        self.assertTrue(fhs_cache.is_fresh(self.de_file))
+        self.assertEqual(['IDX', 'ROME', 'DATINS', 'DATANN'], fhs_cache.read_header(self.de_file))
+        self.assertEqual([
+            {'IDX': 2, 'ROME': 'A1234', 'DATINS': datetime.date(2015, 1, 1), 'DATANN': ''},
+            {
+                'IDX': 1,
+                'ROME': 'B1234',
+                'DATINS': datetime.date(2015, 3, 1),
+                'DATANN': datetime.date(2015, 6, 1),
+            },
+        ], list(fhs_cache.read_rows(self.de_file)))
+
+    def test_read_rows_as_strings(self):
+        """Values can be read as in a CSV file."""
+        fhs_to_parquet.convert_files([self.de_file])
+
+        self.assertEqual(
+            [{'IDX': '2', 'DATANN': ''}, {'IDX': '1', 'DATANN': '2015-06-01'}],
+            list(fhs_cache.read_rows(self.de_file, ['IDX', 'DATANN'], as_strings=True)))
+
+    def test_read_rows_missing_column(self):
+        """Reading a column that is not in the cache fails."""
+        fhs_to_parquet.convert_files([self.de_file])
+
+        with self.assertRaises(ValueError):
+            list(fhs_cache.read_rows(self.de_file, ['SALMT']))
+
+    def test_stale_cache(self):
+        """The cache is not used anymore when the source file is updated."""
+        self.assertFalse(fhs_cache.is_fresh(self.de_file))
+        fhs_to_parquet.convert_files([self.de_file])
+        source_time = path.getmtime(fhs_cache.cache_filename(self.de_file)) + 10
+        os.utime(self.de_file, (source_time, source_time))
+
+        self.assertFalse(fhs_cache.is_fresh(self.de_file))
+        rows = list(migration_helpers.flatten_iterator(path.join(self.fhs_folder, '*/de_*.csv')))
+        self.assertEqual(['2.0', '1'], [row['IDX'] for row in rows])
+
+    def test_flatten_iterator(self):
+        """flatten_iterator reads the cache when it is up to date."""
+        fhs_to_parquet.convert_files([self.de_file])
+
+        rows = list(migration_helpers.flatten_iterator(path.join(self.fhs_folder, '*/de_*.csv')))
+        self.assertEqual({
+            'IDX': '1',
+            'ROME': 'B1234',
+            'DATINS': '2015-03-01',
+            'DATANN': '2015-06-01',
+            '__file__': self.de_file,
+        }, rows[1])
+        # Rows are in the order of the file, only the index format changes.
+        self.assertEqual(['2', '1'], [row['IDX'] for row in rows])
+
+    def test_job_seeker_iterator(self):
+        """Job seekers are the same with or without the cache."""
+        with open(self.de_file, 'w') as de_file:
+            de_file.write(
+                'IDX,ROME,DATINS,DATANN\n'
+                '1,B1234,2015-03-01,2015-06-01\n'
+                '2.0,A1234,2015-01-01,\n')
+
+        def _job_seekers():
+            return [
+                job_seeker.state_at_date(datetime.date(2015, 3, 1))
+                for job_seeker in fhs.job_seeker_iterator(
+                    self.fhs_folder, columns={'de': ['ROME', 'DATINS', 'DATANN']})]
+        without_cache = _job_seekers()
+        fhs_to_parquet.convert_files([self.de_file])
+
+        self.assertEqual(without_cache, _job_seekers())
+        self.assertEqual(['B1234', 'A1234'], [state['ROME'] for state in without_cache])
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
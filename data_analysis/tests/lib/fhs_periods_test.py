@@ -0,0 +1,137 @@
+"""Tests for the bob_emploi.lib.fhs_periods module."""
+import datetime
+import random
+import unittest
+
+import pandas
+
+from bob_emploi.lib import fhs
+from bob_emploi.lib import fhs_periods
+
+_NOW = datetime.date(2016, 1, 1)
+
+
+def _random_day(rand):
+    day = datetime.date(2014, 1, 1) + datetime.timedelta(days=rand.randrange(800))
+    if rand.random() < .3:
+        # Start of a month, to hit the bounds of the worked months.
+        return day.replace(day=1)
+    return day
+
+
+def _random_job_seeker(rand, idx):
+    de_rows = []
+    day = _random_day(rand)
+    for index in range(rand.randrange(5)):
+        end = day + datetime.timedelta(days=rand.choice((0, rand.randrange(1, 200))))
+        if rand.random() < .3:
+            end = end.replace(day=1) if end.replace(day=1) >= day else end
+        de_rows.append({
+            'IDX': idx,
+            'DATINS': day,
+            'DATANN': end,
+            'CATREGR': rand.choice('12345'),
+            'MOTINS': 'in%d' % index,
+            'MOTANN': 'out%d' % index,
+            'ROME': 'rome%d' % index,
+        })
+        day = end + datetime.timedelta(days=rand.randrange(60))
+    if de_rows and rand.random() < .4:
+        de_rows[-1]['DATANN'] = ''
+    e0_rows = [
+        {'IDX': idx, 'MOIS': '%d%02d' % (rand.choice((2014, 2015, 2016)), rand.randint(1, 12))}
+        for unused_index in range(rand.randrange(8))]
+    return de_rows, e0_rows
+
+
+def _expected_periods(de_rows, e0_rows, period_type):
+    job_seeker = fhs.JobSeeker({
+        'de': [dict(row) for row in de_rows],
+        'e0': [dict(row) for row in e0_rows],
+    })
+    if period_type == 'a':
+        periods = job_seeker.unemployment_a_periods(cover_holes_up_to=27)
+    else:
+        periods = job_seeker.unemployment_abc_periods(cover_holes_up_to=27)
+    periods.exclude_after(_NOW, lambda m: dict(m, MOTANN=fhs.CancellationReason.NOW))
+    return [
+        (p.metadata['IDX'], p.begin, p.end, p.metadata['MOTINS'], p.metadata['MOTANN'],
+         p.metadata['ROME'])
+        for p in periods]
+
+
+def _frame(rows, columns):
+    frame = pandas.DataFrame(rows, columns=columns)
+    for column in fhs.DATE_COLUMNS.intersection(columns):
+        frame[column] = pandas.to_datetime(frame[column], format='%Y-%m-%d')
+    return frame
+
+
+class UnemploymentPeriodsTestCase(unittest.TestCase):
+    """Unit tests for the unemployment_periods function."""
+
+    def _assert_same_periods(self, de_rows, e0_rows, period_type):
+        expected = []
+        for idx in sorted({row['IDX'] for row in de_rows}):
+            expected.extend(_expected_periods(
+                [row for row in de_rows if row['IDX'] == idx],
+                [row for row in e0_rows if row['IDX'] == idx],
+                period_type))
+
+        periods = fhs_periods.unemployment_periods(
+            _frame(de_rows, ['IDX', 'DATINS', 'DATANN', 'CATREGR', 'MOTINS', 'MOTANN', 'ROME']),
+            _frame(e0_rows, ['IDX', 'MOIS']), period_type, 27, _NOW)
+
+        self.assertEqual(expected, [
+            (row.IDX, row.begin.date(), row.end.date(), row.MOTINS, row.MOTANN, row.ROME)
+            for row in periods.itertuples()])
+
+    def test_same_as_job_seeker(self):
+        """Periods are the same as with the JobSeeker class."""
+        rand = random.Random(42)
+        de_rows = []
+        e0_rows = []
+        for idx in range(1, 300):
+            job_seeker_de_rows, job_seeker_e0_rows = _random_job_seeker(rand, idx)
+            de_rows.extend(job_seeker_de_rows)
+            e0_rows.extend(job_seeker_e0_rows)
+        rand.shuffle(e0_rows)
+
+        self._assert_same_periods(de_rows, e0_rows, 'a')
+        self._assert_same_periods(de_rows, e0_rows, 'abc')
+
+    def test_worked_months(self):
+        """Worked months cut the periods and update the reasons around them."""
+        periods = fhs_periods.unemployment_periods(
+            _frame([
+                (1, '2015-01-10', '2015-03-01', '1', 'in', 'out'),
+                (1, '2015-05-01', '', '1', 'in2', 'out2'),
+            ], ['IDX', 'DATINS', 'DATANN', 'CATREGR', 'MOTINS', 'MOTANN']),
+            _frame([(1, '201502'), (1, '201504')], ['IDX', 'MOIS']),
+            'a', 0, _NOW)
+
+        self.assertEqual([
+            (datetime.date(2015, 1, 10), datetime.date(2015, 2, 1), 'in', '91'),
+            (datetime.date(2015, 5, 1), datetime.date(2016, 1, 1), 'Y', '90'),
+        ], [
+            (row.begin.date(), row.end.date(), row.MOTINS, row.MOTANN)
+            for row in periods.itertuples()])
+
+    def test_last_periods(self):
+        """Only the last period of each job seeker is kept."""
+        periods = fhs_periods.unemployment_periods(
+            _frame([
+                (1, '2014-01-01', '2014-02-01', '1', 'in', 'out'),
+                (1, '2015-01-01', '2015-02-01', '1', 'in', 'out'),
+                (2, '2014-01-01', '2014-02-01', '2', 'in', 'out'),
+            ], ['IDX', 'DATINS', 'DATANN', 'CATREGR', 'MOTINS', 'MOTANN']),
+            None, 'abc', 0, _NOW)
+
+        last_periods = fhs_periods.last_periods(periods)
+        self.assertEqual(
+            [(1, datetime.date(2015, 1, 1)), (2, datetime.date(2014, 1, 1))],
+            [(row.IDX, row.begin.date()) for row in last_periods.itertuples()])
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
@@ -1,7 +1,15 @@
 # encoding: utf-8
 """Tests for the bob_emploi.lib.fhs module."""
 import collections
+import csv
 import datetime
+import functools
+import io
+import os
+from os import path
+import random
+import shutil
+import tempfile
 import unittest
 
 import mock
@@ -114,6 +122,24 @@ class FhsTestCase(unittest.TestCase):
             },
         ], data)
 
+    @mock.patch(fhs.__name__ + '.migration_helpers.flatten_iterator')
+    def test_job_seeker_iterator_missing_rows(self, mock_flatten_iterator):
+        """Job seekers missing from a table get an empty list for it."""
+        def _flatten_iterator(filename):
+            table = 'de' if '/de_' in filename else 'e0'
+            indices = ['1', '3', '3'] if table == 'de' else ['2', '3']
+            return iter([
+                {'IDX': idx, 'DATINS': idx, 'MOIS': idx, '__file__': '/fhs/Reg01/%s.csv' % table}
+                for idx in indices])
+        mock_flatten_iterator.side_effect = _flatten_iterator
+
+        seekers = fhs.job_seeker_iterator('/fhs', ('e0', 'de'))
+
+        data = [j._data for j in seekers]  # pylint: disable=protected-access
+        self.assertEqual(
+            [('1', 1, 0), ('2', 0, 1), ('3', 2, 1)],
+            [(d['IDX'], len(d['de']), len(d['e0'])) for d in data])
+
     def test_job_seeker_key_idx(self):
         """Test of the IDX property of key created by job_seeker_key."""
         key = fhs.job_seeker_key({
@@ -181,6 +207,217 @@ class FhsTestCase(unittest.TestCase):
         self.assertEqual('976', departement_id)
 
 
+def _rome_of_row(row):
+    return row['ROME'] or None
+
+
+def _job_seeker_rows(job_seeker, when='2016-01-01'):
+    state = job_seeker.state_at_date(when)
+    if not state:
+        return []
+    return [(state['IDX'], state['ROME'])]
+
+
+class RegionsTestCase(unittest.TestCase):
+    """Unit tests for the functions processing each FHS region separately."""
+
+    def setUp(self):
+        super(RegionsTestCase, self).setUp()
+        self.fhs_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.fhs_folder)
+        self._write_table('Reg21', 'de', [
+            ('2', 'B1234', '2015-01-01', '2015-06-01'),
+            ('2', 'A1234', '2015-07-01', ''),
+            ('15', '', '2015-01-01', ''),
+        ])
+        self._write_table('Reg01', 'de', [
+            ('1', 'A1234', '2015-01-01', ''),
+            ('15', 'C1234', '2015-02-01', ''),
+        ])
+        self._write_table('Reg27', 'de', [('3', 'A1234', '2015-01-01', '2015-03-01')])
+
+    def _write_table(self, region, table, rows):
+        region_folder = path.join(self.fhs_folder, region)
+        os.mkdir(region_folder)
+        with open(path.join(region_folder, '%s_%s.csv' % (table, region)), 'w') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(('IDX', 'ROME', 'DATINS', 'DATANN'))
+            writer.writerows(rows)
+
+    def test_list_regions(self):
+        """Basic usage of list_regions."""
+        self.assertEqual(['01', '21', '27'], fhs.list_regions(self.fhs_folder))
+
+    def test_job_seeker_iterator_region(self):
+        """Iterate on the job seekers of a single region."""
+        job_seekers = fhs.job_seeker_iterator(self.fhs_folder, region='21')
+        self.assertEqual(
+            [('21', 2), ('21', 15)],
+            [fhs.job_seeker_key(j.state_at_date('2015-01-01')) for j in job_seekers])
+
+    def test_read_table(self):
+        """Only the requested columns are read, and parsed."""
+        rows = list(fhs.read_table(path.join(self.fhs_folder, '*/de_*.csv'), ['ROME', 'DATANN']))
+        self.assertEqual(6, len(rows))
+        self.assertEqual({
+            'IDX': 1,
+            'ROME': 'A1234',
+            'DATANN': '',
+            '__file__': path.join(self.fhs_folder, 'Reg01/de_Reg01.csv'),
+        }, rows[0])
+        self.assertEqual(datetime.date(2015, 6, 1), rows[2]['DATANN'])
+
+    def test_read_table_missing_column(self):
+        """Reading a column that does not exist fails."""
+        with self.assertRaises(ValueError):
+            list(fhs.read_table(path.join(self.fhs_folder, '*/de_*.csv'), ['SALMT']))
+
+    def test_data_frame_iterator(self):
+        """Tables can be read in chunks of typed columns."""
+        frames = list(fhs.data_frame_iterator(
+            path.join(self.fhs_folder, '*/de_*.csv'), ['ROME', 'DATANN'], chunk_size=2))
+        self.assertEqual([2, 2, 1, 1], [len(frame) for frame in frames])
+        self.assertEqual(['IDX', 'ROME', 'DATANN'], list(frames[0].columns))
+        self.assertEqual([1, 15, 2, 2, 15, 3], [
+            idx for frame in frames for idx in frame.IDX.tolist()])
+        self.assertTrue(frames[0].DATANN.isnull().all())
+        self.assertEqual(datetime.date(2015, 6, 1), frames[1].DATANN[0].date())
+
+    def test_job_seeker_iterator_columns(self):
+        """Job seekers are the same when reading only some columns."""
+        job_seekers = fhs.job_seeker_iterator(
+            self.fhs_folder, columns={'de': ['ROME', 'DATINS', 'DATANN']})
+        self.assertEqual(
+            ['1,A1234', '15,C1234', '2,A1234', '15,'],
+            ['%s,%s' % row for job_seeker in job_seekers
+             for row in _job_seeker_rows(job_seeker, datetime.date(2016, 1, 1))])
+
+    def test_map_regions(self):
+        """Results are returned in the order of the regions."""
+        progress = []
+        results = fhs.map_regions(
+            self.fhs_folder, path.join, processes=2,
+            progress=lambda value, total: progress.append((value, total)))
+        self.assertEqual(
+            [path.join(self.fhs_folder, region) for region in ('01', '21', '27')], results)
+        self.assertEqual([(1, 3), (2, 3), (3, 3)], progress)
+
+    def test_count_rows(self):
+        """Counting rows gives the same result with several processes."""
+        counts = fhs.count_rows(self.fhs_folder, _rome_of_row, processes=2)
+        self.assertEqual({'A1234': 3, 'B1234': 1, 'C1234': 1}, counts)
+        self.assertEqual(
+            list(fhs.count_rows(self.fhs_folder, _rome_of_row, processes=1)), list(counts))
+
+    def test_write_job_seeker_rows(self):
+        """Rows are written in the order of the job seekers."""
+        output = io.StringIO()
+        fhs.write_job_seeker_rows(
+            self.fhs_folder, _job_seeker_rows, csv.writer(output), processes=3)
+        self.assertEqual(
+            ['1,A1234', '15,C1234', '2,A1234', '15,'],
+            output.getvalue().splitlines())
+
+
+def _random_periods(rand):
+    periods = []
+    day = datetime.date(2014, 1, 1) + datetime.timedelta(days=rand.randrange(60))
+    for index in range(rand.randrange(6)):
+        end = day + datetime.timedelta(days=rand.randrange(1, 300))
+        periods.append((day, end, {'index': index}))
+        day = end + datetime.timedelta(days=rand.randrange(40))
+    if periods and rand.random() < .3:
+        periods[-1] = (periods[-1][0], None, periods[-1][2])
+    return periods
+
+
+def _random_months(rand):
+    months = sorted(
+        '%d%02d' % (rand.choice((2014, 2015, 2016)), rand.randint(1, 12))
+        for unused_index in range(rand.randrange(12)))
+    return [fhs._month_bounds(month) for month in months]  # pylint: disable=protected-access
+
+
+def _cut(field, metadata):
+    """Count the number of times a metadata was updated."""
+    return dict(metadata, **{field: metadata.get(field, 0) + 1})
+
+
+def _cover_holes_sequentially(periods, max_duration, merge_metadata):
+    """The reference implementation of cover_holes, merging periods one by one."""
+    covered = []
+    period = periods[0]
+    for next_period in periods[1:]:
+        if period.end + max_duration < next_period.begin:
+            covered.append(period)
+            period = next_period
+            continue
+        period = fhs.Period(
+            period.begin, next_period.end, merge_metadata(period.metadata, next_period.metadata))
+    covered.append(period)
+    return covered
+
+
+class DateIntervalsTestCase(unittest.TestCase):
+    """Unit tests for the DateIntervals class."""
+
+    def test_exclude_periods(self):
+        """Excluding periods at once is the same as excluding them one by one."""
+        rand = random.Random(42)
+        for unused_index in range(500):
+            periods = _random_periods(rand)
+            exclusions = [
+                (begin, end,
+                 functools.partial(_cut, 'cut_begin'), functools.partial(_cut, 'cut_end'))
+                for begin, end in _random_months(rand)]
+
+            expected = fhs.DateIntervals(periods)
+            for exclusion in exclusions:
+                expected.exclude_period(*exclusion)
+            intervals = fhs.DateIntervals(periods)
+            intervals.exclude_periods(exclusions)
+
+            self.assertEqual(expected, intervals, msg=(periods, exclusions))
+
+    def test_exclude_periods_overlapping(self):
+        """Overlapping exclusions are applied in the order of their beginning."""
+        intervals = fhs.DateIntervals([
+            (datetime.date(2015, 1, 1), None, {}),
+        ])
+        intervals.exclude_periods([
+            (datetime.date(2015, 5, 1), datetime.date(2015, 7, 1),
+             functools.partial(_cut, 'cut_begin'), functools.partial(_cut, 'cut_end')),
+            (datetime.date(2015, 3, 1), datetime.date(2015, 6, 1),
+             functools.partial(_cut, 'cut_begin'), functools.partial(_cut, 'cut_end')),
+        ])
+        self.assertEqual(
+            [
+                (datetime.date(2015, 1, 1), datetime.date(2015, 3, 1), {'cut_end': 1}),
+                (datetime.date(2015, 7, 1), None, {'cut_begin': 2}),
+            ],
+            [period.as_tuple for period in intervals])
+
+    def test_cover_holes(self):
+        """Covering holes is the same as merging periods one by one."""
+        rand = random.Random(42)
+
+        def _merge(metadata1, metadata2):
+            merged = metadata1['merged'] if 'merged' in metadata1 else [metadata1['index']]
+            return {'merged': merged + [metadata2['index']]}
+
+        for unused_index in range(500):
+            periods = [p for p in _random_periods(rand) if p[1]]
+            if not periods:
+                continue
+            max_duration = datetime.timedelta(days=rand.randrange(60))
+
+            intervals = fhs.DateIntervals(periods)
+            expected = _cover_holes_sequentially(list(intervals), max_duration, _merge)
+            intervals.cover_holes(max_duration, _merge)
+
+            self.assertEqual(expected, list(intervals), msg=(periods, max_duration))
+
+
 # TODO: Add more unit tests.
 
 
@@ -0,0 +1,162 @@
+"""Tests for the bob_emploi.lib.sampling module."""
+import csv
+import os
+from os import path
+import shutil
+import tempfile
+import unittest
+
+import mock
+import pandas
+
+from bob_emploi.lib import fhs_to_parquet
+from bob_emploi.lib import migration_helpers
+from bob_emploi.lib import sampling
+
+
+class HashSamplingTestCase(unittest.TestCase):
+    """Unit tests for the sampling by job seeker."""
+
+    def test_hash_ids(self):
+        """Hashes are deterministic and depend on the seed."""
+        self.assertEqual(
+            sampling.hash_ids([1, 2, 3]).tolist(), sampling.hash_ids([1, 2, 3]).tolist())
+        self.assertNotEqual(
+            sampling.hash_ids([1, 2, 3]).tolist(), sampling.hash_ids([1, 2, 3], seed=1).tolist())
+
+    def test_is_job_seeker_sampled(self):
+        """Seeds give disjoint samples of about the same size."""
+        ids = list(range(10000))
+        masks = [sampling.is_job_seeker_sampled(ids, 10, seed) for seed in range(10)]
+
+        self.assertEqual([1] * 10000, sum(mask.astype(int) for mask in masks).tolist())
+        for mask in masks:
+            self.assertAlmostEqual(1000, mask.sum(), delta=100)
+
+    def test_is_job_seeker_sampled_strings(self):
+        """Indices from CSV files are parsed."""
+        self.assertEqual(
+            sampling.is_job_seeker_sampled([12, 13, 14], 3, 1).tolist(),
+            sampling.is_job_seeker_sampled(['12.0', '13', '14.0'], 3, 1).tolist())
+
+
+class ReservoirSampleTestCase(unittest.TestCase):
+    """Unit tests for the reservoir_sample function."""
+
+    def test_sample(self):
+        """The sample keeps the order of the stream and ignores chunks."""
+        data_frame = pandas.DataFrame({'value': range(1000)})
+
+        sample = sampling.reservoir_sample([data_frame], 50)
+        chunked_sample = sampling.reservoir_sample(
+            [data_frame.iloc[start:start + 7] for start in range(0, 1000, 7)], 50)
+
+        self.assertEqual(50, len(sample))
+        self.assertEqual(sorted(sample.value.tolist()), sample.value.tolist())
+        self.assertEqual(sample.value.tolist(), chunked_sample.value.tolist())
+        self.assertNotEqual(
+            sample.value.tolist(),
+            sampling.reservoir_sample([data_frame], 50, seed=1).value.tolist())
+
+    def test_small_stream(self):
+        """All rows are kept if there are not enough of them."""
+        data_frame = pandas.DataFrame({'value': range(10)})
+        self.assertEqual(
+            list(range(10)), sampling.reservoir_sample([data_frame], 50).value.tolist())
+        self.assertTrue(sampling.reservoir_sample([], 50).empty)
+
+
+class SampleFhsTestCase(unittest.TestCase):
+    """Unit tests for the sampling of FHS files."""
+
+    def setUp(self):
+        super(SampleFhsTestCase, self).setUp()
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.fhs_folder = path.join(self.folder, 'fhs')
+        for region in ('Reg01', 'Reg02'):
+            os.makedirs(path.join(self.fhs_folder, region))
+            for table, num_rows in (('de', 3), ('e0', 2)):
+                with open(path.join(self.fhs_folder, region, '%s_1.csv' % table), 'w') as file:
+                    writer = csv.writer(file)
+                    writer.writerow(['IDX', 'DATINS', 'VALUE'])
+                    for idx in range(100):
+                        for row in range(num_rows):
+                            writer.writerow(['%d.0' % idx, '2015-01-0%d' % (row + 1), ''])
+
+    def _read_sample(self, filename):
+        with open(path.join(self.folder, 'sample', filename)) as sample_file:
+            return sample_file.read()
+
+    def test_sample_fhs(self):
+        """All the rows of the sampled job seekers are written."""
+        num_rows = sampling.sample_fhs(
+            self.fhs_folder, path.join(self.folder, 'sample'), sampling=10, seed=3, processes=1)
+
+        sample = pandas.read_csv(path.join(self.folder, 'sample', 'Reg01', 'de_1.csv'))
+        e0_sample = pandas.read_csv(path.join(self.folder, 'sample', 'Reg02', 'e0_1.csv'))
+        self.assertEqual(['IDX', 'DATINS', 'VALUE'], list(sample.columns))
+        self.assertEqual([3], sample.groupby('IDX').size().unique().tolist())
+        self.assertEqual(
+            sorted(set(sample.IDX)), sorted(set(e0_sample.IDX)))
+        self.assertEqual(
+            sampling.is_job_seeker_sampled(range(100), 10, 3).sum(), sample.IDX.nunique())
+        self.assertEqual(2 * 5 * sample.IDX.nunique(), num_rows)
+
+    def test_sample_fhs_cache(self):
+        """The sample is the same when reading the columnar cache."""
+        sampling.sample_fhs(
+            self.fhs_folder, path.join(self.folder, 'sample'), sampling=10, processes=1)
+        without_cache = self._read_sample('Reg02/de_1.csv')
+        fhs_to_parquet.convert_files([path.join(self.fhs_folder, 'Reg02', 'de_1.csv')])
+
+        sampling.sample_fhs(
+            self.fhs_folder, path.join(self.folder, 'sample'), sampling=10, processes=1)
+        with_cache = self._read_sample('Reg02/de_1.csv')
+        # The cache stores the indices as integers.
+        self.assertEqual(without_cache.replace('.0,', ','), with_cache)
+
+    def test_sample_data_frame(self):
+        """Sampled rows are loaded with the file they come from."""
+        data_frame = migration_helpers.sample_data_frame(
+            path.join(self.fhs_folder, '*', 'de_*.csv'), sampling=10, seed=3)
+
+        self.assertEqual(['IDX', 'DATINS', 'VALUE', '__file__'], list(data_frame.columns))
+        self.assertEqual(
+            2 * 3 * sampling.is_job_seeker_sampled(range(100), 10, 3).sum(), len(data_frame))
+        self.assertEqual('', data_frame.VALUE.iloc[0])
+
+    def test_sample_data_frame_limit(self):
+        """Only the first rows are loaded with a limit."""
+        data_frame = migration_helpers.sample_data_frame(
+            path.join(self.fhs_folder, '*', 'de_*.csv'), limit=4)
+
+        self.assertEqual(['0.0', '0.0', '0.0', '1.0'], data_frame.IDX.tolist())
+
+    def test_sample_data_frame_headers_mismatch(self):
+        """Files with different headers cannot be loaded together."""
+        with open(path.join(self.fhs_folder, 'Reg02', 'de_1.csv'), 'w') as de_file:
+            de_file.write('IDX,DATANN\n1.0,2015-01-01\n')
+
+        with self.assertRaisesRegex(ValueError, "Headers from file .* don't match"):
+            migration_helpers.sample_data_frame(path.join(self.fhs_folder, '*', 'de_*.csv'))
+
+    @mock.patch(migration_helpers.__name__ + '.SAS7BDAT')
+    def test_sample_data_frame_sas(self, mock_sas7bdat):
+        """SAS files are sampled as well."""
+        sas_filename = path.join(self.fhs_folder, 'Reg01', 'de_1.sas7bdat')
+        with open(sas_filename, 'w'):
+            pass
+        mock_sas7bdat().readlines.side_effect = lambda: iter(
+            [['IDX', 'DATINS']] + [[float(idx), '2015-01-01'] for idx in range(100)])
+
+        data_frame = migration_helpers.sample_data_frame(
+            path.join(self.fhs_folder, '*', 'de_*.sas7bdat'), sampling=10, seed=3)
+
+        self.assertEqual(['IDX', 'DATINS', '__file__'], list(data_frame.columns))
+        self.assertEqual(
+            sampling.is_job_seeker_sampled(range(100), 10, 3).sum(), len(data_frame))
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
@@ -4,7 +4,10 @@ aws ecs run-task \
   --overrides '{
     "containerOverrides": [{
       "name": "flask",
-      "command": ["python", "bob_emploi/frontend/asynchronous/mail_advice.py"],
+      "command": [
+        "sh", "-c",
+        "python bob_emploi/frontend/asynchronous/sync_email_stats.py && python bob_emploi/frontend/asynchronous/mail_advice.py"
+      ],
       "environment": [{
         "name": "NODRY_RUN",
         "value": "1"
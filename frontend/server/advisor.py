@@ -3,8 +3,11 @@
 See http://go/bob:advisor-design.
 """
 import collections
+from concurrent import futures
 import datetime
 import logging
+import math
+import os
 import random
 
 from bson import objectid
@@ -20,6 +23,15 @@ from bob_emploi.frontend.api import user_pb2
 
 _ScoredAdvice = collections.namedtuple('ScoredAdvice', ['advice', 'score'])
 
+# Number of threads used to compute the extra data of the advice modules
+# concurrently: some of them (e.g. LBB companies) call external services, so
+# the request waits for the slowest of them instead of their sum. Set it to 0
+# to compute them sequentially in the request thread.
+_EXTRA_DATA_MAX_WORKERS = int(os.getenv('ADVISOR_EXTRA_DATA_MAX_WORKERS', '4'))
+
+_EXTRA_DATA_EXECUTOR = futures.ThreadPoolExecutor(max_workers=_EXTRA_DATA_MAX_WORKERS) \
+    if _EXTRA_DATA_MAX_WORKERS > 0 else None
+
 
 def maybe_advise(user, project, database):
     """Check if a project needs advice and populate all advice fields if not.
@@ -39,24 +51,15 @@ def _maybe_recommend_advice(user, project, database):
 
     scoring_project = scoring.ScoringProject(
         project, user.profile, user.features_enabled, database)
-    scores = {}
     advice_modules = _advice_modules(database)
-    for module in advice_modules:
-        if not module.is_ready_for_prod and not user.features_enabled.alpha:
-            continue
-        scoring_model = scoring.get_scoring_model(module.trigger_scoring_model)
-        if scoring_model is None:
-            logging.warning(
-                'Not able to score advice "%s", the scoring model "%s" is unknown.',
-                module.advice_id, module.trigger_scoring_model)
-            continue
-        scores[module.advice_id] = scoring_model.score(scoring_project).score
+    scores = _compute_scores(advice_modules, user, scoring_project)
 
     modules = sorted(
         advice_modules,
         key=lambda m: (scores.get(m.advice_id, 0), m.advice_id),
         reverse=True)
     incompatible_modules = set()
+    modules_with_extra_data = []
     for module in modules:
         if not scores.get(module.advice_id):
             # We can break as others will have 0 score as well.
@@ -70,22 +73,172 @@ def _maybe_recommend_advice(user, project, database):
 
         incompatible_modules.update(module.incompatible_advice_ids)
 
-        _compute_extra_data(piece_of_advice, module, scoring_project)
+        if module.extra_data_field_name:
+            modules_with_extra_data.append((piece_of_advice, module))
+
+    _populate_extra_data(modules_with_extra_data, scoring_project)
 
     return True
 
 
-def _compute_extra_data(piece_of_advice, module, scoring_project):
-    if not module.extra_data_field_name:
+def _compute_scores(advice_modules, user, scoring_project):
+    """Score advice modules for a project.
+
+    Returns:
+        a dict of scores keyed by advice IDs. Modules that are not available for
+        this user or that cannot be scored are missing.
+    """
+    scores = {}
+    for module in advice_modules:
+        if not module.is_ready_for_prod and not user.features_enabled.alpha:
+            continue
+        scoring_model = scoring.get_scoring_model(module.trigger_scoring_model)
+        if scoring_model is None:
+            logging.warning(
+                'Not able to score advice "%s", the scoring model "%s" is unknown.',
+                module.advice_id, module.trigger_scoring_model)
+            continue
+        scores[module.advice_id] = scoring_model.score(scoring_project).score
+    return scores
+
+
+# A change in the recommendation of an advice module for a project. The number
+# of stars are 0 when the advice is not recommended.
+AdviceChange = collections.namedtuple('AdviceChange', ['advice_id', 'before', 'after'])
+
+
+def update_advice(user, project, database, advice_ids):
+    """Rescore some advice modules for a project that was already advised.
+
+    The pieces of advice for other modules are kept untouched. A piece of
+    advice that the user has already seen is never removed, only its number of
+    stars is updated. The extra data are only computed for the pieces of
+    advice that are added or whose number of stars changed.
+
+    Args:
+        user: the full user info.
+        project: the project to update. This proto will be modified.
+        database: access to the database to get modules.
+        advice_ids: a set of IDs of advice modules to rescore. IDs of modules
+            that do not exist anymore are scored 0: their pieces of advice are
+            removed unless the user has already seen them.
+    Returns:
+        a list of AdviceChange, one for each advice module whose
+        recommendation has changed.
+    """
+    if project.is_incomplete or user.features_enabled.advisor != user_pb2.ACTIVE or \
+            not project.advices:
+        return []
+
+    all_modules = {m.advice_id: m for m in _advice_modules(database)}
+    modules = [m for m in all_modules.values() if m.advice_id in advice_ids]
+    removed_advice_ids = {
+        a.advice_id for a in project.advices
+        if a.advice_id in advice_ids and a.advice_id not in all_modules}
+    if not modules and not removed_advice_ids:
+        return []
+
+    scoring_project = scoring.ScoringProject(
+        project, user.profile, user.features_enabled, database)
+    scores = _compute_scores(modules, user, scoring_project)
+    scores.update((advice_id, 0) for advice_id in removed_advice_ids)
+
+    changes = []
+    modules_with_extra_data = []
+    kept_advices = []
+    for piece_of_advice in project.advices:
+        advice_id = piece_of_advice.advice_id
+        if advice_id not in scores:
+            kept_advices.append(piece_of_advice)
+            continue
+        new_stars = scores.pop(advice_id)
+        if not new_stars and piece_of_advice.status == project_pb2.ADVICE_RECOMMENDED:
+            changes.append(AdviceChange(advice_id, piece_of_advice.num_stars, 0))
+            continue
+        kept_advices.append(piece_of_advice)
+        # num_stars is stored as a 32-bit float.
+        if not new_stars or math.isclose(new_stars, piece_of_advice.num_stars, rel_tol=1e-6):
+            continue
+        changes.append(AdviceChange(advice_id, piece_of_advice.num_stars, new_stars))
+        piece_of_advice.num_stars = new_stars
+        if all_modules[advice_id].extra_data_field_name:
+            modules_with_extra_data.append((piece_of_advice, all_modules[advice_id]))
+
+    # Modules that were not recommended before.
+    incompatible_modules = set()
+    for piece_of_advice in kept_advices:
+        module = all_modules.get(piece_of_advice.advice_id)
+        if module:
+            incompatible_modules.update(module.incompatible_advice_ids)
+    for advice_id, new_stars in sorted(scores.items(), key=lambda s: (s[1], s[0]), reverse=True):
+        if not new_stars:
+            continue
+        module = all_modules[advice_id]
+        if module.airtable_id in incompatible_modules:
+            continue
+        piece_of_advice = project_pb2.Advice(
+            advice_id=advice_id, status=project_pb2.ADVICE_RECOMMENDED, num_stars=new_stars)
+        kept_advices.append(piece_of_advice)
+        changes.append(AdviceChange(advice_id, 0, new_stars))
+        incompatible_modules.update(module.incompatible_advice_ids)
+        if module.extra_data_field_name:
+            modules_with_extra_data.append((piece_of_advice, module))
+
+    if not changes:
+        return []
+
+    # Keep the same order as when first recommending advice.
+    kept_advices = sorted(kept_advices, key=lambda a: (a.num_stars, a.advice_id), reverse=True)
+    del project.advices[:]
+    project.advices.extend(kept_advices)
+    # The protos were copied when extending the list, populate the new ones.
+    advices_by_id = {a.advice_id: a for a in project.advices}
+    _populate_extra_data(
+        [(advices_by_id[a.advice_id], m) for a, m in modules_with_extra_data],
+        scoring_project)
+
+    return changes
+
+
+def _populate_extra_data(advice_and_modules, scoring_project):
+    """Compute and set the extra data for pieces of advice.
+
+    If an executor is available the extra data are computed concurrently.
+    All of them are waited for: pieces of advice are only advised once, so
+    they would never get their extra data later.
+
+    Args:
+        advice_and_modules: a list of tuples with a piece of advice to
+            populate and its advice module.
+        scoring_project: the ScoringProject to compute the extra data for.
+    """
+    if not _EXTRA_DATA_EXECUTOR:
+        for piece_of_advice, module in advice_and_modules:
+            _set_extra_data(piece_of_advice, module, _compute_extra_data(module, scoring_project))
         return
+
+    computations = [
+        (piece_of_advice, module, _EXTRA_DATA_EXECUTOR.submit(
+            _compute_extra_data, module, scoring_project))
+        for piece_of_advice, module in advice_and_modules]
+    for piece_of_advice, module, computation in computations:
+        _set_extra_data(piece_of_advice, module, computation.result())
+
+
+def _compute_extra_data(module, scoring_project):
+    if not module.extra_data_field_name:
+        return None
     scoring_model = scoring.get_scoring_model(module.trigger_scoring_model)
     try:
         compute_extra_data = scoring_model.compute_extra_data
     except AttributeError:
         logging.warning(
             'The scoring model %s has no compute_extra_data method', module.trigger_scoring_model)
-        return
-    extra_data = compute_extra_data(scoring_project)
+        return None
+    return compute_extra_data(scoring_project)
+
+
+def _set_extra_data(piece_of_advice, module, extra_data):
     if not extra_data:
         return
     try:
@@ -144,8 +297,40 @@ def list_all_tips(user, project, piece_of_advice, database, cache=None, filter_t
     return filtered_tips
 
 
-def select_advice_for_email(user, weekday, database):
-    """Select an advice to promote in a follow-up email."""
+def get_email_histories(user_ids, database):
+    """Fetch the history of emails sent to many users at once.
+
+    Args:
+        user_ids: the IDs of the users as stored in MongoDB.
+        database: the database containing the email_history collection.
+    Returns:
+        a dict of EmailHistory protos keyed by user IDs. Users that never
+        received any email get an empty history.
+    """
+    histories = {user_id: advisor_pb2.EmailHistory() for user_id in user_ids}
+    if not histories:
+        return histories
+    for history_dict in database.email_history.find({'_id': {'$in': list(histories)}}):
+        user_id = history_dict['_id']
+        proto.parse_from_mongo(history_dict, histories[user_id])
+    return histories
+
+
+def _get_email_history(user, database):
+    user_id = objectid.ObjectId(user.user_id)
+    return get_email_histories([user_id], database)[user_id]
+
+
+def select_advice_for_email(user, weekday, database, email_history=None):
+    """Select an advice to promote in a follow-up email.
+
+    Args:
+        user: the User proto.
+        weekday: the day the email is sent, as a user_pb2.WeekDay value.
+        database: the database containing the advice modules.
+        email_history: the EmailHistory of the user, see get_email_histories.
+            If not given, it is fetched from the database.
+    """
     if not user.projects:
         return None
 
@@ -154,9 +339,9 @@ def select_advice_for_email(user, weekday, database):
         return None
 
     easy_advice_modules = _easy_advice_modules(database)
-    history = advisor_pb2.EmailHistory()
-    history_dict = database.email_history.find_one({'_id': objectid.ObjectId(user.user_id)})
-    proto.parse_from_mongo(history_dict, history)
+    history = email_history
+    if history is None:
+        history = _get_email_history(user, database)
 
     today = now.get()
     last_monday = today - datetime.timedelta(days=today.weekday())
@@ -198,15 +383,25 @@ def select_advice_for_email(user, weekday, database):
     return next(advice for priority, advice in candidates)
 
 
-def select_tips_for_email(user, project, piece_of_advice, database, num_tips=3):
-    """Select tips to promote an advice in a follow-up email."""
+def select_tips_for_email(
+        user, project, piece_of_advice, database, num_tips=3, email_history=None):
+    """Select tips to promote an advice in a follow-up email.
+
+    Args:
+        user: the User proto.
+        project: the project the advice is about.
+        piece_of_advice: the advice to promote.
+        database: the database containing the tip templates.
+        num_tips: the number of tips to select.
+        email_history: the EmailHistory of the user, see get_email_histories.
+            If not given, it is fetched from the database.
+    """
     all_templates = list_all_tips(
         user, project, piece_of_advice, database, filter_tip=lambda t: t.is_ready_for_email)
 
-    # TODO(pascal): Factorize with above.
-    history = advisor_pb2.EmailHistory()
-    history_dict = database.email_history.find_one({'_id': objectid.ObjectId(user.user_id)})
-    proto.parse_from_mongo(history_dict, history)
+    history = email_history
+    if history is None:
+        history = _get_email_history(user, database)
 
     today = now.get()
 
@@ -243,6 +438,7 @@ def select_tips_for_email(user, project, piece_of_advice, database, num_tips=3):
 
 # Cache (from MongoDB) of known advice module.
 _ADVICE_MODULES = []
+_ADVICE_MODULES_BY_ID = {}
 _EASY_ADVICE_MODULES = set()
 
 
@@ -253,10 +449,10 @@ def _advice_modules(database):
 
 def get_advice_module(advice_id, database):
     """Get a module by its ID."""
-    try:
-        return next(a for a in _advice_modules(database) if a.advice_id == advice_id)
-    except StopIteration:
-        return None
+    if not _ADVICE_MODULES_BY_ID:
+        for module in _advice_modules(database):
+            _ADVICE_MODULES_BY_ID.setdefault(module.advice_id, module)
+    return _ADVICE_MODULES_BY_ID.get(advice_id)
 
 
 def _easy_advice_modules(database):
@@ -281,5 +477,17 @@ def _tip_templates(database):
 def clear_cache():
     """Clear all caches for this module."""
     del _ADVICE_MODULES[:]
+    _ADVICE_MODULES_BY_ID.clear()
     _EASY_ADVICE_MODULES.clear()
     _TIP_TEMPLATES.clear()
+
+
+def warm_up_cache(database):
+    """Populate all caches for this module.
+
+    Useful before using the module from several threads, as the caches are not
+    protected against concurrent population.
+    """
+    _easy_advice_modules(database)
+    get_advice_module('', database)
+    _tip_templates(database)
@@ -1,5 +1,6 @@
 """Unit tests for the bob_emploi.frontend.advisor module."""
 import datetime
+import threading
 import unittest
 
 import mock
@@ -9,6 +10,7 @@ from bob_emploi.frontend import action
 from bob_emploi.frontend import advisor
 from bob_emploi.frontend import companies
 from bob_emploi.frontend import now
+from bob_emploi.frontend import scoring
 from bob_emploi.frontend.api import advisor_pb2
 from bob_emploi.frontend.api import geo_pb2
 from bob_emploi.frontend.api import job_pb2
@@ -293,6 +295,70 @@ class MaybeAdviseTestCase(unittest.TestCase):
         self.assertEqual('Pompier', advice.better_job_in_group_data.better_job.name)
         self.assertEqual(1, advice.better_job_in_group_data.num_better_jobs)
 
+    def test_extra_data_concurrent(self):
+        """Test that the advisor computes extra data concurrently and waits for all of them."""
+        project = project_pb2.Project()
+        # Each model only returns once the other one has started.
+        both_started = threading.Barrier(2, timeout=5)
+
+        def _slow_extra_data(title):
+            both_started.wait()
+            return project_pb2.JobBoardsData(job_board_title=title)
+
+        models = {}
+        for name, stars in (('first-model', 3), ('second-model', 2)):
+            model = mock.MagicMock()
+            model.score.return_value = scoring.ConstantScoreModel(stars).score(None)
+            model.compute_extra_data.side_effect = \
+                lambda unused_project, title=name: _slow_extra_data(title)
+            models[name] = model
+        self.database.advice_modules.insert_many([
+            {
+                'adviceId': 'first-advice',
+                'triggerScoringModel': 'first-model',
+                'extraDataFieldName': 'job_boards_data',
+                'isReadyForProd': True,
+            },
+            {
+                'adviceId': 'second-advice',
+                'triggerScoringModel': 'second-model',
+                'extraDataFieldName': 'job_boards_data',
+                'isReadyForProd': True,
+            },
+        ])
+
+        with mock.patch.dict(scoring.SCORING_MODELS, models):
+            advisor.maybe_advise(self.user, project, self.database)
+
+        self.assertEqual(
+            ['first-model', 'second-model'],
+            [a.job_boards_data.job_board_title for a in project.advices])
+
+    @mock.patch(advisor.__name__ + '._EXTRA_DATA_EXECUTOR', None)
+    def test_extra_data_sequential(self):
+        """Test that the advisor computes extra data without any thread pool."""
+        project = project_pb2.Project()
+        self.database.jobboards.insert_one({'title': 'Indeed'})
+        self.database.advice_modules.insert_many([
+            {
+                'adviceId': 'job-boards',
+                'triggerScoringModel': 'advice-job-boards',
+                'extraDataFieldName': 'job_boards_data',
+                'isReadyForProd': True,
+            },
+            {
+                'adviceId': 'other-job-boards',
+                'triggerScoringModel': 'advice-job-boards',
+                'extraDataFieldName': 'job_boards_data',
+                'isReadyForProd': True,
+            },
+        ])
+
+        advisor.maybe_advise(self.user, project, self.database)
+
+        self.assertEqual(
+            ['Indeed', 'Indeed'], [a.job_boards_data.job_board_title for a in project.advices])
+
 
 class SelectAdviceForEmailTestCase(unittest.TestCase):
     """Unit tests for the select_advice_for_email function."""
@@ -458,6 +524,71 @@ class SelectAdviceForEmailTestCase(unittest.TestCase):
 
         self.assertEqual(3, len(advice_given), msg=advice_given)
 
+    @mock.patch(now.__name__ + '.get')
+    def test_given_email_history(self, mock_now):
+        """Use the email history given instead of reading it from the database."""
+        user = user_pb2.User(
+            user_id=str(mongomock.ObjectId()),
+            features_enabled=user_pb2.Features(advisor=user_pb2.ACTIVE),
+            projects=[project_pb2.Project(advices=[
+                project_pb2.Advice(advice_id='sent-advice', num_stars=3, score=9),
+                project_pb2.Advice(advice_id='other-advice', num_stars=1, score=2),
+            ])],
+        )
+        mock_now.return_value = datetime.datetime(2017, 4, 5, 13, 00)
+        history = advisor_pb2.EmailHistory()
+        history.advice_modules['sent-advice'].FromDatetime(
+            datetime.datetime(2017, 4, 3, 13, 00))
+        database = mock.MagicMock(wraps=self.database)
+
+        advice = advisor.select_advice_for_email(
+            user, user_pb2.WEDNESDAY, database, email_history=history)
+
+        self.assertEqual('other-advice', advice.advice_id)
+        self.assertFalse(database.email_history.find.called)
+        self.assertFalse(database.email_history.find_one.called)
+
+
+class GetEmailHistoriesTestCase(unittest.TestCase):
+    """Unit tests for the get_email_histories function."""
+
+    def test_batch(self):
+        """Fetch the histories of several users at once."""
+        database = mongomock.MongoClient().test
+        user_ids = [mongomock.ObjectId() for unused_i in range(3)]
+        database.email_history.insert_many([
+            {'_id': user_ids[0], 'advice_modules': {'advice-a': '2017-04-03T13:00:00Z'}},
+            {'_id': user_ids[2], 'tips': {'tip-b': '2017-04-05T13:00:00Z'}},
+            {'_id': mongomock.ObjectId(), 'tips': {'tip-c': '2017-04-05T13:00:00Z'}},
+        ])
+
+        histories = advisor.get_email_histories(user_ids, database)
+
+        self.assertEqual(set(user_ids), set(histories))
+        self.assertEqual(['advice-a'], list(histories[user_ids[0]].advice_modules))
+        self.assertEqual(advisor_pb2.EmailHistory(), histories[user_ids[1]])
+        self.assertEqual(['tip-b'], list(histories[user_ids[2]].tips))
+
+
+class GetAdviceModuleTestCase(unittest.TestCase):
+    """Unit tests for the get_advice_module function."""
+
+    def setUp(self):
+        super(GetAdviceModuleTestCase, self).setUp()
+        advisor.clear_cache()
+
+    def test_get(self):
+        """Get advice modules by ID."""
+        database = mongomock.MongoClient().test
+        database.advice_modules.insert_many([
+            {'adviceId': 'advice-a', 'title': 'A'},
+            {'adviceId': 'advice-b', 'title': 'B'},
+        ])
+
+        self.assertEqual('B', advisor.get_advice_module('advice-b', database).title)
+        self.assertEqual('A', advisor.get_advice_module('advice-a', database).title)
+        self.assertIsNone(advisor.get_advice_module('unknown', database))
+
 
 class SelectTipsForEmailTestCase(unittest.TestCase):
     """Unit tests for the select_tips_for_email function."""
@@ -0,0 +1,276 @@
+# encoding: utf-8
+"""Helpers shared by the scripts sending email blasts to our users.
+
+A blast can be split in shards that run in separate processes, e.g. in
+separate containers:
+
+docker-compose run --rm \
+    -e MONGO_URL ... \
+    frontend-flask python bob_emploi/frontend/asynchronous/mail_advice.py \
+    --run_id advice-2017-03-06 --num_shards 4 --shard 0
+
+Each shard records its progress in the blast_runs collection: if it is
+stopped, running it again with the same run ID resumes from its last
+checkpoint. The report of the blast is sent by the last shard to finish.
+"""
+import datetime
+import logging
+import signal
+import threading
+
+import pymongo
+from pymongo import errors
+
+
+class BulkWriter(object):
+    """Buffer the updates of a blast and write them to MongoDB in bulks.
+
+    Updates are sent as unordered bulk writes of batch_size operations: call
+    flush to write the last ones. It can be shared by several threads.
+    """
+
+    def __init__(self, collection, batch_size=500, dry_run=False):
+        """Create a writer for a collection.
+
+        Args:
+            collection: the MongoDB collection to update.
+            batch_size: the number of operations to buffer before writing them.
+            dry_run: if True, operations are dropped instead of being written.
+        """
+        self._collection = collection
+        self._batch_size = batch_size
+        self._dry_run = dry_run
+        self._operations = []
+        self._lock = threading.Lock()
+
+    def update_one(self, query, update):
+        """Buffer an update of a single document, see Collection.update_one."""
+        with self._lock:
+            self._operations.append(pymongo.UpdateOne(query, update))
+            if len(self._operations) < self._batch_size:
+                return
+            operations = self._operations
+            self._operations = []
+        self._write(operations)
+
+    def flush(self):
+        """Write all the buffered operations."""
+        with self._lock:
+            operations = self._operations
+            self._operations = []
+        self._write(operations)
+
+    def _write(self, operations):
+        if not operations or self._dry_run:
+            return
+        try:
+            self._collection.bulk_write(operations, ordered=False)
+        except errors.BulkWriteError as error:
+            logging.error(
+                '%d errors while writing %d updates: %s',
+                len(error.details.get('writeErrors', [])), len(operations),
+                error.details.get('writeErrors', [])[:5])
+
+
+def break_on_signal(signums, iterator, caught_signals=None):
+    """Wrapper for an iterator to stop iterating when kernal signal is received.
+
+    Args:
+        signums: a list of signal numbers to break on.
+        iterator: the iterator to wrap.
+        caught_signals: an optional list to populate with the signals caught.
+    Yields:
+        the item of the iterator as long as no signal has been caught.
+    """
+    signals = [] if caught_signals is None else caught_signals
+
+    def _record_signal(signum, unused_frame):
+        signals.append(signum)
+
+    for signum in signums:
+        signal.signal(signum, _record_signal)
+    for item in iterator:
+        yield item
+        if signals:
+            break
+
+
+def add_run_arguments(parser):
+    """Add the command line arguments to run a shard of a blast."""
+    parser.add_argument(
+        '--run_id', help='ID of the blast, to resume it or run it in several shards.')
+    parser.add_argument(
+        '--num_shards', type=int, default=1, help='Number of shards of the blast.')
+    parser.add_argument(
+        '--shard', type=int, default=0, help='Index of the shard to run, from 0.')
+
+
+class BlastRun(object):
+    """A shard of a blast, recording its progress in the blast_runs collection.
+
+    Without a run ID, the blast is not split and its progress is not recorded.
+
+    The users are split in shards of contiguous _id ranges: their boundaries
+    are computed once by the first shard to start and stored with the run so
+    that all shards use the same ones even if users change in between.
+    """
+
+    def __init__(self, runs_collection=None, run_id=None, num_shards=1, shard=0):
+        """Create a run.
+
+        Args:
+            runs_collection: the blast_runs collection.
+            run_id: the ID of the blast, shared by all its shards.
+            num_shards: the number of shards of the blast.
+            shard: the index of the shard handled by this process.
+        """
+        if run_id and runs_collection is None:
+            raise ValueError('A collection is needed to record the run "%s".' % run_id)
+        if not 0 <= shard < num_shards:
+            raise ValueError('Shard %d does not exist in %d shards.' % (shard, num_shards))
+        if num_shards > 1 and not run_id:
+            raise ValueError('A run ID is needed to split a blast in shards.')
+        self._runs = runs_collection
+        self._run_id = run_id
+        self._num_shards = num_shards
+        self._shard = shard
+        self._field = 'shards.%d' % shard
+        self._lower_bound = None
+        self._upper_bound = None
+        self._last_id = None
+        self._previous_count = 0
+        self._previous_errors = []
+        self.is_done = False
+        self.interrupted = False
+
+    def start(self, users_collection, query):
+        """Start or resume the shard.
+
+        Args:
+            users_collection: the collection of users to send the blast to.
+            query: the query to select the users of the whole blast.
+        Returns:
+            the query to select the remaining users of this shard.
+        """
+        if not self._run_id:
+            return query
+        run = self._runs.find_one({'_id': self._run_id})
+        if not run:
+            run = self._create(users_collection, query)
+        if run.get('numShards') != self._num_shards:
+            raise ValueError('The run "%s" was started with %d shards.' % (
+                self._run_id, run.get('numShards')))
+        boundaries = run.get('boundaries', [])
+        if self._shard:
+            self._lower_bound = boundaries[self._shard - 1]
+        if self._shard < self._num_shards - 1:
+            self._upper_bound = boundaries[self._shard]
+
+        progress = run.get('shards', {}).get(str(self._shard), {})
+        self.is_done = progress.get('done', False)
+        self._last_id = progress.get('lastId')
+        self._previous_count = progress.get('count', 0)
+        self._previous_errors = progress.get('errors', [])
+        if self._last_id is not None:
+            logging.info(
+                'Resuming shard %d of "%s" after %s.', self._shard, self._run_id, self._last_id)
+
+        id_range = {}
+        if self._last_id is not None:
+            id_range['$gt'] = self._last_id
+        elif self._lower_bound is not None:
+            id_range['$gte'] = self._lower_bound
+        if self._upper_bound is not None:
+            id_range['$lt'] = self._upper_bound
+        if not id_range:
+            return query
+        return {'$and': [query, {'_id': id_range}]}
+
+    def _create(self, users_collection, query):
+        num_users = users_collection.count(query)
+        boundaries = []
+        for shard in range(1, self._num_shards):
+            # Boundary between shards: the first user of the shard.
+            first_users = list(users_collection.find(
+                query, {'_id': 1}, sort=[('_id', pymongo.ASCENDING)],
+                skip=shard * num_users // self._num_shards, limit=1))
+            if first_users:
+                boundaries.append(first_users[0]['_id'])
+            else:
+                # No users at all: all shards are empty.
+                boundaries.append('')
+        run = {
+            '_id': self._run_id,
+            'boundaries': boundaries,
+            'createdAt': datetime.datetime.utcnow(),
+            'numShards': self._num_shards,
+        }
+        try:
+            self._runs.insert_one(run)
+        except errors.DuplicateKeyError:
+            # Another shard created the run at the same time.
+            return self._runs.find_one({'_id': self._run_id})
+        return run
+
+    def checkpoint(self, last_id, count, error_messages):
+        """Record the progress of the shard.
+
+        Only call it once the results of all the users up to last_id have
+        been written in the database.
+
+        Args:
+            last_id: the _id of the last user processed: users are processed
+                in the order of their _id.
+            count: the number of emails sent by this process.
+            error_messages: the errors that occurred in this process.
+        """
+        if last_id is not None:
+            self._last_id = last_id
+        if not self._run_id:
+            return
+        self._runs.update_one({'_id': self._run_id}, {'$set': {
+            self._field + '.count': self._previous_count + count,
+            self._field + '.errors': self._previous_errors + list(error_messages),
+            self._field + '.lastId': self._last_id,
+            self._field + '.updatedAt': datetime.datetime.utcnow(),
+        }})
+
+    def finish(self, count, error_messages):
+        """Record the end of the shard.
+
+        Args:
+            count: the number of emails sent by this process.
+            error_messages: the errors that occurred in this process.
+        Returns:
+            a tuple with the number of emails sent and the errors of the
+            whole blast if the report should be sent by this process, None
+            otherwise.
+        """
+        if not self._run_id:
+            return count, error_messages
+        self.checkpoint(None, count, error_messages)
+        if self.interrupted:
+            return None
+        run = self._runs.find_one_and_update(
+            {'_id': self._run_id},
+            {'$set': {self._field + '.done': True}},
+            return_document=pymongo.ReturnDocument.AFTER)
+        shards = run.get('shards', {})
+        if not all(shards.get(str(i), {}).get('done') for i in range(self._num_shards)):
+            return None
+        # All the shards are done: make sure only one of them sends the report.
+        if not self._runs.find_one_and_update(
+                {'_id': self._run_id, 'reportSent': {'$ne': True}},
+                {'$set': {'reportSent': True}}):
+            return None
+        return (
+            sum(shard.get('count', 0) for shard in shards.values()),
+            [error for shard in shards.values() for error in shard.get('errors', [])])
+
+    def iterate(self, iterator):
+        """Iterate over users, stopping on SIGTERM."""
+        caught_signals = []
+        for item in break_on_signal([signal.SIGTERM], iterator, caught_signals):
+            yield item
+        if caught_signals:
+            self.interrupted = True
@@ -0,0 +1,151 @@
+# encoding: utf-8
+"""Tests for the bob_emploi.frontend.asynchronous.blast module."""
+import unittest
+
+import mock
+import mongomock
+from pymongo import errors
+
+from bob_emploi.frontend.asynchronous import blast
+
+
+class BulkWriterTestCase(unittest.TestCase):
+    """Unit tests for the BulkWriter class."""
+
+    def setUp(self):
+        super(BulkWriterTestCase, self).setUp()
+        self._db = mongomock.MongoClient().database
+        self._db.user.insert_many([{'_id': i, 'name': 'User %d' % i} for i in range(5)])
+
+    def test_batches(self):
+        """Updates are written by batches."""
+        collection = mock.MagicMock(wraps=self._db.user)
+        writer = blast.BulkWriter(collection, batch_size=2)
+        for i in range(5):
+            writer.update_one({'_id': i}, {'$set': {'sent': True}})
+
+        self.assertEqual(2, collection.bulk_write.call_count)
+        self.assertEqual(4, self._db.user.count({'sent': True}))
+
+        writer.flush()
+
+        self.assertEqual(3, collection.bulk_write.call_count)
+        self.assertEqual(5, self._db.user.count({'sent': True}))
+
+    def test_flush_empty(self):
+        """Flushing without any updates does not call the database."""
+        collection = mock.MagicMock()
+        blast.BulkWriter(collection).flush()
+
+        self.assertFalse(collection.bulk_write.called)
+
+    def test_dry_run(self):
+        """Nothing is written during a dry run."""
+        writer = blast.BulkWriter(self._db.user, batch_size=2, dry_run=True)
+        for i in range(5):
+            writer.update_one({'_id': i}, {'$set': {'sent': True}})
+        writer.flush()
+
+        self.assertEqual(0, self._db.user.count({'sent': True}))
+
+    def test_write_errors(self):
+        """Errors while writing are logged, not raised."""
+        collection = mock.MagicMock()
+        collection.bulk_write.side_effect = errors.BulkWriteError(
+            {'writeErrors': [{'index': 0, 'errmsg': 'Oops'}]})
+        writer = blast.BulkWriter(collection)
+        writer.update_one({'_id': 0}, {'$set': {'sent': True}})
+
+        with mock.patch(blast.__name__ + '.logging') as mock_logging:
+            writer.flush()
+
+        self.assertTrue(mock_logging.error.called)
+
+
+class BlastRunTestCase(unittest.TestCase):
+    """Unit tests for the BlastRun class."""
+
+    def setUp(self):
+        super(BlastRunTestCase, self).setUp()
+        self._db = mongomock.MongoClient().database
+        self._db.user.insert_many([{'_id': i, 'ready': i % 5 > 0} for i in range(20)])
+        self._query = {'ready': True}
+
+    def _user_ids(self, query):
+        return [u['_id'] for u in self._db.user.find(query, sort=[('_id', 1)])]
+
+    def test_no_run_id(self):
+        """Without a run ID, the blast is not recorded."""
+        run = blast.BlastRun()
+        self.assertEqual(self._query, run.start(self._db.user, self._query))
+        run.checkpoint(3, 2, ['error'])
+        self.assertEqual((2, ['error']), run.finish(2, ['error']))
+
+    def test_shards(self):
+        """Shards split the users in parts of the same size."""
+        shard_ids = []
+        for shard in range(3):
+            run = blast.BlastRun(self._db.blast_runs, 'run', 3, shard)
+            shard_ids.append(self._user_ids(run.start(self._db.user, self._query)))
+
+        self.assertEqual([5, 5, 6], [len(ids) for ids in shard_ids])
+        self.assertEqual(
+            self._user_ids(self._query), shard_ids[0] + shard_ids[1] + shard_ids[2])
+
+    def test_wrong_number_of_shards(self):
+        """All the shards of a run must agree on the number of shards."""
+        blast.BlastRun(self._db.blast_runs, 'run', 3, 0).start(self._db.user, self._query)
+
+        with self.assertRaises(ValueError):
+            blast.BlastRun(self._db.blast_runs, 'run', 2, 0).start(self._db.user, self._query)
+
+    def test_resume(self):
+        """Resume a shard after its last checkpoint."""
+        run = blast.BlastRun(self._db.blast_runs, 'run', 2, 1)
+        query = run.start(self._db.user, self._query)
+        self.assertEqual([11, 12, 13, 14, 16, 17, 18, 19], self._user_ids(query))
+        run.checkpoint(13, 3, ['error 1'])
+        run.interrupted = True
+        self.assertIsNone(run.finish(3, ['error 1']))
+
+        run = blast.BlastRun(self._db.blast_runs, 'run', 2, 1)
+        query = run.start(self._db.user, self._query)
+        self.assertEqual([14, 16, 17, 18, 19], self._user_ids(query))
+        self.assertFalse(run.is_done)
+
+    def test_report_once_all_shards_are_done(self):
+        """The last shard to finish gets the report of the whole blast."""
+        first_run = blast.BlastRun(self._db.blast_runs, 'run', 2, 0)
+        first_run.start(self._db.user, self._query)
+        second_run = blast.BlastRun(self._db.blast_runs, 'run', 2, 1)
+        second_run.start(self._db.user, self._query)
+
+        self.assertIsNone(first_run.finish(8, ['error 1']))
+        self.assertEqual((15, ['error 1', 'error 2']), second_run.finish(7, ['error 2']))
+
+        # Running a shard again does not send any more reports.
+        run_again = blast.BlastRun(self._db.blast_runs, 'run', 2, 1)
+        run_again.start(self._db.user, self._query)
+        self.assertTrue(run_again.is_done)
+        self.assertIsNone(run_again.finish(0, []))
+
+    def test_counts_of_resumed_shard(self):
+        """The report includes the counts before the shard was resumed."""
+        run = blast.BlastRun(self._db.blast_runs, 'run')
+        run.start(self._db.user, self._query)
+        run.checkpoint(10, 5, ['error 1'])
+
+        run = blast.BlastRun(self._db.blast_runs, 'run')
+        run.start(self._db.user, self._query)
+        self.assertEqual((8, ['error 1', 'error 2']), run.finish(3, ['error 2']))
+
+    def test_no_users(self):
+        """Shards of a blast without users are empty."""
+        query = {'ready': 'never'}
+        for shard in range(3):
+            run = blast.BlastRun(self._db.blast_runs, 'run', 3, shard)
+            self.assertEqual([], self._user_ids(run.start(self._db.user, query)))
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
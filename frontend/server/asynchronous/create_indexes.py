@@ -0,0 +1,48 @@
+# encoding: utf-8
+"""Script to create the indexes of the database and check that they are used.
+
+It creates the indexes declared in the indexes module, then runs explain on
+all the declared queries and fails if any of them scans a whole collection.
+It can be run several times safely, e.g. against a local Mongo after changing
+a query:
+
+docker-compose run --rm \
+    -e MONGO_URL ... \
+    frontend-flask python bob_emploi/frontend/asynchronous/create_indexes.py
+"""
+import argparse
+import logging
+import os
+import sys
+
+import pymongo
+
+from bob_emploi.frontend import indexes
+
+_DB = pymongo.MongoClient(os.getenv('MONGO_URL', 'mongodb://localhost/test'))\
+    .get_default_database()
+
+
+def main(database, check_only=False):
+    """Create the indexes and check the queries.
+
+    Args:
+        database: the database to update.
+        check_only: if True, do not create the indexes, only check them.
+    Returns:
+        the names of the queries doing a collection scan.
+    """
+    if not check_only:
+        for collection, names in sorted(indexes.apply(database).items()):
+            logging.info('Indexes of %s: %s', collection, ', '.join(names))
+    collection_scans = indexes.check(database)
+    for name in collection_scans:
+        logging.error('The query "%s" scans a whole collection.', name)
+    return collection_scans
+
+
+if __name__ == '__main__':
+    _PARSER = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    _PARSER.add_argument(
+        '--check_only', action='store_true', help='Only check the indexes, do not create them.')
+    sys.exit(1 if main(_DB, **vars(_PARSER.parse_args())) else 0)
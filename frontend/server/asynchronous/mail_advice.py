@@ -5,12 +5,21 @@ Usage:
 docker-compose run --rm \
     -e MONGO_URL ... \
     frontend-flask python bob_emploi/frontend/asynchronous/mail_advice.py
+
+The users are selected from the mailing_eligibility collection: see the
+mailing_eligibility module to fill it. Run the sync_email_stats script just
+before, so that users who do not open their emails are not sent more.
+
+See the blast module to split the blast in shards or resume it.
 """
+import argparse
+from concurrent import futures
 import datetime
 import logging
 import os
 import random
-import signal
+import threading
+import time
 
 import pymongo
 import requests
@@ -19,7 +28,9 @@ from google.protobuf import json_format
 
 from bob_emploi.frontend import advisor
 from bob_emploi.frontend import mail
+from bob_emploi.frontend import mailing_eligibility
 from bob_emploi.frontend import proto
+from bob_emploi.frontend.asynchronous import blast
 from bob_emploi.frontend.api import user_pb2
 
 # A Slack WebHook URL to send final reports to. Defined in the Incoming
@@ -28,8 +39,6 @@ _SLACK_WEBHOOK_URL = os.getenv('SLACK_WEBHOOK_URL')
 
 _DB = pymongo.MongoClient(os.getenv('MONGO_URL', 'mongodb://localhost/test'))\
     .get_default_database()
-# Minimum duration between two emails.
-_COOL_DOWN_TIME = datetime.timedelta(hours=20)
 
 # The base URL to use as the prefix of all links to the website. E.g. in dev,
 # you should use http://localhost:3000.
@@ -40,6 +49,42 @@ DRY_RUN = not bool(os.getenv('NODRY_RUN'))
 if DRY_RUN:
     logging.getLogger().setLevel(logging.INFO)
 
+# Number of threads rendering the template variables of the emails.
+_RENDER_WORKERS = int(os.getenv('MAIL_ADVICE_RENDER_WORKERS', '4'))
+
+# Number of threads calling MailJet concurrently to send the emails.
+_SEND_WORKERS = int(os.getenv('MAIL_ADVICE_SEND_WORKERS', '8'))
+
+# Number of emails sent in each call to MailJet.
+_SEND_BATCH_SIZE = int(os.getenv('MAIL_ADVICE_SEND_BATCH_SIZE', '50'))
+
+# Maximum number of calls to MailJet per second, and maximum number of calls
+# that can be made in a burst. Use a rate of 0 to disable the rate limit.
+_SEND_RATE = float(os.getenv('MAIL_ADVICE_SEND_RATE', '20'))
+_SEND_BURST = int(os.getenv('MAIL_ADVICE_SEND_BURST', '20'))
+
+# Fields of the users needed to select and render the email: the actions of
+# the projects are the largest part of user documents but they are not used.
+_USER_PROJECTION = proto.mongo_projection(
+    user_pb2.User,
+    ('features_enabled', 'last_email_sent_at', 'profile', 'projects'),
+    exclude=('projects.actions', 'projects.past_actions', 'projects.sticky_actions'))
+
+# Number of users whose data is fetched from the database at once.
+_PREFETCH_BATCH_SIZE = int(os.getenv('MAIL_ADVICE_PREFETCH_BATCH_SIZE', '200'))
+
+# Number of users processed between two checkpoints of the blast.
+_CHECKPOINT_SIZE = int(os.getenv('MAIL_ADVICE_CHECKPOINT_SIZE', '2000'))
+
+# Maximum number of users being processed at the same time: the producer waits
+# for the other stages to catch up before parsing more users.
+_MAX_USERS_IN_FLIGHT = int(os.getenv('MAIL_ADVICE_MAX_USERS_IN_FLIGHT', '200'))
+
+# Maximum age of the email stats synced from MailJet to stop sending emails
+# to users that do not open them: older stats might miss their last opens.
+_MAX_EMAIL_STATS_AGE = datetime.timedelta(
+    hours=int(os.getenv('MAIL_ADVICE_MAX_EMAIL_STATS_AGE_HOURS', '36')))
+
 # ID of the email template for advice in MailJet. See
 # https://app.mailjet.com/template/132388/build
 _MAILJET_ADVICE_TEMPLATE_ID = '132388'
@@ -107,22 +152,37 @@ def frequency(days):
     return '%s fois par semaine' % _FRENCH_COUNT[num_days]
 
 
-def send_email_to_user(user, base_url, weekday, database):
-    """Sends an email to the user with their current actions."""
+def render_email_vars(user, base_url, weekday, database, email_history=None):
+    """Selects the content of the email for a user.
+
+    Args:
+        user: the User proto.
+        base_url: the base URL of all links in the email.
+        weekday: the day the email is sent, as a user_pb2.WeekDay value.
+        database: the database containing the advice modules and tips.
+        email_history: the EmailHistory of the user, see
+            advisor.get_email_histories. If not given, it is fetched from the
+            database.
+    Returns:
+        a dict of the variables for the MailJet template or None if there is
+        nothing to send to this user.
+    """
     if not user.projects:
-        return False
+        return None
     # Renew actions for the day if needed.
-    advice = advisor.select_advice_for_email(user, weekday, database)
+    advice = advisor.select_advice_for_email(
+        user, weekday, database, email_history=email_history)
     if not advice:
         logging.warning('No useful advice to send for: %s', user.profile.email)
-        return False
+        return None
 
     advice_module = advisor.get_advice_module(advice.advice_id, database)
     if not advice_module:
         logging.warning('Module for advice "%s" not found in DB.', advice.advice_id)
-        return False
+        return None
 
-    tips = advisor.select_tips_for_email(user, user.projects[0], advice, database)
+    tips = advisor.select_tips_for_email(
+        user, user.projects[0], advice, database, email_history=email_history)
     if not tips:
         logging.warning('No tips for advice "%s".', advice.advice_id)
 
@@ -130,76 +190,57 @@ def send_email_to_user(user, base_url, weekday, database):
         advisor.get_advice_module(a.advice_id, database)
         for a in user.projects[0].advices]
 
-    mail_result = mail.send_template(
-        _MAILJET_ADVICE_TEMPLATE_ID,
-        user.profile,
-        dict({
-            'advices': [
-                {'adviceId': a.advice_id, 'title': a.title}
-                for a in advice_modules if a],
-            'baseUrl': base_url,
-            'fact': random.choice(advice_module.email_facts),
-            'firstName': user.profile.name,
-            'frequency': frequency(user.profile.email_days),
-            'nextday': see_you_day(user.profile.email_days, weekday),
-            'numStars': advice.num_stars,
-            'projectId': user.projects[0].project_id,
-            'subject': advice_module.email_subject,
-            'suggestionSentence': advice_module.email_suggestion_sentence,
-            'title': advice_module.email_title,
-        }, **_flatten([json_format.MessageToDict(t) for t in tips], prefix='tips')),
-        dry_run=DRY_RUN,
-        monitoring_category='daily_notification',
-    )
-    mail_result.raise_for_status()
-    return True
-
-
-def _break_on_signal(signums, iterator):
-    """Wrapper for an iterator to stop iterating when kernal signal is received.
+    return dict({
+        'advices': [
+            {'adviceId': a.advice_id, 'title': a.title}
+            for a in advice_modules if a],
+        'baseUrl': base_url,
+        'fact': random.choice(advice_module.email_facts),
+        'firstName': user.profile.name,
+        'frequency': frequency(user.profile.email_days),
+        'nextday': see_you_day(user.profile.email_days, weekday),
+        'numStars': advice.num_stars,
+        'projectId': user.projects[0].project_id,
+        'subject': advice_module.email_subject,
+        'suggestionSentence': advice_module.email_suggestion_sentence,
+        'title': advice_module.email_title,
+    }, **_flatten([json_format.MessageToDict(t) for t in tips], prefix='tips'))
+
+
+def _deactivate_if_never_opened(
+        user_id, user, email_stats, now, user_writer, eligibility_writer):
+    """Deactivate mailings if emails were never opened.
 
     Args:
-        signums: a list of signal numbers to break on.
-        iterator: the iterator to wrap.
-    Yields:
-        the item of the iterator as long as no signal has been caught.
+        user_id: the ID of the user in the database.
+        user: the User proto.
+        email_stats: the stats of the emails sent to this user, as stored in
+            the email_stats collection by the sync_email_stats script.
+        now: the time of the blast, to check that the stats are recent.
+        user_writer: a BulkWriter for the user collection.
+        eligibility_writer: a BulkWriter for the mailing_eligibility collection.
     """
-    signals = []
-
-    def _record_signal(signum, unused_frame):
-        # TODO(pascal): Update the report email to write that the blast was
-        # interrupted.
-        signals.append(signum)
-
-    for signum in signums:
-        signal.signal(signum, _record_signal)
-    for item in iterator:
-        yield item
-        if signals:
-            break
-
-
-def _deactivate_if_never_opened(user_id, user, user_db):
-    """Deactivate mailings if emails were never opened."""
     if not user.last_email_sent_at:
         return False
-    email = user.profile.email
-    # TODO(pascal): Store the fact that the user has already been checked
-    # in our DB to avoid the extra call to MailJet API.
-    counts = mail.count_sent_to(email)
-    delivered_count = counts.get('DeliveredCount', 0)
-    opened_count = counts.get('OpenedCount', 0)
+    delivered_count = email_stats.get('deliveredCount', 0)
+    opened_count = email_stats.get('openedCount', 0)
     if delivered_count < 5:
         return False
     if opened_count >= int(delivered_count / 5):
         return False
+    updated_at = email_stats.get('updatedAt')
+    if not updated_at or updated_at < now - _MAX_EMAIL_STATS_AGE:
+        logging.warning(
+            'Email stats of %s were synced on %s, too long ago to stop sending emails.',
+            user_id, updated_at)
+        return False
 
     logging.info('Disable sending email to %s', user_id)
 
-    if not DRY_RUN:
-        user_db.update_one(
-            {'_id': user_id},
-            {'$set': {'profile.emailDays': [], 'featuresEnabled.autoStopEmails': True}})
+    user_writer.update_one(
+        {'_id': user_id},
+        {'$set': {'profile.emailDays': [], 'featuresEnabled.autoStopEmails': True}})
+    mailing_eligibility.record_advice_stopped(eligibility_writer, user_id)
     return True
 
 
@@ -234,50 +275,293 @@ def _send_email_report(count, errors, english_weekday):
         logging.error('Error while sending the report: %d', result.status_code)
 
 
-def main(database, base_url, now):
-    """Send an email with a selected advice to a list of users."""
-    # Week day as a user_pb2.WeekDay value.
-    weekday = now.weekday() + 1
-    query = {
-        'profile.emailDays': user_pb2.WeekDay.Name(weekday),
-        'projects.advices.score': {'$gt': 0},
-        'featuresEnabled.advisorEmail': 'ACTIVE',
-    }
-    count = 0
-    cool_down_time_beginning = now - _COOL_DOWN_TIME
-    user_iterator = database.user.find(query)
-    errors = []
-    for user_in_db in _break_on_signal([signal.SIGTERM], user_iterator):
-        user = user_pb2.User()
-        user_id = user_in_db['_id']
-        if not proto.parse_from_mongo(user_in_db, user):
-            # Skip silently (the proto library already logs the error).
-            continue
-        if user.last_email_sent_at.ToDatetime() > cool_down_time_beginning:
-            # Skip silently.
-            continue
-
-        if _deactivate_if_never_opened(user_id, user, database.user):
-            continue
-
-        try:
-            result = send_email_to_user(user, base_url, weekday, database)
-        except (IOError, json_format.ParseError) as err:
-            errors.append('%s - %s' % (err, user_id))
-            logging.error(err)
-            continue
-
-        if not result:
-            continue
+class _TokenBucket(object):
+    """A rate limiter allowing bursts, shared by several threads."""
+
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        """Create a bucket, initially full.
+
+        Args:
+            rate: the number of tokens added to the bucket per second. If 0,
+                there is no limit at all.
+            capacity: the maximum number of tokens in the bucket.
+            clock: a function returning the current time in seconds.
+            sleep: a function to wait for a given number of seconds.
+        """
+        self._rate = rate
+        self._capacity = max(1, capacity)
+        self._tokens = self._capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._last_refill = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token from the bucket, waiting for one if it is empty."""
+        if self._rate <= 0:
+            return
+        # Waiting threads hold the lock so that they get their tokens in order.
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(
+                self._capacity, self._tokens + (now - self._last_refill) * self._rate)
+            self._last_refill = now
+            self._tokens -= 1
+            if self._tokens < 0:
+                # Wait for the missing token: it is then refilled in the next
+                # call as if it had been taken after the wait.
+                self._sleep(-self._tokens / self._rate)
+
+
+class _StageStats(object):
+    """Stats of a stage of the blast pipeline, updated by several threads."""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.busy_seconds = 0
+        self._lock = threading.Lock()
+
+    def timed(self, func, num_users=lambda *args: 1):
+        """Wrap a function to record its calls in the stats.
+
+        Args:
+            func: the function to wrap.
+            num_users: a function computing the number of users handled in a
+                call from the args of the call.
+        """
+        def _timed_func(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                duration = time.monotonic() - start
+                with self._lock:
+                    self.count += num_users(*args)
+                    self.busy_seconds += duration
+        return _timed_func
+
+    def log(self, elapsed_seconds):
+        """Log the throughput of the stage for the whole blast."""
+        logging.warning(
+            'Stage "%s": %d users in %.1fs (%.1f users/s, %.0fms per user).',
+            self.name, self.count, elapsed_seconds,
+            self.count / elapsed_seconds if elapsed_seconds else 0,
+            1000 * self.busy_seconds / self.count if self.count else 0)
+
+
+class _BlastPipeline(object):
+    """Pipeline to render and send emails to users concurrently.
+
+    Users are parsed and filtered by the caller, then the template variables
+    are rendered by a pool of threads, and the emails are sent in batches by
+    another pool of threads under a rate limit. The results are collected in
+    the caller's thread. Updates of the users are buffered: call flush to
+    write the last ones.
+    """
 
+    def __init__(self, database, base_url, now, render_executor, send_executor):
+        self._database = database
+        self._base_url = base_url
+        self._now = now
+        self._weekday = now.weekday() + 1
+        self._render_executor = render_executor
+        self._send_executor = send_executor
+        self._rate_limiter = _TokenBucket(_SEND_RATE, _SEND_BURST)
+        self._pending = {}
+        self._batch = []
+        self._user_writer = blast.BulkWriter(database.user, dry_run=DRY_RUN)
+        self._eligibility_writer = blast.BulkWriter(
+            database.mailing_eligibility, dry_run=DRY_RUN)
+        self.count = 0
+        self.errors = []
+        self.stats = [_StageStats('parse'), _StageStats('render'), _StageStats('send')]
+        self.parse_stats, self._render_stats, self._send_stats = self.stats
+
+    def push(self, user_id, user, email_stats, email_history):
+        """Add a user to the pipeline, waiting if too many are in flight.
+
+        Args:
+            user_id: the ID of the user in the database.
+            user: the User proto.
+            email_stats: the stats of the emails sent to this user, as stored
+                in the email_stats collection.
+            email_history: the EmailHistory of the user.
+        """
+        self._pending[self._render_executor.submit(
+            self._render_stats.timed(self._render), user_id, user, email_stats, email_history)] = \
+            (user_id, user, 'render')
+        self._collect(timeout=0)
+        while len(self._pending) >= _MAX_USERS_IN_FLIGHT:
+            self._collect()
+
+    def join(self):
+        """Wait for all the users in the pipeline to be processed."""
+        while self._pending or self._batch:
+            if all(stage == 'send' for unused_id, unused_user, stage in self._pending.values()):
+                # No more users are being rendered: send the last batch.
+                self._flush()
+            self._collect()
+
+    def _render(self, user_id, user, email_stats, email_history):
+        if _deactivate_if_never_opened(
+                user_id, user, email_stats, self._now, self._user_writer,
+                self._eligibility_writer):
+            return None
+        return render_email_vars(
+            user, self._base_url, self._weekday, self._database, email_history=email_history)
+
+    def _send(self, batch):
         if not DRY_RUN:
-            database.user.update_one(
+            self._rate_limiter.acquire()
+        results = mail.send_template_batch(
+            _MAILJET_ADVICE_TEMPLATE_ID,
+            [(user.profile, template_vars) for unused_id, user, template_vars in batch],
+            dry_run=DRY_RUN,
+            monitoring_category='daily_notification',
+        )
+        return [result.error for result in results]
+
+    def _flush(self):
+        if not self._batch:
+            return
+        batch = self._batch
+        self._batch = []
+        self._pending[self._send_executor.submit(
+            self._send_stats.timed(self._send, num_users=len), batch)] = (None, batch, 'send')
+
+    def _collect(self, timeout=None):
+        done, unused_not_done = futures.wait(
+            self._pending, timeout=timeout, return_when=futures.FIRST_COMPLETED)
+        for future in done:
+            user_id, user, stage = self._pending.pop(future)
+            if stage == 'send':
+                self._record_sent(batch=user, errors=future.result())
+                continue
+
+            try:
+                template_vars = future.result()
+            except (IOError, json_format.ParseError) as err:
+                self._record_error(err, user_id)
+                continue
+            if template_vars:
+                self._batch.append((user_id, user, template_vars))
+                if len(self._batch) >= _SEND_BATCH_SIZE:
+                    self._flush()
+
+    def _record_error(self, err, user_id):
+        self.errors.append('%s - %s' % (err, user_id))
+        logging.error(err)
+
+    def _record_sent(self, batch, errors):
+        for (user_id, unused_user, unused_vars), error in zip(batch, errors):
+            if error:
+                self._record_error(error, user_id)
+                continue
+
+            self._user_writer.update_one(
                 {'_id': user_id},
-                {'$set': {'lastEmailSentAt': now}})
+                {'$set': {'lastEmailSentAt': self._now}})
+            mailing_eligibility.record_advice_sent(self._eligibility_writer, user_id, self._now)
+
+            self.count += 1
+
+    def flush(self):
+        """Write the pending updates of the users."""
+        self._user_writer.flush()
+        self._eligibility_writer.flush()
 
-        count += 1
 
-    _send_reports(count, errors, weekday)
+def main(database, base_url, now, run=None):
+    """Send an email with a selected advice to a list of users.
+
+    Args:
+        database: the database with the users and the advice modules.
+        base_url: the base URL of all links in the emails.
+        now: the time of the blast.
+        run: the shard of the blast to run, see blast.BlastRun. By default, the
+            blast is sent to all users in one go.
+    """
+    # Week day as a user_pb2.WeekDay value.
+    weekday = now.weekday() + 1
+    query = {
+        'campaigns': mailing_eligibility.advice_campaign(weekday),
+        'nextEligibleAt.advice': {'$lte': now},
+    }
+    if run is None:
+        run = blast.BlastRun()
+    query = run.start(database.mailing_eligibility, query)
+    cool_down_time_beginning = now - mailing_eligibility.ADVICE_COOL_DOWN_TIME
+    user_iterator = [] if run.is_done else mailing_eligibility.iterate_users(
+        database, query, _USER_PROJECTION, batch_size=_PREFETCH_BATCH_SIZE)
+    advisor.warm_up_cache(database)
+    start = time.monotonic()
+    with futures.ThreadPoolExecutor(max_workers=_RENDER_WORKERS) as render_executor, \
+            futures.ThreadPoolExecutor(max_workers=_SEND_WORKERS) as send_executor:
+        pipeline = _BlastPipeline(database, base_url, now, render_executor, send_executor)
+        parse_user = pipeline.parse_stats.timed(_parse_user)
+        users = []
+        user_id = None
+        num_users_since_checkpoint = 0
+        try:
+            for user_in_db in run.iterate(user_iterator):
+                user_id = user_in_db['_id']
+                num_users_since_checkpoint += 1
+                user = parse_user(user_in_db, cool_down_time_beginning)
+                if user:
+                    user.user_id = str(user_id)
+                    users.append((user_id, user))
+                if len(users) >= _PREFETCH_BATCH_SIZE:
+                    _push_users(pipeline, database, users)
+                    users = []
+                if num_users_since_checkpoint >= _CHECKPOINT_SIZE:
+                    _push_users(pipeline, database, users)
+                    users = []
+                    pipeline.join()
+                    pipeline.flush()
+                    run.checkpoint(user_id, pipeline.count, pipeline.errors)
+                    num_users_since_checkpoint = 0
+            _push_users(pipeline, database, users)
+            pipeline.join()
+        finally:
+            # Record the emails already sent even if the blast is interrupted.
+            pipeline.flush()
+    run.checkpoint(user_id, pipeline.count, pipeline.errors)
+    elapsed_seconds = time.monotonic() - start
+    for stage_stats in pipeline.stats:
+        stage_stats.log(elapsed_seconds)
+
+    report = run.finish(pipeline.count, pipeline.errors)
+    if report:
+        _send_reports(*report, weekday=weekday)
+
+
+def _push_users(pipeline, database, users):
+    """Fetch the data needed for a batch of users and add them to the pipeline."""
+    if not users:
+        return
+    # Emails are stored lowercase by sync_email_stats.
+    all_email_stats = {
+        email_stats['_id']: email_stats
+        for email_stats in database.email_stats.find(
+            {'_id': {'$in': list({user.profile.email.lower() for unused_id, user in users})}})}
+    email_histories = advisor.get_email_histories(
+        [user_id for user_id, unused_user in users], database)
+    for user_id, user in users:
+        pipeline.push(
+            user_id, user, all_email_stats.get(user.profile.email.lower(), {}),
+            email_histories[user_id])
+
+
+def _parse_user(user_in_db, cool_down_time_beginning):
+    user = user_pb2.User()
+    if not proto.parse_from_mongo(user_in_db, user):
+        # Skip silently (the proto library already logs the error).
+        return None
+    if user.last_email_sent_at.ToDatetime() > cool_down_time_beginning:
+        # Skip silently.
+        return None
+    return user
 
 
 def _flatten(root, prefix='', all_vars=None):
@@ -295,4 +579,9 @@ def _flatten(root, prefix='', all_vars=None):
 
 
 if __name__ == '__main__':
-    main(_DB, _BASE_URL, datetime.datetime.utcnow())
+    _PARSER = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    blast.add_run_arguments(_PARSER)
+    _ARGS = _PARSER.parse_args()
+    main(
+        _DB, _BASE_URL, datetime.datetime.utcnow(),
+        blast.BlastRun(_DB.blast_runs, _ARGS.run_id, _ARGS.num_shards, _ARGS.shard))
@@ -1,6 +1,7 @@
 # encoding: utf-8
 """Tests for the bob_emploi.frontend.asynchronous.mail_advice module."""
 import datetime
+import functools
 import signal
 import unittest
 
@@ -8,6 +9,9 @@ import mock
 import mongomock
 
 from bob_emploi.frontend import advisor
+from bob_emploi.frontend import mail
+from bob_emploi.frontend import mailing_eligibility
+from bob_emploi.frontend.asynchronous import blast
 from bob_emploi.frontend.asynchronous import mail_advice
 from bob_emploi.frontend.api import action_pb2
 from bob_emploi.frontend.api import project_pb2
@@ -25,7 +29,28 @@ _USER_READY_FOR_EMAIL = {
 }
 
 
-@mock.patch(mail_advice.__name__ + '.mail')
+def _send_template_batch(mock_mail, template_id, messages, **kwargs):
+    results = []
+    for recipient, template_vars in messages:
+        try:
+            mock_mail.send_template(
+                template_id, recipient, template_vars, **kwargs).raise_for_status()
+        except IOError as error:
+            results.append(mail.SendResult(message_id=None, error=str(error)))
+            continue
+        results.append(mail.SendResult(message_id=1, error=None))
+    return results
+
+
+def _mock_mail():
+    """Mock the mail module, so that batches are sent with send_template."""
+    mock_mail = mock.MagicMock()
+    mock_mail.send_template_batch.side_effect = functools.partial(
+        _send_template_batch, mock_mail)
+    return mock_mail
+
+
+@mock.patch(mail_advice.__name__ + '.mail', new_callable=_mock_mail)
 @mock.patch(advisor.__name__ + '.select_tips_for_email')
 @mock.patch(advisor.__name__ + '.select_advice_for_email')
 class MailingTestCase(unittest.TestCase):
@@ -78,8 +103,8 @@ class MailingTestCase(unittest.TestCase):
         })
         mock_mail.send_template.return_value.status_code = 200
         mock_mail.send_template_to_admins.return_value.status_code = 200
-        mock_mail.count_sent_to.return_value = {'DeliveredCount': 0, 'OpenedCount': 0}
 
+        mailing_eligibility.rebuild(self._db)
         mail_advice.main(self._db, 'http://localhost:3000', self._now)
         self.assertFalse(mock_mail.send_template.called)
 
@@ -114,9 +139,12 @@ class MailingTestCase(unittest.TestCase):
         })
         mock_mail.send_template.return_value.status_code = 200
         mock_mail.send_template_to_admins.return_value.status_code = 200
-        mock_mail.count_sent_to.return_value = {'DeliveredCount': 0, 'OpenedCount': 0}
 
-        mail_advice.main(self._db, 'http://localhost:3000', self._now)
+        mailing_eligibility.rebuild(self._db)
+        with self.assertLogs(level='WARNING') as logs:
+            mail_advice.main(self._db, 'http://localhost:3000', self._now)
+        # The throughput of each stage is reported, even in a real run.
+        self.assertTrue([line for line in logs.output if 'Stage "' in line])
         self.assertTrue(mock_mail.send_template.called)
         template_id, profile, template_vars = mock_mail.send_template.call_args[0]
         self.assertEqual('132388', template_id)
@@ -144,6 +172,28 @@ class MailingTestCase(unittest.TestCase):
             template_vars)
         self.assertTrue(mock_mail.send_template_to_admins.called)
 
+    def test_email_history(self, mock_select_advice, mock_select_tips, mock_mail):
+        """The history of emails is fetched once for both advice and tips."""
+        mock_select_advice.return_value = project_pb2.Advice(
+            advice_id='advice-to-send',
+            num_stars=2,
+        )
+        mock_select_tips.return_value = [action_pb2.Action(title='First tip')]
+        mock_mail.send_template_to_admins.return_value.status_code = 200
+        user_id = self._db.user.insert_one(dict(_USER_READY_FOR_EMAIL)).inserted_id
+        self._db.email_history.insert_one({
+            '_id': user_id,
+            'adviceModules': {'advice-to-send': '2016-11-17T10:00:00Z'},
+        })
+
+        mailing_eligibility.rebuild(self._db)
+        mail_advice.main(self._db, 'http://localhost:3000', self._now)
+
+        history = mock_select_advice.call_args[1]['email_history']
+        self.assertEqual(['advice-to-send'], list(history.advice_modules))
+        self.assertIs(history, mock_select_tips.call_args[1]['email_history'])
+        self.assertEqual(str(user_id), mock_select_advice.call_args[0][0].user_id)
+
     def test_no_dupes(self, mock_select_advice, unused_mock_select_tips, mock_mail):
         """Test that we do not send duplicate emails if we run the script twice."""
         mock_select_advice.return_value = project_pb2.Advice(
@@ -153,8 +203,8 @@ class MailingTestCase(unittest.TestCase):
         self._db.user.insert_one(_USER_READY_FOR_EMAIL)
         mock_mail.send_template.return_value.status_code = 200
         mock_mail.send_template_to_admins.return_value.status_code = 200
-        mock_mail.count_sent_to.return_value = {'DeliveredCount': 0, 'OpenedCount': 0}
 
+        mailing_eligibility.rebuild(self._db)
         mail_advice.main(self._db, 'http://localhost:3000', self._now)
 
         self.assertTrue(mock_mail.send_template.called)
@@ -181,13 +231,13 @@ class MailingTestCase(unittest.TestCase):
 
         mock_mail.send_template.return_value.status_code = 200
         mock_mail.send_template_to_admins.return_value.status_code = 200
-        mock_mail.count_sent_to.return_value = {'DeliveredCount': 0, 'OpenedCount': 0}
         self._db.user.insert_many([
             dict(
                 _USER_READY_FOR_EMAIL,
                 _id=mongomock.ObjectId('580f4a4271cd4a0007672a%dd' % i))
             for i in range(10)
         ])
+        mailing_eligibility.rebuild(self._db)
 
         users = list(self._db.user.find({}))
 
@@ -198,7 +248,8 @@ class MailingTestCase(unittest.TestCase):
         mail_advice.main(self._db, 'http://localhost:3000', self._now)
 
         self.assertEqual(4, mock_mail.send_template.call_count)
-        self.assertEqual(4, db_user.update_one.call_count)
+        self.assertEqual(
+            4, sum(len(call[0][0]) for call in db_user.bulk_write.call_args_list))
         self.assertTrue(mock_mail.send_template_to_admins.called)
 
     def test_6_weeks_not_open(self, mock_select_advice, unused_mock_select_tips, mock_mail):
@@ -212,34 +263,101 @@ class MailingTestCase(unittest.TestCase):
         mock_mail.send_template_to_admins.return_value.status_code = 200
         self._db.user.insert_one(_USER_READY_FOR_EMAIL)
 
+        mailing_eligibility.rebuild(self._db)
+
         # Running the script 5 weeks in a row.
         for week in range(5):
-            mock_mail.count_sent_to.return_value = {'DeliveredCount': week, 'OpenedCount': 0}
-            mail_advice.main(
-                self._db, 'http://localhost:3000',
-                self._now + datetime.timedelta(hours=24 * 7 * week))
+            now = self._now + datetime.timedelta(hours=24 * 7 * week)
+            self._set_email_stats(delivered=week, opened=0, updated_at=now)
+            mail_advice.main(self._db, 'http://localhost:3000', now)
 
         self.assertEqual(5, mock_mail.send_template.call_count)
         mock_mail.send_template.reset_mock()
 
         # Running on week 6.
-        mock_mail.count_sent_to.return_value = {'DeliveredCount': 5, 'OpenedCount': 0}
-        mail_advice.main(
-            self._db, 'http://localhost:3000',
-            self._now + datetime.timedelta(hours=24 * 7 * 6))
+        now = self._now + datetime.timedelta(hours=24 * 7 * 6)
+        self._set_email_stats(delivered=5, opened=0, updated_at=now)
+        mail_advice.main(self._db, 'http://localhost:3000', now)
 
         self.assertFalse(mock_mail.send_template.called)
         user_in_db = self._db.user.find_one({})
         self.assertEqual([], user_in_db['profile'].get('emailDays', []))
         self.assertTrue(user_in_db['featuresEnabled'].get('autoStopEmails'))
+        self.assertEqual([], self._db.mailing_eligibility.find_one({})['campaigns'])
+
+    def test_shards(self, mock_select_advice, unused_mock_select_tips, mock_mail):
+        """Send the blast in several shards with a single report."""
+        mock_select_advice.return_value = project_pb2.Advice(
+            advice_id='advice-to-send',
+            num_stars=2,
+        )
+        mock_mail.send_template_to_admins.return_value.status_code = 200
+        self._db.user.insert_many([
+            dict(_USER_READY_FOR_EMAIL, _id='user-%d' % i) for i in range(10)])
+
+        mailing_eligibility.rebuild(self._db)
+        for shard in range(2):
+            mail_advice.main(
+                self._db, 'http://localhost:3000', self._now,
+                run=blast.BlastRun(self._db.blast_runs, 'advice-run', 2, shard))
+
+        self.assertEqual(10, mock_mail.send_template.call_count)
+        self.assertEqual(1, mock_mail.send_template_to_admins.call_count)
+        self.assertEqual(10, mock_mail.send_template_to_admins.call_args[0][1]['count'])
+
+    def _set_email_stats(self, delivered, opened, updated_at=None):
+        self._db.email_stats.update_one(
+            {'_id': _USER_READY_FOR_EMAIL['profile']['email']},
+            {'$set': {
+                'deliveredCount': delivered,
+                'openedCount': opened,
+                'updatedAt': updated_at or self._now,
+            }},
+            upsert=True)
+
+    def test_outdated_email_stats(
+            self, mock_select_advice, unused_mock_select_tips, mock_mail):
+        """Emails are not stopped on stats that were not synced recently."""
+        mock_select_advice.return_value = project_pb2.Advice(
+            advice_id='advice-to-send', num_stars=2)
+        mock_mail.send_template_to_admins.return_value.status_code = 200
+        self._db.user.insert_one(dict(
+            _USER_READY_FOR_EMAIL, lastEmailSentAt='2016-11-10T10:00:00Z'))
+        self._set_email_stats(
+            delivered=11, opened=0, updated_at=self._now - datetime.timedelta(days=7))
+        mailing_eligibility.rebuild(self._db)
+
+        mail_advice.main(self._db, 'http://localhost:3000', self._now)
+
+        self.assertTrue(mock_mail.send_template.called)
+        self.assertFalse(self._db.user.find_one({})['featuresEnabled'].get('autoStopEmails'))
+
+    def test_email_stats_case(self, mock_select_advice, unused_mock_select_tips, mock_mail):
+        """Email stats are found whatever the case of the user's email."""
+        mock_select_advice.return_value = project_pb2.Advice(
+            advice_id='advice-to-send', num_stars=2)
+        mock_mail.send_template_to_admins.return_value.status_code = 200
+        self._db.user.insert_one(dict(
+            _USER_READY_FOR_EMAIL,
+            lastEmailSentAt='2016-11-10T10:00:00Z',
+            profile=dict(_USER_READY_FOR_EMAIL['profile'], email='Pascal@Bayes.org')))
+        self._set_email_stats(delivered=11, opened=0)
+        mailing_eligibility.rebuild(self._db)
+
+        mail_advice.main(self._db, 'http://localhost:3000', self._now)
+
+        self.assertFalse(mock_mail.send_template.called)
+        self.assertTrue(self._db.user.find_one({})['featuresEnabled'].get('autoStopEmails'))
 
     def _assert_disable_sending(self, mock_mail, delivered, opened, disabled):
         mock_mail.send_template.return_value.status_code = 200
         mock_mail.send_template_to_admins.return_value.status_code = 200
         self._db.user.drop()
+        self._db.mailing_eligibility.drop()
         self._db.user.insert_one(_USER_READY_FOR_EMAIL)
 
-        mock_mail.count_sent_to.return_value = {'DeliveredCount': delivered, 'OpenedCount': opened}
+        self._set_email_stats(delivered, opened)
+        mailing_eligibility.rebuild(self._db)
         mail_advice.main(self._db, 'http://localhost:3000', self._now)
 
         if disabled:
@@ -266,6 +384,37 @@ class MailingTestCase(unittest.TestCase):
         # Disable for 2/100 ratio.
         self._assert_disable_sending(mock_mail, delivered=100, opened=2, disabled=True)
 
+    def test_send_errors(self, mock_select_advice, unused_mock_select_tips, mock_mail):
+        """Errors while sending are reported but do not stop the blast."""
+        mock_select_advice.return_value = project_pb2.Advice(
+            advice_id='advice-to-send',
+            num_stars=2,
+        )
+        mock_mail.send_template_to_admins.return_value.status_code = 200
+        self._db.user.insert_many([
+            dict(_USER_READY_FOR_EMAIL, _id='user-%d' % i) for i in range(10)])
+
+        def _send_template(unused_template_id, profile, unused_vars, **unused_kwargs):
+            result = mock.MagicMock()
+            if profile.name == 'Failing':
+                result.raise_for_status.side_effect = IOError('MailJet is down')
+            return result
+        mock_mail.send_template.side_effect = _send_template
+        self._db.user.update_one({'_id': 'user-3'}, {'$set': {'profile.name': 'Failing'}})
+
+        mailing_eligibility.rebuild(self._db)
+        mail_advice.main(self._db, 'http://localhost:3000', self._now)
+
+        self.assertEqual(10, mock_mail.send_template.call_count)
+        # All the emails were sent in one call.
+        self.assertEqual(1, mock_mail.send_template_batch.call_count)
+        self.assertEqual(
+            9, self._db.user.count({'lastEmailSentAt': {'$exists': True}}))
+        self.assertFalse(self._db.user.find_one({'_id': 'user-3'}).get('lastEmailSentAt'))
+        report_vars = mock_mail.send_template_to_admins.call_args[0][1]
+        self.assertEqual(9, report_vars['count'])
+        self.assertEqual(['MailJet is down - user-3'], report_vars['errors'])
+
 
 class _SigtermAfterNItems(object):
     """Wrapper to iterate on a list but raise a SIGTERM after n items have been iterated."""
@@ -286,6 +435,56 @@ class _SigtermAfterNItems(object):
         return self._items.pop()
 
 
+class TokenBucketTestCase(unittest.TestCase):
+    """Unit tests for the _TokenBucket rate limiter."""
+
+    def setUp(self):
+        super(TokenBucketTestCase, self).setUp()
+        self._time = 0
+        self._sleeps = []
+
+    def _clock(self):
+        return self._time
+
+    def _sleep(self, seconds):
+        self._sleeps.append(seconds)
+        self._time += seconds
+
+    def test_burst(self):
+        """Tokens are available without waiting up to the capacity."""
+        bucket = mail_advice._TokenBucket(  # pylint: disable=protected-access
+            10, 3, clock=self._clock, sleep=self._sleep)
+        for unused_i in range(3):
+            bucket.acquire()
+        self.assertEqual([], self._sleeps)
+
+        bucket.acquire()
+        self.assertEqual(1, len(self._sleeps))
+        self.assertAlmostEqual(.1, self._sleeps[0])
+
+    def test_rate(self):
+        """Tokens are refilled over time at the given rate."""
+        bucket = mail_advice._TokenBucket(  # pylint: disable=protected-access
+            10, 1, clock=self._clock, sleep=self._sleep)
+        for unused_i in range(21):
+            bucket.acquire()
+        self.assertAlmostEqual(2, self._time)
+
+        self._time += 60
+        bucket.acquire()
+        # The bucket did not hold more than its capacity.
+        bucket.acquire()
+        self.assertAlmostEqual(62.1, self._time)
+
+    def test_no_limit(self):
+        """A rate of 0 disables the limit."""
+        bucket = mail_advice._TokenBucket(  # pylint: disable=protected-access
+            0, 1, clock=self._clock, sleep=self._sleep)
+        for unused_i in range(100):
+            bucket.acquire()
+        self.assertEqual([], self._sleeps)
+
+
 class FrenchTestCase(unittest.TestCase):
     """Unit tests for french realted functions."""
 
@@ -9,12 +9,16 @@ Usage:
 docker-compose run --rm \
     -e MONGO_URL ... \
     frontend-flask python bob_emploi/frontend/asynchronous/mail_nps.py 2
+
+The users are selected from the mailing_eligibility collection: see the
+mailing_eligibility module to fill it.
+
+See the blast module to split the blast in shards or resume it.
 """
+import argparse
 import datetime
 import logging
 import os
-import signal
-import sys
 from urllib import parse
 
 import pymongo
@@ -23,6 +27,9 @@ import requests
 from google.protobuf import json_format
 
 from bob_emploi.frontend import mail
+from bob_emploi.frontend import mailing_eligibility
+from bob_emploi.frontend import proto
+from bob_emploi.frontend.asynchronous import blast
 from bob_emploi.frontend.api import user_pb2
 
 # A Slack WebHook URL to send final reports to. Defined in the Incoming
@@ -49,6 +56,18 @@ _MAILJET_TEMPLATE_ID = '100819'
 # https://app.mailjet.com/tempate/74071/build
 _MAILJET_REPORT_TEMPLATE_ID = '74071'
 
+# Fields of the users needed to send the NPS email.
+_USER_PROJECTION = proto.mongo_projection(user_pb2.User, (
+    'features_enabled.net_promoter_score_email',
+    'profile.email',
+    'profile.last_name',
+    'profile.name',
+    'registered_at',
+))
+
+# Number of users processed between two checkpoints of the blast.
+_CHECKPOINT_SIZE = int(os.getenv('MAIL_NPS_CHECKPOINT_SIZE', '2000'))
+
 # Hour of the day (considered in UTC) at which we decide it is a new day: we
 # only send NPS email on the next day.
 _DAY_CUT_UTC_HOUR = 1
@@ -72,30 +91,6 @@ def send_email_to_user(user, base_url, now):
     return True
 
 
-def _break_on_signal(signums, iterator):
-    """Wrapper for an iterator to stop iterating when kernal signal is received.
-
-    Args:
-        signums: a list of signal numbers to break on.
-        iterator: the iterator to wrap.
-    Yields:
-        the item of the iterator as long as no signal has been caught.
-    """
-    signals = []
-
-    def _record_signal(signum, unused_frame):
-        # TODO(pascal): Update the report email to write that the blast was
-        # interrupted.
-        signals.append(signum)
-
-    for signum in signums:
-        signal.signal(signum, _record_signal)
-    for item in iterator:
-        yield item
-        if signals:
-            break
-
-
 def _send_reports(count, errors):
     logging.warning('%d emails sent.', count)
 
@@ -124,58 +119,91 @@ def _send_email_report(count, errors):
         logging.error('Error while sending the report: %d', result.status_code)
 
 
-def main(user_db, base_url, now, days_before_sending):
-    """Send an email to users that signed up more than n days ago list of users."""
+def main(database, base_url, now, days_before_sending, run=None):
+    """Send an email to users that signed up more than n days ago list of users.
+
+    Args:
+        database: the database with the user and mailing_eligibility
+            collections.
+        base_url: the base URL of all links in the emails.
+        now: the time of the blast.
+        days_before_sending: the number of days after sign up before sending
+            the email.
+        run: the shard of the blast to run, see blast.BlastRun. By default, the
+            blast is sent to all users in one go.
+    """
+    registered_before = (now - datetime.timedelta(days=int(days_before_sending)))\
+        .replace(hour=_DAY_CUT_UTC_HOUR, minute=0, second=0, microsecond=0)
     query = {
-        'featuresEnabled.netPromoterScoreEmail': 'NPS_EMAIL_PENDING',
-        'projects': {'$exists': True},
+        'campaigns': mailing_eligibility.NPS_CAMPAIGN,
+        'nextEligibleAt.nps': {'$lte': registered_before},
     }
+    if run is None:
+        run = blast.BlastRun()
+    query = run.start(database.mailing_eligibility, query)
     count = 0
-    user_iterator = user_db.find(
-        query,
-        {
-            '_id': 1,
-            'registeredAt': 1,
-            'featuresEnabled.netPromoterScoreEmail': 1,
-            'profile.email': 1,
-            'profile.lastName': 1,
-            'profile.name': 1,
-        })
+    user_iterator = [] if run.is_done else mailing_eligibility.iterate_users(
+        database, query, _USER_PROJECTION)
     errors = []
-    registered_before = (now - datetime.timedelta(days=int(days_before_sending)))\
-        .replace(hour=_DAY_CUT_UTC_HOUR, minute=0, second=0, microsecond=0)
-    for user_in_db in _break_on_signal([signal.SIGTERM], user_iterator):
-        user = user_pb2.User()
-        user_id = user_in_db.pop('_id')
-        json_format.ParseDict(user_in_db, user)
-        if user.features_enabled.net_promoter_score_email != user_pb2.NPS_EMAIL_PENDING:
-            # Skip silently: NPS was sent already.
-            continue
-
-        if user.registered_at.ToDatetime() > registered_before:
-            # Skip silently: will send another day.
-            continue
-
-        try:
-            result = send_email_to_user(user, base_url, now)
-        except (IOError, json_format.ParseError) as err:
-            errors.append('%s - %s' % (err, user_id))
-            logging.error(err)
-            continue
-
-        if not result:
-            continue
-
-        if not DRY_RUN:
-            user_db.update_one(
+    user_writer = blast.BulkWriter(database.user, dry_run=DRY_RUN)
+    eligibility_writer = blast.BulkWriter(database.mailing_eligibility, dry_run=DRY_RUN)
+    user_id = None
+    num_users_since_checkpoint = 0
+    try:
+        for user_in_db in run.iterate(user_iterator):
+            if num_users_since_checkpoint >= _CHECKPOINT_SIZE:
+                user_writer.flush()
+                eligibility_writer.flush()
+                run.checkpoint(user_id, count, errors)
+                num_users_since_checkpoint = 0
+            num_users_since_checkpoint += 1
+
+            user = user_pb2.User()
+            user_id = user_in_db['_id']
+            if not proto.parse_from_mongo(user_in_db, user):
+                # Skip silently (the proto library already logs the error).
+                continue
+            if user.features_enabled.net_promoter_score_email != user_pb2.NPS_EMAIL_PENDING:
+                # Skip silently: NPS was sent already.
+                continue
+
+            if user.registered_at.ToDatetime() > registered_before:
+                # Skip silently: will send another day.
+                continue
+
+            try:
+                result = send_email_to_user(user, base_url, now)
+            except (IOError, json_format.ParseError) as err:
+                errors.append('%s - %s' % (err, user_id))
+                logging.error(err)
+                continue
+
+            if not result:
+                continue
+
+            user_writer.update_one(
                 {'_id': user_id},
                 {'$set': {'featuresEnabled.netPromoterScoreEmail': 'NPS_EMAIL_SENT'}})
+            mailing_eligibility.record_nps_sent(eligibility_writer, user_id)
 
-        count += 1
+            count += 1
+    finally:
+        # Record the emails already sent even if the blast is interrupted.
+        user_writer.flush()
+        eligibility_writer.flush()
+    run.checkpoint(user_id, count, errors)
 
-    _send_reports(count, errors)
+    report = run.finish(count, errors)
+    if report:
+        _send_reports(*report)
 
 
 if __name__ == '__main__':
-    _DAYS_BEFORE_SENDING, = sys.argv[1:]  # pylint: disable=unbalanced-tuple-unpacking
-    main(_DB.user, _BASE_URL, datetime.datetime.utcnow(), _DAYS_BEFORE_SENDING)
+    _PARSER = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    _PARSER.add_argument(
+        'days_before_sending', help='Number of days after sign up before sending the email.')
+    blast.add_run_arguments(_PARSER)
+    _ARGS = _PARSER.parse_args()
+    main(
+        _DB, _BASE_URL, datetime.datetime.utcnow(), _ARGS.days_before_sending,
+        blast.BlastRun(_DB.blast_runs, _ARGS.run_id, _ARGS.num_shards, _ARGS.shard))
@@ -7,6 +7,8 @@ import unittest
 import mock
 import mongomock
 
+from bob_emploi.frontend import mailing_eligibility
+from bob_emploi.frontend.asynchronous import blast
 from bob_emploi.frontend.asynchronous import mail_nps
 
 _USER_PENDING_NPS_DICT = {
@@ -54,7 +56,8 @@ class MailingTestCase(unittest.TestCase):
         mock_mail.send_template.return_value.status_code = 200
         mock_mail.send_template_to_admins.return_value.status_code = 200
 
-        mail_nps.main(self._db.user, 'http://localhost:3000', self._now, '1')
+        mailing_eligibility.rebuild(self._db)
+        mail_nps.main(self._db, 'http://localhost:3000', self._now, '1')
         self.assertTrue(mock_mail.send_template.called)
         template_id, profile, template_vars = mock_mail.send_template.call_args[0]
         self.assertEqual('100819', template_id)
@@ -78,7 +81,8 @@ class MailingTestCase(unittest.TestCase):
                 _USER_PENDING_NPS_DICT,
                 registeredAt=(self._now - datetime.timedelta(hours=6)).isoformat() + 'Z'))
 
-        mail_nps.main(self._db.user, 'http://localhost:3000', self._now, '0')
+        mailing_eligibility.rebuild(self._db)
+        mail_nps.main(self._db, 'http://localhost:3000', self._now, '0')
 
         self.assertFalse(mock_mail.send_template.called)
         self.assertTrue(mock_mail.send_template_to_admins.called)
@@ -89,7 +93,8 @@ class MailingTestCase(unittest.TestCase):
         mock_mail.send_template_to_admins.return_value.status_code = 200
         self._db.user.insert_one(_USER_PENDING_NPS_DICT)
 
-        mail_nps.main(self._db.user, 'http://localhost:3000', self._now, '1')
+        mailing_eligibility.rebuild(self._db)
+        mail_nps.main(self._db, 'http://localhost:3000', self._now, '1')
 
         self.assertTrue(mock_mail.send_template.called)
         self.assertTrue(mock_mail.send_template_to_admins.called)
@@ -98,7 +103,7 @@ class MailingTestCase(unittest.TestCase):
 
         # Running the script again 10 minutes later.
         mail_nps.main(
-            self._db.user, 'http://localhost:3000', self._now + datetime.timedelta(minutes=10), '1')
+            self._db, 'http://localhost:3000', self._now + datetime.timedelta(minutes=10), '1')
         self.assertFalse(mock_mail.send_template.called)
         self.assertTrue(mock_mail.send_template_to_admins.called)
 
@@ -112,18 +117,74 @@ class MailingTestCase(unittest.TestCase):
                 _id=mongomock.ObjectId('580f4a4271cd4a0007672a%dd' % i))
             for i in range(10)
         ])
+        mailing_eligibility.rebuild(self._db)
 
         users = list(self._db.user.find({}))
 
         db_user = mock.MagicMock()
         db_user.find.return_value = _SigtermAfterNItems(users, 3)
+        self._db.user = db_user
 
-        mail_nps.main(db_user, 'http://localhost:3000', self._now, '1')
+        mail_nps.main(self._db, 'http://localhost:3000', self._now, '1')
 
         self.assertEqual(4, mock_mail.send_template.call_count)
-        self.assertEqual(4, db_user.update_one.call_count)
+        self.assertEqual(
+            4, sum(len(call[0][0]) for call in db_user.bulk_write.call_args_list))
         self.assertTrue(mock_mail.send_template_to_admins.called)
 
+    def test_shards(self, mock_mail):
+        """Send the blast in several shards with a single report."""
+        mock_mail.send_template.return_value.status_code = 200
+        mock_mail.send_template_to_admins.return_value.status_code = 200
+        self._db.user.insert_many([
+            dict(_USER_PENDING_NPS_DICT, _id=mongomock.ObjectId()) for unused_i in range(10)])
+
+        mailing_eligibility.rebuild(self._db)
+
+        for shard in range(3):
+            mail_nps.main(
+                self._db, 'http://localhost:3000', self._now, '1',
+                run=blast.BlastRun(self._db.blast_runs, 'nps-run', 3, shard))
+
+        self.assertEqual(10, mock_mail.send_template.call_count)
+        self.assertEqual(1, mock_mail.send_template_to_admins.call_count)
+        self.assertEqual(10, mock_mail.send_template_to_admins.call_args[0][1]['count'])
+
+    def test_resume(self, mock_mail):
+        """Resume an interrupted blast without sending emails twice."""
+        mock_mail.send_template.return_value.status_code = 200
+        mock_mail.send_template_to_admins.return_value.status_code = 200
+        self._db.user.insert_many([
+            dict(
+                _USER_PENDING_NPS_DICT,
+                _id=mongomock.ObjectId('580f4a4271cd4a0007672a%dd' % i))
+            for i in range(10)
+        ])
+        mailing_eligibility.rebuild(self._db)
+
+        users = list(self._db.user.find({}))
+        users.reverse()
+        user_collection = self._db.user
+        db_user = mock.MagicMock(wraps=user_collection)
+        db_user.find.return_value = _SigtermAfterNItems(users, 3)
+        self._db.user = db_user
+
+        mail_nps.main(
+            self._db, 'http://localhost:3000', self._now, '1',
+            run=blast.BlastRun(self._db.blast_runs, 'nps-run'))
+        self._db.user = user_collection
+
+        self.assertEqual(4, mock_mail.send_template.call_count)
+        self.assertFalse(mock_mail.send_template_to_admins.called)
+
+        mail_nps.main(
+            self._db, 'http://localhost:3000', self._now, '1',
+            run=blast.BlastRun(self._db.blast_runs, 'nps-run'))
+
+        self.assertEqual(10, mock_mail.send_template.call_count)
+        self.assertEqual(1, mock_mail.send_template_to_admins.call_count)
+        self.assertEqual(10, mock_mail.send_template_to_admins.call_args[0][1]['count'])
+
 
 class _SigtermAfterNItems(object):
     """Wrapper to iterate on a list but raise a SIGTERM after n items have been iterated."""
@@ -0,0 +1,25 @@
+# encoding: utf-8
+"""Script to compute the mailing_eligibility collection from all the users.
+
+The collection is then kept up to date by the server and the blasts: this is
+only needed to fill it the first time or to fix it.
+
+Usage:
+
+docker-compose run --rm \
+    -e MONGO_URL ... \
+    frontend-flask python bob_emploi/frontend/asynchronous/rebuild_mailing_eligibility.py
+"""
+import logging
+import os
+
+import pymongo
+
+from bob_emploi.frontend import mailing_eligibility
+
+_DB = pymongo.MongoClient(os.getenv('MONGO_URL', 'mongodb://localhost/test'))\
+    .get_default_database()
+
+
+if __name__ == '__main__':
+    logging.warning('%d users eligible to a mailing.', mailing_eligibility.rebuild(_DB))
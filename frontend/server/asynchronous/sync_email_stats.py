@@ -0,0 +1,73 @@
+# encoding: utf-8
+"""Script to copy the statistics of emails sent to our users from MailJet.
+
+The statistics are stored in the email_stats collection keyed by lowercase
+email, so that mailing scripts can check them without calling MailJet for each
+user.
+It should run before each blast.
+
+Usage:
+
+docker-compose run --rm \
+    -e MONGO_URL ... \
+    frontend-flask python bob_emploi/frontend/asynchronous/sync_email_stats.py
+"""
+import datetime
+import logging
+import os
+
+import pymongo
+
+from bob_emploi.frontend import mail
+
+_DB = pymongo.MongoClient(os.getenv('MONGO_URL', 'mongodb://localhost/test'))\
+    .get_default_database()
+
+# For a dry run we do not modify the database.
+DRY_RUN = not bool(os.getenv('NODRY_RUN'))
+if DRY_RUN:
+    logging.getLogger().setLevel(logging.INFO)
+
+# Number of contacts written to the database at once.
+_WRITE_BATCH_SIZE = 1000
+
+
+def _write(email_stats_db, updates):
+    if updates and not DRY_RUN:
+        email_stats_db.bulk_write(updates, ordered=False)
+
+
+def main(database, sync_time):
+    """Copy the statistics of all contacts from MailJet to the database.
+
+    Args:
+        database: the database to update.
+        sync_time: the datetime of the sync, stored with the statistics.
+    Returns:
+        the number of contacts updated.
+    """
+    count = 0
+    updates = []
+    for email, stats in mail.iterate_contacts_statistics():
+        updates.append(pymongo.UpdateOne(
+            {'_id': email.lower()},
+            {'$set': {
+                'deliveredCount': stats.get('DeliveredCount', 0),
+                'openedCount': stats.get('OpenedCount', 0),
+                'clickedCount': stats.get('ClickedCount', 0),
+                'updatedAt': sync_time,
+            }},
+            upsert=True))
+        count += 1
+        if len(updates) >= _WRITE_BATCH_SIZE:
+            _write(database.email_stats, updates)
+            updates = []
+    _write(database.email_stats, updates)
+
+    logging.warning(
+        '%s the statistics of %d contacts.', 'Would update' if DRY_RUN else 'Updated', count)
+    return count
+
+
+if __name__ == '__main__':
+    main(_DB, datetime.datetime.utcnow())
@@ -0,0 +1,62 @@
+# encoding: utf-8
+"""Tests for the bob_emploi.frontend.asynchronous.sync_email_stats module."""
+import datetime
+import unittest
+
+import mock
+import mongomock
+
+from bob_emploi.frontend.asynchronous import sync_email_stats
+
+
+@mock.patch(sync_email_stats.__name__ + '.mail')
+class SyncEmailStatsTestCase(unittest.TestCase):
+    """Unit tests for the sync_email_stats script."""
+
+    def setUp(self):
+        super(SyncEmailStatsTestCase, self).setUp()
+        sync_email_stats.DRY_RUN = False
+        self._db = mongomock.MongoClient().database
+        self._now = datetime.datetime(2017, 3, 6, 10, 0, 0)
+
+    def test_main(self, mock_mail):
+        """Statistics are copied and updated in the database."""
+        self._db.email_stats.insert_one({
+            '_id': 'pascal@bayes.org',
+            'deliveredCount': 3,
+            'openedCount': 0,
+            'updatedAt': self._now - datetime.timedelta(days=7),
+        })
+        mock_mail.iterate_contacts_statistics.return_value = iter([
+            ('pascal@bayes.org', {'DeliveredCount': 5, 'OpenedCount': 1}),
+            ('Cyrille@Bayes.org', {'DeliveredCount': 2, 'OpenedCount': 2, 'ClickedCount': 1}),
+        ])
+
+        self.assertEqual(2, sync_email_stats.main(self._db, self._now))
+
+        self.assertEqual(
+            {
+                '_id': 'pascal@bayes.org',
+                'clickedCount': 0,
+                'deliveredCount': 5,
+                'openedCount': 1,
+                'updatedAt': self._now,
+            },
+            self._db.email_stats.find_one({'_id': 'pascal@bayes.org'}))
+        self.assertEqual(
+            1, self._db.email_stats.find_one({'_id': 'cyrille@bayes.org'})['clickedCount'])
+
+    def test_dry_run(self, mock_mail):
+        """Nothing is written during a dry run."""
+        sync_email_stats.DRY_RUN = True
+        mock_mail.iterate_contacts_statistics.return_value = iter([
+            ('pascal@bayes.org', {'DeliveredCount': 5, 'OpenedCount': 1}),
+        ])
+
+        self.assertEqual(1, sync_email_stats.main(self._db, self._now))
+
+        self.assertFalse(self._db.email_stats.find_one())
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,285 @@
+# encoding: utf-8
+"""Script to update the advice of existing users after advice modules changed.
+
+Users only get advice when their project is first saved, so when we change the
+definition of an advice module or its scoring model, existing users keep their
+old advice. This script rescores the modules that changed for all users that
+already have advice.
+
+Modules are considered changed if their scoring related fields (see
+_fingerprint) are different since the last real run, or if their scoring model
+is given on the command line. Modules deleted since the last real run are
+changed as well: their pieces of advice are removed.
+
+Usage:
+
+docker-compose run --rm \
+    -e MONGO_URL ... \
+    frontend-flask python bob_emploi/frontend/asynchronous/update_advice.py \
+    --scoring_models chantier-spontaneous-application --processes 4
+"""
+import argparse
+import collections
+import hashlib
+import logging
+import multiprocessing
+import os
+
+import pymongo
+
+from google.protobuf import json_format
+
+from bob_emploi.frontend import advisor
+from bob_emploi.frontend import proto
+from bob_emploi.frontend.api import advisor_pb2
+from bob_emploi.frontend.api import user_pb2
+
+_MONGO_URL = os.getenv('MONGO_URL', 'mongodb://localhost/test')
+
+# For a dry run we do not modify the database, we only report what would
+# change.
+DRY_RUN = not bool(os.getenv('NODRY_RUN'))
+if DRY_RUN:
+    logging.getLogger().setLevel(logging.INFO)
+
+# Number of users handled in each range of IDs sent to a worker.
+_DEFAULT_BATCH_SIZE = 500
+
+# Query to find users that might need their advice to be updated.
+_ADVISED_USERS_QUERY = {
+    'featuresEnabled.advisor': 'ACTIVE',
+    'projects.advices': {'$exists': True},
+}
+
+# Fields of the advice modules that have an impact on the advice given to users.
+_SCORING_FIELDS = (
+    'airtable_id',
+    'extra_data_field_name',
+    'incompatible_advice_ids',
+    'is_ready_for_prod',
+    'trigger_scoring_model',
+)
+
+# Database of the current worker process.
+_WORKER_DATABASE = None
+
+
+def _fingerprint(module):
+    """Compute a fingerprint of the scoring related fields of an advice module."""
+    scoring_part = advisor_pb2.AdviceModule()
+    for field in _SCORING_FIELDS:
+        value = getattr(module, field)
+        if isinstance(value, (str, bool)):
+            setattr(scoring_part, field, value)
+        else:
+            getattr(scoring_part, field).extend(sorted(value))
+    return hashlib.sha1(scoring_part.SerializeToString(deterministic=True)).hexdigest()
+
+
+def changed_advice_ids(database, scoring_models=()):
+    """List the IDs of the advice modules that changed since the last update.
+
+    Args:
+        database: the database containing the advice modules.
+        scoring_models: names of scoring models whose code changed: all the
+            modules using them are considered changed.
+    Returns:
+        a dict of fingerprints of the changed modules keyed by their IDs. The
+        fingerprint is None for modules that were deleted since the last
+        update.
+    """
+    previous_fingerprints = {
+        version['_id']: version.get('fingerprint')
+        for version in database.advice_module_versions.find()}
+    changed = {}
+    for module_dict in database.advice_modules.find():
+        module = advisor_pb2.AdviceModule()
+        proto.parse_from_mongo(module_dict, module)
+        fingerprint = _fingerprint(module)
+        previous_fingerprint = previous_fingerprints.pop(module.advice_id, None)
+        if module.trigger_scoring_model in scoring_models or previous_fingerprint != fingerprint:
+            changed[module.advice_id] = fingerprint
+    for advice_id in previous_fingerprints:
+        changed[advice_id] = None
+    return changed
+
+
+def _id_ranges(user_db, batch_size):
+    """Split the advised users in ranges of IDs.
+
+    Only the IDs are streamed from the database, the users themselves are
+    fetched by the workers.
+
+    Yields:
+        tuples of the first and last (inclusive) IDs of each range.
+    """
+    first_id = None
+    last_id = None
+    count = 0
+    for user_id in user_db.find(_ADVISED_USERS_QUERY, {'_id': 1}).sort('_id', pymongo.ASCENDING):
+        if first_id is None:
+            first_id = user_id['_id']
+        last_id = user_id['_id']
+        count += 1
+        if count >= batch_size:
+            yield first_id, last_id
+            first_id = None
+            count = 0
+    if first_id is not None:
+        yield first_id, last_id
+
+
+def update_users_in_range(database, id_range, advice_ids, dry_run=True):
+    """Update the advice of the users in a range of IDs.
+
+    Args:
+        database: the database containing the users and advice modules.
+        id_range: a tuple with the first and last (inclusive) IDs of the users
+            to update.
+        advice_ids: a set of IDs of the advice modules to update.
+        dry_run: if True, only compute the changes, do not save them.
+    Returns:
+        a Counter of changes keyed by advice ID and kind of change ('added',
+        'removed' or 'updated'). The special key ('', 'users') counts the
+        number of users whose advice changed, and ('', 'conflicts') the
+        number of them that were not saved because they were modified
+        meanwhile.
+    """
+    first_id, last_id = id_range
+    query = dict(_ADVISED_USERS_QUERY, _id={'$gte': first_id, '$lte': last_id})
+    counts = collections.Counter()
+    updates = []
+    projection = {'featuresEnabled': 1, 'profile': 1, 'projects': 1}
+    for user_in_db in database.user.find(query, projection):
+        user_id = user_in_db['_id']
+        user = user_pb2.User()
+        if not proto.parse_from_mongo(user_in_db, user):
+            continue
+        user.user_id = str(user_id)
+        # Only save if the projects were not modified since we read them, e.g.
+        # if the user did not give feedback on a piece of advice, nor added
+        # or removed a project.
+        update_filter = {'_id': user_id}
+        updated_fields = {}
+        for index, project in enumerate(user.projects):
+            changes = advisor.update_advice(user, project, database, advice_ids)
+            if not changes:
+                continue
+            for change in changes:
+                if not change.before:
+                    counts[(change.advice_id, 'added')] += 1
+                elif not change.after:
+                    counts[(change.advice_id, 'removed')] += 1
+                else:
+                    counts[(change.advice_id, 'updated')] += 1
+            project_in_db = user_in_db['projects'][index]
+            update_filter['projects.%d.projectId' % index] = project_in_db.get('projectId')
+            update_filter['projects.%d.advices' % index] = project_in_db.get('advices')
+            updated_fields['projects.%d.advices' % index] = [
+                json_format.MessageToDict(a) for a in project.advices]
+        if not updated_fields:
+            continue
+        counts[('', 'users')] += 1
+        updates.append(pymongo.UpdateOne(update_filter, {'$set': updated_fields}))
+
+    if updates and not dry_run:
+        result = database.user.bulk_write(updates, ordered=False)
+        if result.matched_count < len(updates):
+            counts[('', 'conflicts')] += len(updates) - result.matched_count
+    return counts
+
+
+def _init_worker(mongo_url):
+    # pylint: disable=global-statement
+    global _WORKER_DATABASE
+    # Each process needs its own client: MongoClient is not fork-safe. The
+    # caches of the advisor module are then kept for the whole life of the
+    # worker.
+    _WORKER_DATABASE = pymongo.MongoClient(mongo_url).get_default_database()
+
+
+def _update_users_in_worker(args):
+    id_range, advice_ids, dry_run = args
+    return update_users_in_range(_WORKER_DATABASE, id_range, advice_ids, dry_run=dry_run)
+
+
+def _report(counts, dry_run):
+    num_conflicts = counts.pop(('', 'conflicts'), 0)
+    logging.warning(
+        '%s the advice of %d users.', 'Would update' if dry_run else 'Updated',
+        counts.pop(('', 'users'), 0) - num_conflicts)
+    if num_conflicts:
+        logging.warning(
+            '%d users were modified while being updated, run the script again to update them.',
+            num_conflicts)
+    changes_per_advice = collections.defaultdict(collections.Counter)
+    for (advice_id, kind), count in counts.items():
+        changes_per_advice[advice_id][kind] = count
+    for advice_id, changes in sorted(changes_per_advice.items()):
+        logging.warning(
+            '%s: +%d -%d ~%d', advice_id,
+            changes['added'], changes['removed'], changes['updated'])
+
+
+def main(database, string_args=None, mongo_url=None):
+    """Update the advice of all users for advice modules that changed.
+
+    Args:
+        database: the database to update.
+        string_args: the command line arguments.
+        mongo_url: the URL of the database, used by worker processes to
+            connect to it.
+    Returns:
+        a Counter of changes, see update_users_in_range.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--scoring_models', nargs='*', default=[],
+        help='Scoring models whose code has changed.')
+    parser.add_argument(
+        '--processes', type=int, default=0,
+        help='Number of worker processes, 0 to work in the main process.')
+    parser.add_argument(
+        '--batch_size', type=int, default=_DEFAULT_BATCH_SIZE,
+        help='Number of users sent to a worker at once.')
+    args = parser.parse_args(string_args)
+
+    changed = changed_advice_ids(database, set(args.scoring_models))
+    if not changed:
+        logging.warning('No advice modules have changed.')
+        return collections.Counter()
+    logging.info('Updating advice modules: %s', ', '.join(sorted(changed)))
+    advice_ids = set(changed)
+
+    id_ranges = _id_ranges(database.user, args.batch_size)
+    counts = collections.Counter()
+    if args.processes and mongo_url:
+        with multiprocessing.Pool(
+                args.processes, initializer=_init_worker, initargs=(mongo_url,)) as pool:
+            for range_counts in pool.imap_unordered(
+                    _update_users_in_worker,
+                    ((id_range, advice_ids, DRY_RUN) for id_range in id_ranges)):
+                counts.update(range_counts)
+    else:
+        for id_range in id_ranges:
+            counts.update(update_users_in_range(database, id_range, advice_ids, dry_run=DRY_RUN))
+
+    _report(collections.Counter(counts), DRY_RUN)
+
+    # Keep the old fingerprints if some users could not be saved, so that
+    # the next run tries them again.
+    if not DRY_RUN and not counts[('', 'conflicts')]:
+        for advice_id, fingerprint in changed.items():
+            if fingerprint is None:
+                database.advice_module_versions.delete_one({'_id': advice_id})
+                continue
+            database.advice_module_versions.update_one(
+                {'_id': advice_id}, {'$set': {'fingerprint': fingerprint}}, upsert=True)
+
+    return counts
+
+
+if __name__ == '__main__':
+    main(
+        pymongo.MongoClient(_MONGO_URL).get_default_database(),
+        mongo_url=_MONGO_URL)
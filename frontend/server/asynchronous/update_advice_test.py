@@ -0,0 +1,184 @@
+# encoding: utf-8
+"""Tests for the bob_emploi.frontend.asynchronous.update_advice module."""
+import copy
+import unittest
+
+import mock
+import mongomock
+
+from bob_emploi.frontend import advisor
+from bob_emploi.frontend import scoring
+from bob_emploi.frontend.asynchronous import update_advice
+from bob_emploi.frontend.api import advisor_pb2
+from bob_emploi.frontend.api import project_pb2
+
+
+class UpdateAdviceTestCase(unittest.TestCase):
+    """Unit tests for the update_advice script."""
+
+    def setUp(self):
+        super(UpdateAdviceTestCase, self).setUp()
+        update_advice.DRY_RUN = False
+        self._db = mongomock.MongoClient().database
+        self._db.advice_modules.insert_many([
+            {
+                'adviceId': 'stable',
+                'triggerScoringModel': 'constant(2)',
+                'isReadyForProd': True,
+            },
+            {
+                'adviceId': 'new-advice',
+                'triggerScoringModel': 'constant(3)',
+                'isReadyForProd': True,
+            },
+            {
+                'adviceId': 'obsolete',
+                'triggerScoringModel': 'constant(0)',
+                'isReadyForProd': True,
+            },
+        ])
+        stable_fingerprint = update_advice._fingerprint(  # pylint: disable=protected-access
+            advisor_pb2.AdviceModule(
+                advice_id='stable', trigger_scoring_model='constant(2)', is_ready_for_prod=True))
+        self._db.advice_module_versions.insert_many([
+            {'_id': 'stable', 'fingerprint': stable_fingerprint},
+            {'_id': 'obsolete', 'fingerprint': 'old-fingerprint'},
+        ])
+        advisor.clear_cache()
+        self._user_id = self._db.user.insert_one({
+            'featuresEnabled': {'advisor': 'ACTIVE'},
+            'projects': [{
+                'title': 'Project Title',
+                'advices': [
+                    {'adviceId': 'stable', 'numStars': 2, 'status': 'ADVICE_RECOMMENDED'},
+                    {'adviceId': 'obsolete', 'numStars': 1, 'status': 'ADVICE_RECOMMENDED'},
+                ],
+            }],
+        }).inserted_id
+
+    def test_changed_advice_ids(self):
+        """Only new and modified modules are considered changed."""
+        self.assertEqual(
+            {'new-advice', 'obsolete'}, set(update_advice.changed_advice_ids(self._db)))
+
+    def test_changed_scoring_model(self):
+        """Modules using a scoring model given on the command line are changed."""
+        self.assertEqual(
+            {'new-advice', 'obsolete', 'stable'},
+            set(update_advice.changed_advice_ids(self._db, {'constant(2)'})))
+
+    def test_main(self):
+        """Update users' advice and record the new fingerprints."""
+        counts = update_advice.main(self._db, [])
+
+        self.assertEqual(1, counts[('', 'users')])
+        self.assertEqual(1, counts[('new-advice', 'added')])
+        self.assertEqual(1, counts[('obsolete', 'removed')])
+        user = self._db.user.find_one({'_id': self._user_id})
+        self.assertEqual(
+            ['new-advice', 'stable'],
+            [a['adviceId'] for a in user['projects'][0]['advices']])
+
+        advisor.clear_cache()
+        self.assertFalse(update_advice.changed_advice_ids(self._db))
+
+    def test_main_dry_run(self):
+        """Dry run does not modify the database."""
+        update_advice.DRY_RUN = True
+        counts = update_advice.main(self._db, ['--batch_size', '1'])
+
+        self.assertEqual(1, counts[('new-advice', 'added')])
+        user = self._db.user.find_one({'_id': self._user_id})
+        self.assertEqual(
+            ['stable', 'obsolete'],
+            [a['adviceId'] for a in user['projects'][0]['advices']])
+        self.assertEqual(2, self._db.advice_module_versions.count())
+
+    def test_seen_advice_is_kept(self):
+        """A piece of advice already seen by the user is never removed."""
+        self._db.user.update_one(
+            {'_id': self._user_id},
+            {'$set': {'projects.0.advices.1.status': 'ADVICE_READ'}})
+        counts = update_advice.main(self._db, [])
+
+        self.assertEqual(0, counts[('obsolete', 'removed')])
+        user = self._db.user.find_one({'_id': self._user_id})
+        self.assertEqual(
+            ['new-advice', 'stable', 'obsolete'],
+            [a['adviceId'] for a in user['projects'][0]['advices']])
+
+    def test_concurrent_modification(self):
+        """A user modified during the update is not overwritten."""
+        real_update_advice = advisor.update_advice
+
+        def _update_advice_while_user_reads(user, project, database, advice_ids):
+            user_in_db = copy.deepcopy(self._db.user.find_one({'_id': self._user_id}))
+            user_in_db['projects'][0]['advices'][1]['status'] = 'ADVICE_READ'
+            self._db.user.replace_one({'_id': self._user_id}, user_in_db)
+            return real_update_advice(user, project, database, advice_ids)
+
+        with mock.patch(advisor.__name__ + '.update_advice') as mock_update_advice:
+            mock_update_advice.side_effect = _update_advice_while_user_reads
+            counts = update_advice.main(self._db, [])
+
+        self.assertEqual(1, counts[('', 'conflicts')])
+        user = self._db.user.find_one({'_id': self._user_id})
+        self.assertEqual(
+            ['stable', 'obsolete'], [a['adviceId'] for a in user['projects'][0]['advices']])
+        self.assertEqual('ADVICE_READ', user['projects'][0]['advices'][1]['status'])
+        # The modules are still considered changed, to update the user next time.
+        self.assertEqual(
+            {'new-advice', 'obsolete'}, set(update_advice.changed_advice_ids(self._db)))
+
+        counts = update_advice.main(self._db, [])
+        self.assertEqual(0, counts[('', 'conflicts')])
+        user = self._db.user.find_one({'_id': self._user_id})
+        self.assertEqual(
+            ['new-advice', 'stable', 'obsolete'],
+            [a['adviceId'] for a in user['projects'][0]['advices']])
+
+    def test_deleted_module(self):
+        """Pieces of advice of a deleted module are removed."""
+        self._db.advice_modules.delete_one({'adviceId': 'stable'})
+        advisor.clear_cache()
+
+        self.assertIsNone(update_advice.changed_advice_ids(self._db)['stable'])
+        counts = update_advice.main(self._db, [])
+
+        self.assertEqual(1, counts[('stable', 'removed')])
+        user = self._db.user.find_one({'_id': self._user_id})
+        self.assertEqual(['new-advice'], [a['adviceId'] for a in user['projects'][0]['advices']])
+        self.assertFalse(self._db.advice_module_versions.find_one({'_id': 'stable'}))
+
+    def test_extra_data_of_unchanged_advice(self):
+        """Extra data are only computed for added or rescored pieces of advice."""
+        model = mock.MagicMock()
+        model.score.return_value = scoring.ConstantScoreModel(2).score(None)
+        model.compute_extra_data.return_value = project_pb2.JobBoardsData(
+            job_board_title='Indeed')
+        self._db.advice_modules.update_one(
+            {'adviceId': 'stable'},
+            {'$set': {
+                'triggerScoringModel': 'extra-model',
+                'extraDataFieldName': 'job_boards_data',
+            }})
+        advisor.clear_cache()
+
+        with mock.patch.dict(scoring.SCORING_MODELS, {'extra-model': model}):
+            counts = update_advice.main(self._db, [])
+
+        self.assertEqual(0, counts[('stable', 'updated')])
+        self.assertFalse(model.compute_extra_data.called)
+
+        model.score.return_value = scoring.ConstantScoreModel(3).score(None)
+        with mock.patch.dict(scoring.SCORING_MODELS, {'extra-model': model}):
+            counts = update_advice.main(self._db, ['--scoring_models', 'extra-model'])
+
+        self.assertEqual(1, counts[('stable', 'updated')])
+        user = self._db.user.find_one({'_id': self._user_id})
+        self.assertEqual(
+            'Indeed', user['projects'][0]['advices'][0]['jobBoardsData']['jobBoardTitle'])
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
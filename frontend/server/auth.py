@@ -7,6 +7,8 @@ import hmac
 import json
 import logging
 import os
+import re
+import threading
 import time
 from urllib import parse
 
@@ -14,6 +16,7 @@ from bson import objectid
 import flask
 from oauth2client import client
 from oauth2client import crypt
+import requests
 
 from bob_emploi.frontend import mail
 from bob_emploi.frontend import proto
@@ -41,6 +44,173 @@ SECRET_SALT = os.getenv(
 # Validity of generated salt tokens.
 _SALT_VALIDITY_SECONDS = datetime.timedelta(hours=2).total_seconds()
 
+# Lifetime of Google's certificates if their response does not specify it.
+_GOOGLE_CERTS_DEFAULT_MAX_AGE_SECONDS = datetime.timedelta(hours=1).total_seconds()
+# Google's certificates are refreshed in the background when they are that
+# close to expire.
+_GOOGLE_CERTS_REFRESH_MARGIN_SECONDS = datetime.timedelta(minutes=10).total_seconds()
+# Minimum duration between two fetches triggered by tokens signed with an
+# unknown key, so that a flow of bad tokens does not turn into a flow of
+# calls to Google.
+_GOOGLE_CERTS_MIN_FETCH_INTERVAL_SECONDS = 60
+# Delay before fetching Google's certificates again after a failure, during
+# which the old certificates are used.
+_GOOGLE_CERTS_RETRY_DELAY_SECONDS = 60
+
+
+def _fetch_google_certs():
+    """Fetch the certificates used by Google to sign ID tokens.
+
+    Returns:
+        a tuple with a dict of crypt.Verifier keyed by ID of the signing key,
+        and the number of seconds they can be cached.
+    """
+    response = requests.get(client.ID_TOKEN_VERIFICATION_CERTS, timeout=10)
+    response.raise_for_status()
+    max_age = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+    return (
+        {
+            key_id: crypt.Verifier.from_string(cert, is_x509_cert=True)
+            for key_id, cert in response.json().items()
+        },
+        int(max_age.group(1)) if max_age else _GOOGLE_CERTS_DEFAULT_MAX_AGE_SECONDS,
+    )
+
+
+class GoogleCerts(object):
+    """An in-process cache of the certificates used by Google to sign ID tokens.
+
+    Certificates are kept as long as allowed by the HTTP cache headers of
+    Google's response and refreshed in a background thread before they
+    expire, so that logins do not wait for a call to Google.
+    """
+
+    def __init__(self, fetch=_fetch_google_certs, clock=time.time):
+        """Create an empty cache.
+
+        Args:
+            fetch: a function fetching the certificates, see _fetch_google_certs.
+            clock: a function returning the current time in seconds.
+        """
+        self._fetch = fetch
+        self._clock = clock
+        self._verifiers = {}
+        self._expires_at = 0
+        self._fetched_at = None
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+
+    def get_verifiers(self, key_id=None):
+        """Get the verifiers of Google's signatures.
+
+        Args:
+            key_id: the ID of the key that signed the token to verify, if known.
+        Returns:
+            a dict of crypt.Verifier keyed by ID of the signing key.
+        """
+        now = self._clock()
+        with self._lock:
+            verifiers = self._verifiers
+            expires_at = self._expires_at
+            fetched_at = self._fetched_at
+        if not verifiers or now >= expires_at:
+            return self._refresh(block_on_error=not verifiers)
+        if key_id and key_id not in verifiers and \
+                now - fetched_at >= _GOOGLE_CERTS_MIN_FETCH_INTERVAL_SECONDS:
+            # Google might have started signing with a new key.
+            return self._refresh(block_on_error=False)
+        if now >= expires_at - _GOOGLE_CERTS_REFRESH_MARGIN_SECONDS and \
+                now - fetched_at >= _GOOGLE_CERTS_RETRY_DELAY_SECONDS:
+            self._refresh_in_background()
+        return verifiers
+
+    def _refresh(self, block_on_error):
+        try:
+            verifiers, max_age = self._fetch()
+        except (IOError, ValueError) as error:
+            if block_on_error:
+                # Callers only handle IOError, e.g. if Google sent a broken
+                # response.
+                raise IOError("Could not fetch Google's certificates: %s" % error) from error
+            # Keep using the old certificates, rather than failing all logins,
+            # and do not try again on each login while Google is down.
+            logging.warning("Could not refresh Google's certificates: %s", error)
+            now = self._clock()
+            with self._lock:
+                self._fetched_at = now
+                self._expires_at = max(
+                    self._expires_at, now + _GOOGLE_CERTS_RETRY_DELAY_SECONDS)
+                return self._verifiers
+        now = self._clock()
+        with self._lock:
+            self._verifiers = verifiers
+            self._expires_at = now + max_age
+            self._fetched_at = now
+        return verifiers
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refresh_thread and self._refresh_thread.is_alive():
+                return
+            self._refresh_thread = threading.Thread(
+                target=self._refresh, kwargs={'block_on_error': False}, daemon=True)
+            self._refresh_thread.start()
+
+
+_GOOGLE_CERTS = GoogleCerts()
+
+
+def verify_google_id_token(token_id, audience=None, certs=None):
+    """Verify an ID token signed by Google without calling Google.
+
+    Args:
+        token_id: the signed JWT token.
+        audience: the client ID the token should be for, by default our own.
+        certs: the GoogleCerts to verify the signature, by default the ones
+            cached for the whole process.
+    Returns:
+        the payload of the token as a dict.
+    Raises:
+        crypt.AppIdentityError: if the token is not valid.
+        IOError: if Google's certificates could not be fetched or parsed, and
+            none were fetched before.
+    """
+    segments = token_id.encode('ascii', 'ignore').split(b'.')
+    if len(segments) != 3:
+        raise crypt.AppIdentityError('Wrong number of segments in token: %s' % token_id)
+    header, payload, signature = segments
+    try:
+        header_dict = json.loads(_base64_url_decode(header.decode('ascii')).decode('utf-8'))
+        payload_dict = json.loads(_base64_url_decode(payload.decode('ascii')).decode('utf-8'))
+        signature = _base64_url_decode(signature.decode('ascii'))
+    except ValueError as error:
+        raise crypt.AppIdentityError("Can't parse token: %s" % error)
+
+    key_id = header_dict.get('kid')
+    verifiers = (certs or _GOOGLE_CERTS).get_verifiers(key_id)
+    if key_id in verifiers:
+        verifiers = [verifiers[key_id]]
+    else:
+        verifiers = verifiers.values()
+    message = header + b'.' + payload
+    if not any(verifier.verify(message, signature) for verifier in verifiers):
+        raise crypt.AppIdentityError('Invalid token signature')
+
+    now = int(time.time())
+    issued_at = payload_dict.get('iat')
+    expiration = payload_dict.get('exp')
+    if issued_at is None or expiration is None:
+        raise crypt.AppIdentityError('No iat or exp field in token: %s' % payload_dict)
+    if expiration >= now + crypt.MAX_TOKEN_LIFETIME_SECS:
+        raise crypt.AppIdentityError('exp field too far in future: %s' % payload_dict)
+    if now < issued_at - crypt.CLOCK_SKEW_SECS:
+        raise crypt.AppIdentityError('Token used too early: %s' % payload_dict)
+    if now > expiration + crypt.CLOCK_SKEW_SECS:
+        raise crypt.AppIdentityError('Token used too late: %s' % payload_dict)
+    if payload_dict.get('aud') != (audience or GOOGLE_SSO_CLIENT_ID):
+        raise crypt.AppIdentityError('Wrong recipient: %s' % payload_dict.get('aud'))
+    return payload_dict
+
 
 class Authenticator(object):
     """An object to authenticate requests."""
@@ -61,9 +231,12 @@ class Authenticator(object):
 
     def _google_authenticate(self, token_id):
         try:
-            id_info = client.verify_id_token(token_id, GOOGLE_SSO_CLIENT_ID)
+            id_info = verify_google_id_token(token_id)
         except crypt.AppIdentityError as error:
             flask.abort(401, "Mauvais jeton d'authentification : %s" % error)
+        except IOError as error:
+            logging.error("Could not fetch Google's certificates: %s", error)
+            flask.abort(503, "Impossible de vérifier le jeton d'authentification.")
         if id_info.get('iss') not in _GOOGLE_SSO_ISSUERS:
             flask.abort(
                 401, "Fournisseur d'authentification invalide : %s." % id_info.get('iss', '<none>'))
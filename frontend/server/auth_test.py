@@ -10,6 +10,7 @@ from urllib import parse
 import mailjet_rest
 import mock
 from oauth2client import crypt
+import rsa
 
 from bob_emploi.frontend import auth
 from bob_emploi.frontend import base_test
@@ -213,7 +214,7 @@ class AuthenticateEndpointTestCase(base_test.ServerTestCase):
         self.assertEqual(1, len(url_args['resetToken']), msg=url_args)
         return url_args['resetToken'][0]
 
-    @mock.patch(server.__name__ + '.auth.client.verify_id_token')
+    @mock.patch(server.__name__ + '.auth.verify_google_id_token')
     def test_user_after_google_signup(self, mock_verify_id_token):
         """Trying to connect with a password a user registered with Google."""
         # Register user with Google (note that verify_id_token accepts any
@@ -381,7 +382,7 @@ class AuthenticateEndpointFacebookTestCase(base_test.ServerTestCase):
         self.assertEqual(user_id, returned_user.get('userId'))
 
 
-@mock.patch(server.__name__ + '.auth.client.verify_id_token')
+@mock.patch(server.__name__ + '.auth.verify_google_id_token')
 class AuthenticateEndpointGoogleTestCase(base_test.ServerTestCase):
     """Unit tests for the authenticate endpoint."""
 
@@ -533,5 +534,150 @@ class AuthenticateEndpointGoogleTestCase(base_test.ServerTestCase):
         self.assertEqual(user_id, returned_user.get('userId'))
 
 
+# A local stand-in for Google's signing key.
+_GOOGLE_PUBLIC_KEY, _GOOGLE_PRIVATE_KEY = rsa.newkeys(512)
+
+
+def _google_sign(payload, key_id='key-1', private_key=_GOOGLE_PRIVATE_KEY):
+    signer = crypt.RsaSigner.from_string(private_key.save_pkcs1())
+    return crypt.make_signed_jwt(signer, payload, key_id=key_id).decode('ascii')
+
+
+def _google_payload(**kwargs):
+    now = int(time.time())
+    return dict({
+        'aud': auth.GOOGLE_SSO_CLIENT_ID,
+        'email': 'pascal@bayes.org',
+        'exp': now + 3600,
+        'iat': now,
+        'iss': 'accounts.google.com',
+        'sub': '12345',
+    }, **kwargs)
+
+
+class VerifyGoogleIdTokenTestCase(unittest.TestCase):
+    """Unit tests for the verify_google_id_token function."""
+
+    def setUp(self):
+        super(VerifyGoogleIdTokenTestCase, self).setUp()
+        self.fetch = mock.MagicMock(return_value=(
+            {'key-1': crypt.RsaVerifier(_GOOGLE_PUBLIC_KEY)}, 3600))
+        self.certs = auth.GoogleCerts(fetch=self.fetch)
+
+    def test_valid_token(self):
+        """A valid token is verified with the cached certificates."""
+        for unused_i in range(3):
+            id_info = auth.verify_google_id_token(
+                _google_sign(_google_payload()), certs=self.certs)
+            self.assertEqual('12345', id_info['sub'])
+        self.assertEqual(1, self.fetch.call_count)
+
+    def test_bad_signature(self):
+        """A token signed by another key is rejected."""
+        unused_public_key, other_private_key = rsa.newkeys(512)
+        token = _google_sign(_google_payload(), private_key=other_private_key)
+        with self.assertRaises(crypt.AppIdentityError):
+            auth.verify_google_id_token(token, certs=self.certs)
+
+    def test_expired_token(self):
+        """An expired token is rejected."""
+        token = _google_sign(_google_payload(exp=int(time.time()) - 3600))
+        with self.assertRaises(crypt.AppIdentityError):
+            auth.verify_google_id_token(token, certs=self.certs)
+
+    def test_wrong_audience(self):
+        """A token for another app is rejected."""
+        token = _google_sign(_google_payload(aud='other-app'))
+        with self.assertRaises(crypt.AppIdentityError):
+            auth.verify_google_id_token(token, certs=self.certs)
+
+    def test_malformed_token(self):
+        """A token that is not a JWT is rejected without fetching certificates."""
+        with self.assertRaises(crypt.AppIdentityError):
+            auth.verify_google_id_token('my-token', certs=self.certs)
+        self.assertFalse(self.fetch.called)
+
+
+class GoogleCertsTestCase(unittest.TestCase):
+    """Unit tests for the GoogleCerts class."""
+
+    def setUp(self):
+        super(GoogleCertsTestCase, self).setUp()
+        self.now = 1000
+        self.fetch = mock.MagicMock(return_value=({'key-1': 'verifier-1'}, 3600))
+        self.certs = auth.GoogleCerts(fetch=self.fetch, clock=lambda: self.now)
+
+    def test_cache_lifetime(self):
+        """Certificates are fetched again once they expire."""
+        self.assertEqual({'key-1': 'verifier-1'}, self.certs.get_verifiers())
+        self.now += 600
+        self.certs.get_verifiers()
+        self.assertEqual(1, self.fetch.call_count)
+
+        self.fetch.return_value = ({'key-2': 'verifier-2'}, 3600)
+        self.now += 3600
+        self.assertEqual({'key-2': 'verifier-2'}, self.certs.get_verifiers())
+        self.assertEqual(2, self.fetch.call_count)
+
+    def test_background_refresh(self):
+        """Certificates about to expire are refreshed in the background."""
+        self.certs.get_verifiers()
+        self.fetch.return_value = ({'key-2': 'verifier-2'}, 3600)
+        self.now += 3500
+
+        self.assertEqual({'key-1': 'verifier-1'}, self.certs.get_verifiers())
+        self.certs._refresh_thread.join()  # pylint: disable=protected-access
+        self.assertEqual({'key-2': 'verifier-2'}, self.certs.get_verifiers())
+
+    def test_unknown_key(self):
+        """Certificates are fetched again for an unknown key, but not too often."""
+        self.certs.get_verifiers()
+        self.fetch.return_value = ({'key-2': 'verifier-2'}, 3600)
+
+        self.assertEqual({'key-1': 'verifier-1'}, self.certs.get_verifiers('key-2'))
+        self.now += 60
+        self.assertEqual({'key-2': 'verifier-2'}, self.certs.get_verifiers('key-2'))
+        self.assertEqual(2, self.fetch.call_count)
+
+    def test_fetch_error(self):
+        """Old certificates are kept if Google cannot be reached."""
+        self.certs.get_verifiers()
+        self.fetch.side_effect = IOError('Google is down')
+        self.now += 3600
+
+        self.assertEqual({'key-1': 'verifier-1'}, self.certs.get_verifiers())
+
+    def test_fetch_error_retry_delay(self):
+        """Google is not called again on each login after a failed fetch."""
+        self.certs.get_verifiers()
+        self.fetch.side_effect = IOError('Google is down')
+        self.now += 3600
+        self.certs.get_verifiers()
+        self.assertEqual(2, self.fetch.call_count)
+
+        self.now += 30
+        self.assertEqual({'key-1': 'verifier-1'}, self.certs.get_verifiers())
+        self.assertEqual({'key-1': 'verifier-1'}, self.certs.get_verifiers('key-2'))
+        self.assertEqual(2, self.fetch.call_count)
+
+        self.fetch.side_effect = None
+        self.fetch.return_value = ({'key-2': 'verifier-2'}, 3600)
+        self.now += 30
+        self.assertEqual({'key-2': 'verifier-2'}, self.certs.get_verifiers('key-2'))
+        self.assertEqual(3, self.fetch.call_count)
+
+    def test_first_fetch_error(self):
+        """Errors are raised when there are no certificates yet."""
+        self.fetch.side_effect = IOError('Google is down')
+        with self.assertRaises(IOError):
+            self.certs.get_verifiers()
+
+    def test_first_fetch_invalid(self):
+        """Invalid certificates are reported as an IOError."""
+        self.fetch.side_effect = ValueError('Not JSON')
+        with self.assertRaises(IOError):
+            self.certs.get_verifiers()
+
+
 if __name__ == '__main__':
     unittest.main()  # pragma: no cover
@@ -8,6 +8,7 @@ import mock
 import mongomock
 
 from bob_emploi.frontend import action
+from bob_emploi.frontend import relocation
 from bob_emploi.frontend import server
 
 
@@ -29,6 +30,7 @@ class ServerTestCase(unittest.TestCase):
         server._JOB_GROUPS_INFO = {}  # pylint: disable=protected-access
         server._CHANTIERS = {}  # pylint: disable=protected-access
         action.clear_cache()
+        relocation.clear_cache()
 
         self.app = server.app.test_client()
         self._db = mongomock.MongoClient().get_database('test')
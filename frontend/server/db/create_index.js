@@ -1,4 +1,9 @@
 /* eslint-env mongo */
+// Keep in sync with the INDEXES of frontend/server/indexes.py.
 db.user.createIndex('facebookId')
 db.user.createIndex('googleId')
 db.user.createIndex('profile.email')
+db.user.createIndex(
+  {'featuresEnabled.advisor': 1, _id: 1},
+  {name: 'advisor_users', partialFilterExpression: {'featuresEnabled.advisor': 'ACTIVE'}})
+db.mailing_eligibility.createIndex({campaigns: 1, _id: 1})
@@ -0,0 +1,183 @@
+"""Indexes of the database and the queries that need them.
+
+Each query issued by the server or the batch jobs on a large collection is
+declared here with sample values, along with the indexes it needs. The
+apply function creates the indexes and the check function runs explain on
+each query to make sure that none of them scans a whole collection.
+
+Collections that are always read entirely (e.g. to populate a cache) are not
+listed here.
+"""
+import collections
+
+import pymongo
+
+# An index on a collection: keys is a list of (field, direction) as in
+# pymongo, and options are passed to create_index.
+Index = collections.namedtuple('Index', ['collection', 'keys', 'options'])
+
+# A query issued on a collection, with a sample value for each of its
+# parameters, and its sort order if any.
+QueryShape = collections.namedtuple('QueryShape', ['name', 'collection', 'query', 'sort'])
+
+_ASC = pymongo.ASCENDING
+
+INDEXES = (
+    Index('user', [('facebookId', _ASC)], {}),
+    Index('user', [('googleId', _ASC)], {}),
+    Index('user', [('profile.email', _ASC)], {}),
+    # Only the users of the Advisor are scanned by the update_advice job.
+    Index('user', [('featuresEnabled.advisor', _ASC), ('_id', _ASC)], {
+        'name': 'advisor_users',
+        'partialFilterExpression': {'featuresEnabled.advisor': 'ACTIVE'},
+    }),
+    # The blasts select their users by campaign in the order of their _id.
+    Index('mailing_eligibility', [('campaigns', _ASC), ('_id', _ASC)], {}),
+)
+
+_SAMPLE_ID = 'abcdef0123456789abcdef01'
+
+QUERY_SHAPES = (
+    # Authentication.
+    QueryShape('user_by_facebook_id', 'user', {'facebookId': '1234'}, None),
+    QueryShape('user_by_google_id', 'user', {'googleId': '1234'}, None),
+    QueryShape('user_by_email', 'user', {'profile.email': 'pascal@example.com'}, None),
+    QueryShape('user_auth_by_id', 'user_auth', {'_id': _SAMPLE_ID}, None),
+    # Users.
+    QueryShape('user_by_id', 'user', {'_id': _SAMPLE_ID}, None),
+    QueryShape('users_by_ids', 'user', {'_id': {'$in': [_SAMPLE_ID]}}, [('_id', _ASC)]),
+    QueryShape('dashboard_export_by_id', 'dashboard_exports', {'_id': _SAMPLE_ID}, None),
+    QueryShape('feedback_by_id', 'feedbacks', {'_id': _SAMPLE_ID}, None),
+    # Market stats of a project.
+    QueryShape('local_diagnosis_by_id', 'local_diagnosis', {'_id': '69123:A1234'}, None),
+    QueryShape(
+        'local_diagnoses_by_ids', 'local_diagnosis', {'_id': {'$in': ['69123:A1234']}}, None),
+    QueryShape('local_market_scores_by_id', 'local_market_scores', {'_id': '69123:A1234'}, None),
+    QueryShape(
+        'recent_job_offers_by_ids', 'recent_job_offers', {'_id': {'$in': ['69123:A1234']}},
+        None),
+    QueryShape('job_group_info_by_id', 'job_group_info', {'_id': 'A1234'}, None),
+    QueryShape('unverified_data_zone_by_id', 'unverified_data_zones', {'_id': 'abc123'}, None),
+    # Blasts.
+    QueryShape(
+        'advice_blast', 'mailing_eligibility',
+        {'campaigns': 'advice-MONDAY', 'nextEligibleAt.advice': {'$lte': 'now'}},
+        [('_id', _ASC)]),
+    QueryShape(
+        'advice_blast_shard', 'mailing_eligibility',
+        {'$and': [
+            {'campaigns': 'advice-MONDAY', 'nextEligibleAt.advice': {'$lte': 'now'}},
+            {'_id': {'$gt': _SAMPLE_ID}},
+        ]},
+        [('_id', _ASC)]),
+    QueryShape(
+        'nps_blast', 'mailing_eligibility',
+        {'campaigns': 'nps', 'nextEligibleAt.nps': {'$lte': 'registered_before'}},
+        [('_id', _ASC)]),
+    QueryShape('blast_run_by_id', 'blast_runs', {'_id': 'advice-2017-03-06'}, None),
+    QueryShape(
+        'email_stats_by_emails', 'email_stats', {'_id': {'$in': ['pascal@example.com']}}, None),
+    QueryShape('email_histories_by_ids', 'email_history', {'_id': {'$in': [_SAMPLE_ID]}}, None),
+    QueryShape(
+        'advisor_users', 'user',
+        {'featuresEnabled.advisor': 'ACTIVE', 'projects.advices': {'$exists': True}},
+        [('_id', _ASC)]),
+)
+
+
+def apply(database):
+    """Create the declared indexes.
+
+    It can be run several times: existing indexes are left untouched.
+
+    Args:
+        database: the database to create the indexes in.
+    Returns:
+        the names of the indexes, by collection.
+    """
+    index_models = collections.defaultdict(list)
+    for index in INDEXES:
+        index_models[index.collection].append(pymongo.IndexModel(index.keys, **index.options))
+    return {
+        collection: database[collection].create_indexes(models)
+        for collection, models in index_models.items()
+    }
+
+
+def check(database):
+    """Check that none of the declared queries scans a whole collection.
+
+    Args:
+        database: the database to run the queries on, with its indexes.
+    Returns:
+        the names of the queries doing a collection scan.
+    """
+    return [
+        shape.name for shape in QUERY_SHAPES
+        if has_collection_scan(_explain(database, shape))
+    ]
+
+
+def _explain(database, shape):
+    cursor = database[shape.collection].find(shape.query)
+    if shape.sort:
+        cursor = cursor.sort(shape.sort)
+    return cursor.explain()
+
+
+def has_collection_scan(explanation):
+    """Check whether the winning plan of a query scans a whole collection.
+
+    Args:
+        explanation: the result of explain on a cursor.
+    """
+    return _has_stage(explanation.get('queryPlanner', {}).get('winningPlan', {}), 'COLLSCAN')
+
+
+def _has_stage(plan, stage):
+    if isinstance(plan, list):
+        return any(_has_stage(child, stage) for child in plan)
+    if not isinstance(plan, dict):
+        return False
+    if plan.get('stage') == stage:
+        return True
+    return any(
+        _has_stage(child, stage) for child in plan.values() if isinstance(child, (dict, list)))
+
+
+def find_index(shape):
+    """Find the index that should serve a query, without running it.
+
+    This only checks that the first field of an index is constrained by the
+    query: use check on a real database to make sure the index is used.
+
+    Args:
+        shape: a QueryShape.
+    Returns:
+        the declared Index, None if the query only needs the _id index, or
+        False if there is no index for the query.
+    """
+    fields = _query_fields(shape.query)
+    if '_id' in fields:
+        return None
+    for index in INDEXES:
+        if index.collection != shape.collection:
+            continue
+        first_field = index.keys[0][0]
+        if first_field not in fields:
+            continue
+        partial_filter = index.options.get('partialFilterExpression', {})
+        if all(shape.query.get(key) == value for key, value in partial_filter.items()):
+            return index
+    return False
+
+
+def _query_fields(query):
+    fields = set()
+    for key, value in query.items():
+        if key == '$and':
+            for sub_query in value:
+                fields |= _query_fields(sub_query)
+        elif not key.startswith('$'):
+            fields.add(key)
+    return fields
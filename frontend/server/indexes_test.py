@@ -0,0 +1,62 @@
+"""Unit tests for the bob_emploi.frontend.indexes module."""
+import unittest
+
+import mock
+import mongomock
+
+from bob_emploi.frontend import indexes
+
+
+class IndexesTestCase(unittest.TestCase):
+    """Unit tests for the declared indexes."""
+
+    def test_all_queries_have_an_index(self):
+        """All the declared queries have an index."""
+        missing = [
+            shape.name for shape in indexes.QUERY_SHAPES if indexes.find_index(shape) is False]
+        self.assertFalse(missing)
+
+    def test_partial_index(self):
+        """A partial index is only found for queries matching its filter."""
+        shape = indexes.QueryShape(
+            'all_users', 'user', {'featuresEnabled.advisor': {'$exists': True}}, None)
+        self.assertIs(False, indexes.find_index(shape))
+
+    def test_apply_twice(self):
+        """Indexes can be created several times."""
+        database = mongomock.MongoClient().database
+        indexes.apply(database)
+        names = indexes.apply(database)
+
+        self.assertIn('advisor_users', names['user'])
+        self.assertEqual(
+            set(names['user']) | {'_id_'}, set(database.user.index_information()))
+
+
+class CheckTestCase(unittest.TestCase):
+    """Unit tests for the check function."""
+
+    def test_collection_scan(self):
+        """Queries whose winning plan scans a collection are reported."""
+        database = mock.MagicMock()
+        database.__getitem__.return_value.find.return_value.sort.return_value.explain.\
+            return_value = {'queryPlanner': {'winningPlan': {
+                'stage': 'SORT', 'inputStage': {'stage': 'COLLSCAN'}}}}
+        database.__getitem__.return_value.find.return_value.explain.return_value = {
+            'queryPlanner': {'winningPlan': {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}}}}
+
+        collection_scans = indexes.check(database)
+
+        self.assertEqual(
+            [shape.name for shape in indexes.QUERY_SHAPES if shape.sort], collection_scans)
+
+    def test_has_collection_scan(self):
+        """Collection scans are found anywhere in the winning plan."""
+        self.assertTrue(indexes.has_collection_scan({'queryPlanner': {'winningPlan': {
+            'stage': 'OR', 'inputStages': [{'stage': 'IXSCAN'}, {'stage': 'COLLSCAN'}]}}}))
+        self.assertFalse(indexes.has_collection_scan({'queryPlanner': {'winningPlan': {
+            'stage': 'IDHACK'}}}))
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
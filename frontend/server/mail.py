@@ -17,26 +17,67 @@ _ADMIN_EMAILS = os.getenv('ADMIN_EMAILS', 'Pascal Corpet <pascal@bayes.org>')
 _FakeResponse = collections.namedtuple('FakeResponse', [
     'status_code', 'raise_for_status', 'text'])
 
+# Result of sending one message in a batch: error is None if MailJet accepted
+# the message.
+SendResult = collections.namedtuple('SendResult', ['message_id', 'error'])
+
+# Maximum number of messages sent in a single call to the MailJet Send API.
+_MAX_MESSAGES_PER_CALL = 50
+
 
 def _mailjet_client():
     return mailjet_rest.Client(auth=(_MAILJET_APIKEY_PUBLIC, _MAILJET_SECRET))
 
 
-def count_sent_to(email):
-    """Count number of emails sent to a given user.
+def _template_message(template_id, recipient, template_vars, monitoring_category=None):
+    data = {
+        'MJ-TemplateID': template_id,
+        'MJ-TemplateLanguage': True,
+        'MJ-TemplateErrorReporting': _ADMIN_EMAILS,
+        'FromEmail': _MAIL_SENDER_EMAIL,
+        'FromName': _MAIL_SENDER_NAME,
+        'Vars': template_vars,
+        'Recipients': [{
+            'Email': recipient.email,
+            'Name': '%s %s' % (recipient.name, recipient.last_name),
+        }],
+    }
+    if monitoring_category:
+        data['MonitoringCategory'] = monitoring_category,
+    return data
+
+
+def iterate_contacts_statistics(page_size=1000):
+    """Iterate over the statistics of all the contacts in MailJet.
 
     Args:
-        email: the user's email.
-    Returns:
-        a dict with counts: DeliveredCount, OpenedCount, ClickedCount.
-        See full doc at https://dev.mailjet.com/email-api/v3/contactstatistics
+        page_size: the number of contacts fetched in each call to MailJet.
+    Yields:
+        tuples with the email of a contact and a dict with its counts:
+        DeliveredCount, OpenedCount, ClickedCount. See full doc at
+        https://dev.mailjet.com/email-api/v3/contactstatistics
     """
     mail_client = _mailjet_client()
-    result = mail_client.contactstatistics.get(email)
-    if result.status_code == 404:
-        return collections.defaultdict(int)
-    result.raise_for_status()
-    return result.json()['Data'][0]
+    # Statistics only refer to contacts by their IDs.
+    emails = {
+        contact['ID']: contact['Email']
+        for contact in _iterate_pages(mail_client.contact, page_size)}
+    for stats in _iterate_pages(mail_client.contactstatistics, page_size):
+        email = emails.get(stats.get('ContactID'))
+        if email:
+            yield email, stats
+
+
+def _iterate_pages(endpoint, page_size):
+    offset = 0
+    while True:
+        result = endpoint.get(filters={'Limit': page_size, 'Offset': offset})
+        result.raise_for_status()
+        data = result.json()['Data']
+        yield from data
+        if len(data) < page_size:
+            return
+        offset += page_size
 
 
 def send_template(template_id, recipient, template_vars, dry_run=False, monitoring_category=None):
@@ -51,26 +92,77 @@ def send_template(template_id, recipient, template_vars, dry_run=False, monitori
         monitoring_category: see http://hello.mailjet.com/monitoring-beta/
     """
     mail_client = _mailjet_client()
-    data = {
-        'MJ-TemplateID': template_id,
-        'MJ-TemplateLanguage': True,
-        'MJ-TemplateErrorReporting': _ADMIN_EMAILS,
-        'FromEmail': _MAIL_SENDER_EMAIL,
-        'FromName': _MAIL_SENDER_NAME,
-        'Vars': template_vars,
-        'Recipients': [{
-            'Email': recipient.email,
-            'Name': '%s %s' % (recipient.name, recipient.last_name),
-        }],
-    }
-    if monitoring_category:
-        data['MonitoringCategory'] = monitoring_category,
+    data = _template_message(template_id, recipient, template_vars, monitoring_category)
     if dry_run:
         logging.info(data)
         return _FakeResponse(status_code=200, raise_for_status=lambda: None, text='OK')
     return mail_client.send.create(data=data)
 
 
+def send_template_batch(
+        template_id, messages, dry_run=False, monitoring_category=None,
+        batch_size=_MAX_MESSAGES_PER_CALL):
+    """Send many emails using the same template, with as few calls as possible.
+
+    Args:
+        template_id: the ID of the template in MailJet, see
+            https://app.mailjet.com/templates/transactional.
+        messages: a list of (recipient, template_vars) pairs, see the args of
+            send_template.
+        dry_run: if True, emails are sent to the admins, not to the recipient.
+        monitoring_category: see http://hello.mailjet.com/monitoring-beta/
+        batch_size: the maximum number of messages to send in one call.
+    Returns:
+        a list of SendResult, one for each message in the same order.
+    """
+    mail_client = None if dry_run else _mailjet_client()
+    results = []
+    for start in range(0, len(messages), batch_size):
+        batch = [
+            _template_message(template_id, recipient, template_vars, monitoring_category)
+            for recipient, template_vars in messages[start:start + batch_size]]
+        if dry_run:
+            logging.info(batch)
+            results.extend(SendResult(message_id=None, error=None) for unused_data in batch)
+            continue
+        results.extend(_send_batch(mail_client, batch))
+    return results
+
+
+def _send_batch(mail_client, batch):
+    try:
+        response = mail_client.send.create(data={'Messages': batch})
+        if 400 <= response.status_code < 500 and len(batch) > 1:
+            # A single invalid message makes MailJet reject the whole call:
+            # split the batch so that only the invalid message fails.
+            middle = len(batch) // 2
+            return _send_batch(mail_client, batch[:middle]) + _send_batch(
+                mail_client, batch[middle:])
+        response.raise_for_status()
+        sent = response.json().get('Sent', [])
+    except (IOError, ValueError) as error:
+        # The whole call failed, so none of its messages were sent.
+        logging.error('Error while sending %d emails: %s', len(batch), error)
+        return [SendResult(message_id=None, error=str(error)) for unused_data in batch]
+
+    # MailJet lists the messages it accepted with their recipient: match them
+    # back with the messages of the batch. MailJet may change the case of the
+    # email addresses.
+    message_ids = collections.defaultdict(collections.deque)
+    for sent_message in sent:
+        message_ids[sent_message.get('Email', '').lower()].append(sent_message.get('MessageID'))
+    results = []
+    for data in batch:
+        email = data['Recipients'][0]['Email']
+        if message_ids[email.lower()]:
+            results.append(SendResult(
+                message_id=message_ids[email.lower()].popleft(), error=None))
+        else:
+            results.append(SendResult(
+                message_id=None, error='Email to %s was not accepted by MailJet' % email))
+    return results
+
+
 def send_template_to_admins(template_id, template_vars):
     """Send an email to admins using a template.
 
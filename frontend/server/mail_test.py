@@ -0,0 +1,194 @@
+"""Unit tests for the bob_emploi.frontend.mail module."""
+import unittest
+
+import mock
+import requests
+
+from bob_emploi.frontend import mail
+from bob_emploi.frontend.api import user_pb2
+
+
+class _FakeMailjetResponse(object):
+
+    def __init__(self, status_code, json_data):
+        self.status_code = status_code
+        self._json_data = json_data
+
+    def json(self):
+        """Content of the response."""
+        return self._json_data
+
+    def raise_for_status(self):
+        """Raise an error if the call was not successful."""
+        if self.status_code != 200:
+            raise requests.HTTPError('%d Error' % self.status_code)
+
+
+class _FakeMailjetSendEndpoint(object):
+    """A local fake for the MailJet Send API, accepting batches of messages."""
+
+    def __init__(self):
+        self.calls = []
+        self.rejected_emails = set()
+        self.invalid_emails = set()
+        self.status_code = 200
+
+    def create(self, data):
+        """Send one or several messages."""
+        self.calls.append(data)
+        if self.status_code != 200:
+            return _FakeMailjetResponse(self.status_code, {})
+        messages = data.get('Messages', [data])
+        if any(m['Recipients'][0]['Email'] in self.invalid_emails for m in messages):
+            return _FakeMailjetResponse(400, {})
+        sent = [
+            {
+                'Email': message['Recipients'][0]['Email'].lower(),
+                'MessageID': len(self.calls) * 1000 + i,
+            }
+            for i, message in enumerate(messages)
+            if message['Recipients'][0]['Email'] not in self.rejected_emails]
+        return _FakeMailjetResponse(200, {'Sent': sent})
+
+
+class _FakeMailjetListEndpoint(object):
+    """A local fake for a MailJet API endpoint listing items by pages."""
+
+    def __init__(self, items):
+        self.items = items
+        self.calls = []
+
+    def get(self, filters):
+        """List a page of items."""
+        self.calls.append(filters)
+        offset = filters.get('Offset', 0)
+        page = self.items[offset:offset + filters.get('Limit', 10)]
+        return _FakeMailjetResponse(200, {'Count': len(page), 'Data': page})
+
+
+def _profile(email):
+    return user_pb2.UserProfile(email=email, name='Pascal', last_name='Corpet')
+
+
+class SendTemplateBatchTestCase(unittest.TestCase):
+    """Unit tests for the send_template_batch function."""
+
+    def setUp(self):
+        super(SendTemplateBatchTestCase, self).setUp()
+        self._endpoint = _FakeMailjetSendEndpoint()
+        patcher = mock.patch(mail.__name__ + '._mailjet_client')
+        mock_client = patcher.start()
+        self.addCleanup(patcher.stop)
+        mock_client.return_value.send = self._endpoint
+
+    def test_one_call(self):
+        """Messages are sent in one call to MailJet."""
+        results = mail.send_template_batch('123', [
+            (_profile('a@example.com'), {'name': 'A'}),
+            (_profile('b@example.com'), {'name': 'B'}),
+        ], monitoring_category='daily')
+
+        self.assertEqual(1, len(self._endpoint.calls))
+        messages = self._endpoint.calls[0]['Messages']
+        self.assertEqual(
+            ['a@example.com', 'b@example.com'],
+            [m['Recipients'][0]['Email'] for m in messages])
+        self.assertEqual([{'name': 'A'}, {'name': 'B'}], [m['Vars'] for m in messages])
+        self.assertEqual(['123', '123'], [m['MJ-TemplateID'] for m in messages])
+        self.assertEqual([1000, 1001], [r.message_id for r in results])
+        self.assertEqual([None, None], [r.error for r in results])
+
+    def test_batch_size(self):
+        """Messages are split in several calls if there are too many."""
+        results = mail.send_template_batch(
+            '123', [(_profile('%d@example.com' % i), {}) for i in range(5)], batch_size=2)
+
+        self.assertEqual([2, 2, 1], [len(c['Messages']) for c in self._endpoint.calls])
+        self.assertEqual(5, len(results))
+        self.assertFalse(any(r.error for r in results))
+
+    def test_rejected_message(self):
+        """Messages not accepted by MailJet get an error."""
+        self._endpoint.rejected_emails.add('b@example.com')
+        results = mail.send_template_batch('123', [
+            (_profile('a@example.com'), {}),
+            (_profile('b@example.com'), {}),
+            (_profile('c@example.com'), {}),
+        ])
+
+        self.assertEqual([1000, None, 1002], [r.message_id for r in results])
+        self.assertFalse(results[0].error)
+        self.assertIn('b@example.com', results[1].error)
+        self.assertFalse(results[2].error)
+
+    def test_same_recipient(self):
+        """Several messages to the same recipient are all mapped."""
+        results = mail.send_template_batch('123', [
+            (_profile('a@example.com'), {'index': 0}),
+            (_profile('a@example.com'), {'index': 1}),
+        ])
+
+        self.assertEqual([1000, 1001], [r.message_id for r in results])
+
+    def test_email_case(self):
+        """Messages are mapped even if MailJet changes the case of the email."""
+        results = mail.send_template_batch('123', [(_profile('Pascal@Example.com'), {})])
+
+        self.assertEqual([1000], [r.message_id for r in results])
+
+    def test_failed_call(self):
+        """All messages of a failing call get an error."""
+        self._endpoint.status_code = 500
+        results = mail.send_template_batch('123', [
+            (_profile('a@example.com'), {}),
+            (_profile('b@example.com'), {}),
+        ])
+
+        self.assertEqual(['500 Error', '500 Error'], [r.error for r in results])
+
+    def test_invalid_message(self):
+        """An invalid message does not prevent the others of its batch to be sent."""
+        self._endpoint.invalid_emails.add('c@example.com')
+        results = mail.send_template_batch(
+            '123', [(_profile('%s@example.com' % name), {}) for name in 'abcd'])
+
+        self.assertEqual(
+            [False, False, True, False], [r.message_id is None for r in results])
+        self.assertEqual('400 Error', results[2].error)
+        self.assertEqual([4, 2, 2, 1, 1], [len(c['Messages']) for c in self._endpoint.calls])
+
+    def test_dry_run(self):
+        """Nothing is sent during a dry run."""
+        results = mail.send_template_batch(
+            '123', [(_profile('a@example.com'), {})], dry_run=True)
+
+        self.assertFalse(self._endpoint.calls)
+        self.assertEqual([None], [r.error for r in results])
+
+
+class IterateContactsStatisticsTestCase(unittest.TestCase):
+    """Unit tests for the iterate_contacts_statistics function."""
+
+    @mock.patch(mail.__name__ + '._mailjet_client')
+    def test_all_pages(self, mock_client):
+        """Statistics are fetched by pages and matched with the contacts' emails."""
+        mock_client.return_value.contact = _FakeMailjetListEndpoint([
+            {'ID': i, 'Email': '%d@example.com' % i} for i in range(5)])
+        mock_client.return_value.contactstatistics = _FakeMailjetListEndpoint(
+            [{'ContactID': i, 'DeliveredCount': i, 'OpenedCount': 1} for i in range(5)] +
+            [{'ContactID': 404, 'DeliveredCount': 1}])
+
+        stats = dict(mail.iterate_contacts_statistics(page_size=2))
+
+        self.assertEqual(
+            ['%d@example.com' % i for i in range(5)], sorted(stats))
+        self.assertEqual(3, stats['3@example.com']['DeliveredCount'])
+        self.assertEqual(
+            [0, 2, 4], [f['Offset'] for f in mock_client.return_value.contact.calls])
+        self.assertEqual(
+            [0, 2, 4, 6],
+            [f['Offset'] for f in mock_client.return_value.contactstatistics.calls])
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
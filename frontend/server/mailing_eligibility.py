@@ -0,0 +1,187 @@
+"""Index of the users that can receive each email campaign.
+
+The mailing_eligibility collection has a small document for each user that
+can receive at least one of our email campaigns:
+{
+    _id: the _id of the user,
+    campaigns: ['advice-MONDAY', 'advice-FRIDAY', 'nps'],
+    nextEligibleAt: {advice: datetime, nps: datetime},
+}
+
+The blasts select their users from this collection instead of scanning the
+user collection. It is kept up to date when users are saved and after each
+email sent: run the rebuild function to fill it from scratch.
+"""
+import datetime
+
+import pymongo
+
+from bob_emploi.frontend import proto
+from bob_emploi.frontend.api import user_pb2
+
+# Minimum duration between two advice emails.
+ADVICE_COOL_DOWN_TIME = datetime.timedelta(hours=20)
+
+# The campaign of the NPS email.
+NPS_CAMPAIGN = 'nps'
+
+# Fields of the users needed to compute their eligibility.
+_USER_PROJECTION = proto.mongo_projection(user_pb2.User, (
+    'features_enabled.advisor_email',
+    'features_enabled.net_promoter_score_email',
+    'last_email_sent_at',
+    'profile.email_days',
+    'projects.advices.score',
+    'registered_at',
+))
+
+# Number of documents written at once when rebuilding the collection.
+_WRITE_BATCH_SIZE = 1000
+
+
+def advice_campaign(weekday):
+    """Get the campaign of the advice emails sent on a given day.
+
+    Args:
+        weekday: a user_pb2.WeekDay value.
+    """
+    return 'advice-%s' % user_pb2.WeekDay.Name(weekday)
+
+
+_ADVICE_CAMPAIGNS = [
+    advice_campaign(weekday) for weekday in user_pb2.WeekDay.values()
+    if weekday != user_pb2.UNKNOWN_DAY]
+
+
+def get_eligibility(user):
+    """Compute the eligibility document of a user.
+
+    Args:
+        user: a User proto.
+    Returns:
+        the document to store in the mailing_eligibility collection, without
+        its _id, or None if the user cannot receive any campaign.
+    """
+    campaigns = []
+    next_eligible_at = {}
+    has_scored_advice = any(
+        advice.score > 0 for project in user.projects for advice in project.advices)
+    if user.features_enabled.advisor_email == user_pb2.ACTIVE and has_scored_advice:
+        campaigns.extend(sorted(set(
+            advice_campaign(weekday) for weekday in user.profile.email_days
+            if weekday != user_pb2.UNKNOWN_DAY)))
+        next_eligible_at['advice'] = \
+            user.last_email_sent_at.ToDatetime() + ADVICE_COOL_DOWN_TIME
+    if user.features_enabled.net_promoter_score_email == user_pb2.NPS_EMAIL_PENDING and \
+            user.projects:
+        campaigns.append(NPS_CAMPAIGN)
+        # The delay before sending the NPS email is a parameter of the blast:
+        # it compares it to the registration date.
+        next_eligible_at[NPS_CAMPAIGN] = user.registered_at.ToDatetime()
+    if not campaigns:
+        return None
+    return {'campaigns': campaigns, 'nextEligibleAt': next_eligible_at}
+
+
+def update(collection, user_id, user):
+    """Update the eligibility of a user after it was saved.
+
+    Args:
+        collection: the mailing_eligibility collection.
+        user_id: the _id of the user.
+        user: the User proto as saved in the database.
+    """
+    eligibility = get_eligibility(user)
+    if eligibility:
+        collection.replace_one({'_id': user_id}, eligibility, upsert=True)
+    else:
+        collection.delete_one({'_id': user_id})
+
+
+def record_advice_sent(writer, user_id, sent_at):
+    """Record that an advice email was sent to a user.
+
+    Args:
+        writer: the mailing_eligibility collection or a blast.BulkWriter for it.
+        user_id: the _id of the user.
+        sent_at: the time the email was sent.
+    """
+    writer.update_one(
+        {'_id': user_id}, {'$set': {'nextEligibleAt.advice': sent_at + ADVICE_COOL_DOWN_TIME}})
+
+
+def record_advice_stopped(writer, user_id):
+    """Record that a user does not get advice emails anymore."""
+    writer.update_one(
+        {'_id': user_id},
+        {'$pullAll': {'campaigns': _ADVICE_CAMPAIGNS}, '$unset': {'nextEligibleAt.advice': ''}})
+
+
+def record_nps_sent(writer, user_id):
+    """Record that the NPS email was sent to a user."""
+    writer.update_one(
+        {'_id': user_id},
+        {'$pull': {'campaigns': NPS_CAMPAIGN}, '$unset': {'nextEligibleAt.nps': ''}})
+
+
+def iterate_users(database, eligibility_query, projection, batch_size=200):
+    """Iterate over the users selected in the mailing_eligibility collection.
+
+    Args:
+        database: the database with the user and mailing_eligibility
+            collections.
+        eligibility_query: the query on the mailing_eligibility collection.
+        projection: the projection of the user documents.
+        batch_size: the number of users fetched at once.
+    Yields:
+        the documents of the selected users in the order of their _id.
+    """
+    batch = []
+    for document in database.mailing_eligibility.find(
+            eligibility_query, {'_id': 1}, sort=[('_id', pymongo.ASCENDING)]):
+        batch.append(document['_id'])
+        if len(batch) >= batch_size:
+            for user in _find_users(database, batch, projection):
+                yield user
+            batch = []
+    for user in _find_users(database, batch, projection):
+        yield user
+
+
+def _find_users(database, user_ids, projection):
+    if not user_ids:
+        return []
+    return database.user.find(
+        {'_id': {'$in': user_ids}}, projection, sort=[('_id', pymongo.ASCENDING)])
+
+
+def rebuild(database):
+    """Compute the eligibility of all the users from scratch.
+
+    Args:
+        database: the database with the user and mailing_eligibility
+            collections.
+    Returns:
+        the number of users eligible to at least one campaign.
+    """
+    count = 0
+    updates = []
+    for user_in_db in database.user.find({}, _USER_PROJECTION):
+        user_id = user_in_db['_id']
+        user = user_pb2.User()
+        if not proto.parse_from_mongo(user_in_db, user):
+            continue
+        eligibility = get_eligibility(user)
+        if eligibility:
+            updates.append(pymongo.ReplaceOne({'_id': user_id}, eligibility, upsert=True))
+            count += 1
+        else:
+            updates.append(pymongo.DeleteOne({'_id': user_id}))
+        if len(updates) >= _WRITE_BATCH_SIZE:
+            database.mailing_eligibility.bulk_write(updates, ordered=False)
+            updates = []
+    if updates:
+        database.mailing_eligibility.bulk_write(updates, ordered=False)
+    # Drop the users that cannot receive any campaign anymore since they got one.
+    database.mailing_eligibility.delete_many({'campaigns': {'$size': 0}})
+    return count
@@ -0,0 +1,141 @@
+"""Unit tests for the bob_emploi.frontend.mailing_eligibility module."""
+import datetime
+import unittest
+
+import mongomock
+
+from bob_emploi.frontend import mailing_eligibility
+from bob_emploi.frontend.api import user_pb2
+
+
+def _user(**kwargs):
+    user = user_pb2.User(**kwargs)
+    user.registered_at.FromDatetime(datetime.datetime(2017, 3, 1))
+    return user
+
+
+class GetEligibilityTestCase(unittest.TestCase):
+    """Unit tests for the get_eligibility function."""
+
+    def test_advice(self):
+        """A user with scored advice gets the advice emails on their days."""
+        user = _user(
+            features_enabled=user_pb2.Features(advisor_email=user_pb2.ACTIVE),
+            profile=user_pb2.UserProfile(email_days=[user_pb2.FRIDAY, user_pb2.MONDAY]))
+        user.projects.add().advices.add(score=3)
+        user.last_email_sent_at.FromDatetime(datetime.datetime(2017, 3, 6, 10))
+
+        eligibility = mailing_eligibility.get_eligibility(user)
+
+        self.assertEqual(['advice-FRIDAY', 'advice-MONDAY'], eligibility['campaigns'])
+        self.assertEqual(
+            {'advice': datetime.datetime(2017, 3, 7, 6)}, eligibility['nextEligibleAt'])
+
+    def test_advice_not_scored(self):
+        """A user without any scored advice does not get advice emails."""
+        user = _user(
+            features_enabled=user_pb2.Features(advisor_email=user_pb2.ACTIVE),
+            profile=user_pb2.UserProfile(email_days=[user_pb2.MONDAY]))
+        user.projects.add().advices.add(advice_id='unscored')
+
+        self.assertIsNone(mailing_eligibility.get_eligibility(user))
+
+    def test_nps(self):
+        """A user with a project and a pending NPS email gets it."""
+        user = _user(features_enabled=user_pb2.Features(
+            net_promoter_score_email=user_pb2.NPS_EMAIL_PENDING))
+        user.projects.add()
+
+        eligibility = mailing_eligibility.get_eligibility(user)
+
+        self.assertEqual(['nps'], eligibility['campaigns'])
+        self.assertEqual({'nps': datetime.datetime(2017, 3, 1)}, eligibility['nextEligibleAt'])
+
+    def test_nps_without_project(self):
+        """A user without any project does not get the NPS email."""
+        user = _user(features_enabled=user_pb2.Features(
+            net_promoter_score_email=user_pb2.NPS_EMAIL_PENDING))
+
+        self.assertIsNone(mailing_eligibility.get_eligibility(user))
+
+
+class UpdateTestCase(unittest.TestCase):
+    """Unit tests for the update and record functions."""
+
+    def setUp(self):
+        super(UpdateTestCase, self).setUp()
+        self._collection = mongomock.MongoClient().database.mailing_eligibility
+        self._user = _user(
+            features_enabled=user_pb2.Features(
+                advisor_email=user_pb2.ACTIVE,
+                net_promoter_score_email=user_pb2.NPS_EMAIL_PENDING),
+            profile=user_pb2.UserProfile(email_days=[user_pb2.MONDAY]))
+        self._user.projects.add().advices.add(score=3)
+
+    def test_update(self):
+        """The document is replaced, then deleted when the user is not eligible anymore."""
+        mailing_eligibility.update(self._collection, 'my-user', self._user)
+        self.assertEqual(
+            ['advice-MONDAY', 'nps'], self._collection.find_one('my-user')['campaigns'])
+
+        del self._user.projects[:]
+        mailing_eligibility.update(self._collection, 'my-user', self._user)
+        self.assertIsNone(self._collection.find_one('my-user'))
+
+    def test_record(self):
+        """Sent emails update the campaigns and the next eligible times."""
+        mailing_eligibility.update(self._collection, 'my-user', self._user)
+
+        mailing_eligibility.record_advice_sent(
+            self._collection, 'my-user', datetime.datetime(2017, 3, 6, 10))
+        self.assertEqual(
+            datetime.datetime(2017, 3, 7, 6),
+            self._collection.find_one('my-user')['nextEligibleAt']['advice'])
+
+        mailing_eligibility.record_nps_sent(self._collection, 'my-user')
+        self.assertEqual(['advice-MONDAY'], self._collection.find_one('my-user')['campaigns'])
+
+        mailing_eligibility.record_advice_stopped(self._collection, 'my-user')
+        eligibility = self._collection.find_one('my-user')
+        self.assertEqual([], eligibility['campaigns'])
+        self.assertEqual({}, eligibility['nextEligibleAt'])
+
+
+class IterateUsersTestCase(unittest.TestCase):
+    """Unit tests for the rebuild and iterate_users functions."""
+
+    def setUp(self):
+        super(IterateUsersTestCase, self).setUp()
+        self._db = mongomock.MongoClient().database
+        self._db.user.insert_many([
+            {
+                '_id': 'user-%d' % i,
+                'featuresEnabled': {'advisorEmail': 'ACTIVE'},
+                'profile': {'emailDays': ['MONDAY'] if i % 2 else ['TUESDAY']},
+                'projects': [{'advices': [{'score': 1}]}],
+            }
+            for i in range(7)
+        ])
+        self._db.user.insert_one({'_id': 'no-project'})
+        self._db.mailing_eligibility.insert_one({'_id': 'no-project', 'campaigns': ['nps']})
+
+    def test_rebuild(self):
+        """All the users are indexed."""
+        self.assertEqual(7, mailing_eligibility.rebuild(self._db))
+        self.assertEqual(7, self._db.mailing_eligibility.count())
+        self.assertEqual(
+            ['advice-TUESDAY'], self._db.mailing_eligibility.find_one('user-0')['campaigns'])
+
+    def test_iterate_users(self):
+        """Only the users of a campaign are fetched, in batches."""
+        mailing_eligibility.rebuild(self._db)
+
+        users = list(mailing_eligibility.iterate_users(
+            self._db, {'campaigns': 'advice-MONDAY'}, {'profile': 1}, batch_size=2))
+
+        self.assertEqual(['user-1', 'user-3', 'user-5'], [user['_id'] for user in users])
+        self.assertEqual({'_id', 'profile'}, set(users[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
@@ -10,6 +10,7 @@ import mongomock
 from bob_emploi.frontend import proto
 from bob_emploi.frontend.api import action_pb2
 from bob_emploi.frontend.api import job_pb2
+from bob_emploi.frontend.api import user_pb2
 
 app = flask.Flask(__name__)  # pylint: disable=invalid-name
 
@@ -191,5 +192,55 @@ class ParseFromMongoTestCase(unittest.TestCase):
         self.assertEqual("{'romeId': 123}", str(mock_warning.call_args[0][3]))
 
 
+class MongoProjectionTestCase(unittest.TestCase):
+    """Unit tests for the mongo_projection function."""
+
+    def test_fields(self):
+        """Fields are converted to their JSON names."""
+        self.assertEqual(
+            {'lastEmailSentAt': 1, 'profile.lastName': 1, 'featuresEnabled': 1},
+            proto.mongo_projection(
+                user_pb2.User, ['last_email_sent_at', 'profile.last_name', 'features_enabled']))
+
+    def test_exclude(self):
+        """Exclude some sub fields."""
+        projection = proto.mongo_projection(
+            user_pb2.User, ['projects'],
+            exclude=['projects.past_actions', 'projects.mobility.city'])
+
+        self.assertEqual(1, projection.get('projects.advices'))
+        self.assertEqual(1, projection.get('projects.actions'))
+        self.assertEqual(1, projection.get('projects.mobility.areaType'))
+        self.assertNotIn('projects', projection)
+        self.assertNotIn('projects.pastActions', projection)
+        self.assertNotIn('projects.mobility', projection)
+        self.assertNotIn('projects.mobility.city', projection)
+
+    def test_parse_projected_document(self):
+        """Only the projected fields are parsed."""
+        database = mongomock.MongoClient().test
+        database.user.insert_one({
+            'profile': {'name': 'Pascal', 'email': 'pascal@bayes.org'},
+            'projects': [{'title': 'Project', 'pastActions': [{'title': 'Old action'}]}],
+        })
+        projection = proto.mongo_projection(
+            user_pb2.User, ['profile.name', 'projects'], exclude=['projects.past_actions'])
+
+        user = user_pb2.User()
+        self.assertTrue(proto.parse_from_mongo(database.user.find_one({}, projection), user))
+
+        self.assertEqual('Pascal', user.profile.name)
+        self.assertFalse(user.profile.email)
+        self.assertEqual('Project', user.projects[0].title)
+        self.assertFalse(user.projects[0].past_actions)
+
+    def test_unknown_field(self):
+        """Unknown fields raise an error."""
+        with self.assertRaises(ValueError):
+            proto.mongo_projection(user_pb2.User, ['profile.unknown_field'])
+        with self.assertRaises(ValueError):
+            proto.mongo_projection(user_pb2.User, ['projects'], exclude=['projects.unknown'])
+
+
 if __name__ == '__main__':
     unittest.main()  # pragma: no cover
@@ -0,0 +1,196 @@
+"""Module to compare the outlook of a project in all départements at once.
+
+The scoring models only consider the areas around the user's city. To find
+out where a job seeker would do best if they moved, this module loads the
+market data of all départements in NumPy arrays indexed by job group and
+département, so that scoring a project everywhere is a single vectorized
+operation instead of one scoring pass per département.
+"""
+import collections
+
+import numpy
+
+from bob_emploi.frontend import scoring
+from bob_emploi.frontend.api import geo_pb2
+from bob_emploi.frontend.api import project_pb2
+
+# Market stress when there are no job offers at all, see
+# ScoringProject.market_stress.
+_MAX_MARKET_STRESS = 1000
+
+# The scoring model used to score a relocation to a given département.
+_RELOCATION_SCORING_MODEL = 'chantier-relocate(fra)'
+
+# Market data for all départements. Each array has one row per job group and
+# one column per département (NaN when there is no data).
+_Markets = collections.namedtuple('Markets', [
+    'rome_indices', 'departement_ids', 'unemployment_days', 'market_stress'])
+
+# Cache of the markets, a list with at most one tuple: the database they were
+# loaded from, and the markets themselves.
+_MARKETS = []
+
+
+def clear_cache():
+    """Clear the cached markets."""
+    _MARKETS.clear()
+
+
+def _load_unemployment_days(database, rome_indices, departement_indices):
+    departement_days = {}
+    region_days = {}
+    country_days = {}
+    departement_regions = {}
+    fhs_diagnoses = database.fhs_local_diagnosis.find({}, {
+        'unemploymentDuration.days': 1,
+        'bestCity.departementId': 1,
+        'bestCity.regionId': 1,
+    })
+    for diagnosis in fhs_diagnoses:
+        # The best cities of all levels and all job groups, including cities
+        # themselves, give the région of every département with job seekers,
+        # even for job groups without any data in this département.
+        best_city = diagnosis.get('bestCity', {})
+        if best_city.get('departementId') and best_city.get('regionId'):
+            departement_regions[best_city['departementId']] = best_city['regionId']
+
+        area_id, unused_sep, rome_id = diagnosis['_id'].rpartition(':')
+        days = diagnosis.get('unemploymentDuration', {}).get('days')
+        if not days:
+            continue
+        # Cities and ghost towns are ignored: the département level already
+        # holds the best city of each département.
+        if not area_id:
+            country_days[rome_id] = days
+        elif area_id.startswith('d'):
+            departement_days[area_id[1:], rome_id] = days
+        elif area_id.startswith('r'):
+            region_days[area_id[1:], rome_id] = days
+
+    for departement_id, rome_id in departement_days:
+        rome_indices.setdefault(rome_id, len(rome_indices))
+        departement_indices.setdefault(departement_id, len(departement_indices))
+    for rome_id in country_days:
+        rome_indices.setdefault(rome_id, len(rome_indices))
+    region_indices = {}
+    for region_id, rome_id in region_days:
+        rome_indices.setdefault(rome_id, len(rome_indices))
+        region_indices.setdefault(region_id, len(region_indices))
+
+    return departement_days, region_days, country_days, departement_regions, region_indices
+
+
+def _load_markets(database):
+    rome_indices = {}
+    departement_indices = {}
+
+    departement_days, region_days, country_days, departement_regions, region_indices = \
+        _load_unemployment_days(database, rome_indices, departement_indices)
+
+    local_stats = {}
+    local_diagnoses = database.local_diagnosis.find({}, {
+        'imt.yearlyAvgOffersDenominator': 1,
+        'imt.yearlyAvgOffersPer10Candidates': 1,
+        'imt.yearlyAvgOffersPer10Openings': 1,
+    })
+    for diagnosis in local_diagnoses:
+        imt = diagnosis.get('imt')
+        if not imt or not imt.get('yearlyAvgOffersDenominator'):
+            continue
+        departement_id, unused_sep, rome_id = diagnosis['_id'].partition(':')
+        rome_indices.setdefault(rome_id, len(rome_indices))
+        departement_indices.setdefault(departement_id, len(departement_indices))
+        local_stats[departement_id, rome_id] = imt
+
+    shape = (len(rome_indices), len(departement_indices))
+    unemployment_days = numpy.full(shape, numpy.nan, dtype=numpy.float32)
+    for (departement_id, rome_id), days in departement_days.items():
+        unemployment_days[rome_indices[rome_id], departement_indices[departement_id]] = days
+
+    # Fallback on the région, using an additional column full of NaN for
+    # départements whose région is unknown.
+    regional_days = numpy.full(
+        (len(rome_indices), len(region_indices) + 1), numpy.nan, dtype=numpy.float32)
+    for (region_id, rome_id), days in region_days.items():
+        regional_days[rome_indices[rome_id], region_indices[region_id]] = days
+    departement_region_indices = numpy.full(len(departement_indices), -1, dtype=numpy.int32)
+    for departement_id, index in departement_indices.items():
+        departement_region_indices[index] = region_indices.get(
+            departement_regions.get(departement_id), -1)
+    unemployment_days = numpy.where(
+        numpy.isnan(unemployment_days),
+        regional_days[:, departement_region_indices], unemployment_days)
+
+    # Fallback on the whole country.
+    national_days = numpy.full(len(rome_indices), numpy.nan, dtype=numpy.float32)
+    for rome_id, days in country_days.items():
+        national_days[rome_indices[rome_id]] = days
+    unemployment_days = numpy.where(
+        numpy.isnan(unemployment_days), national_days[:, numpy.newaxis], unemployment_days)
+
+    offers = numpy.zeros(shape, dtype=numpy.float32)
+    denominators = numpy.zeros(shape, dtype=numpy.float32)
+    for (departement_id, rome_id), imt in local_stats.items():
+        index = rome_indices[rome_id], departement_indices[departement_id]
+        denominators[index] = imt['yearlyAvgOffersDenominator']
+        offers[index] = imt.get('yearlyAvgOffersPer10Candidates') or \
+            imt.get('yearlyAvgOffersPer10Openings') or 0
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        market_stress = numpy.where(
+            offers > 0, denominators / offers,
+            numpy.where(denominators > 0, _MAX_MARKET_STRESS, numpy.nan))
+
+    departement_ids = [None] * len(departement_indices)
+    for departement_id, index in departement_indices.items():
+        departement_ids[index] = departement_id
+
+    return _Markets(
+        rome_indices=rome_indices,
+        departement_ids=departement_ids,
+        unemployment_days=unemployment_days,
+        market_stress=market_stress.astype(numpy.float32))
+
+
+def _markets(database):
+    if not _MARKETS or _MARKETS[0][0] is not database:
+        _MARKETS[:] = [(database, _load_markets(database))]
+    return _MARKETS[0][1]
+
+
+def compute_areas_outlook(scoring_project, database):
+    """Compute the outlook of a project in all départements.
+
+    Args:
+        scoring_project: the project to evaluate, a scoring.ScoringProject.
+        database: access to the database to get the market data.
+    Returns:
+        an AreasOutlook proto with the départements sorted from the best
+        outlook (shortest unemployment time, then lowest market stress) to the
+        worst one.
+    """
+    markets = _markets(database)
+    outlook = project_pb2.AreasOutlook()
+    rome_index = markets.rome_indices.get(scoring_project.details.target_job.job_group.rome_id)
+    if rome_index is None:
+        return outlook
+
+    unemployment_days = markets.unemployment_days[rome_index]
+    market_stress = markets.market_stress[rome_index]
+    relocation_scores = scoring.get_scoring_model(_RELOCATION_SCORING_MODEL)\
+        .score_unemployment_times(
+            scoring_project.median_unemployment_time(),
+            scoring_project.median_unemployment_time(area_type=geo_pb2.CITY),
+            unemployment_days)
+
+    has_data = ~(numpy.isnan(unemployment_days) & numpy.isnan(market_stress))
+    # numpy.lexsort uses the last key as the primary one, and puts NaN last.
+    for index in numpy.lexsort((market_stress, unemployment_days)):
+        if not has_data[index]:
+            continue
+        area = outlook.areas.add(departement_id=markets.departement_ids[index])
+        if not numpy.isnan(unemployment_days[index]):
+            area.median_unemployment_days = int(unemployment_days[index])
+            area.relocation_score = float(relocation_scores[index])
+        if not numpy.isnan(market_stress[index]):
+            area.market_stress = float(market_stress[index])
+    return outlook
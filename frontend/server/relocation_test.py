@@ -0,0 +1,131 @@
+"""Unit tests for the bob_emploi.frontend.relocation module."""
+import unittest
+
+import mongomock
+
+from bob_emploi.frontend import relocation
+from bob_emploi.frontend import scoring
+from bob_emploi.frontend.api import geo_pb2
+from bob_emploi.frontend.api import project_pb2
+from bob_emploi.frontend.api import user_pb2
+
+
+class ComputeAreasOutlookTestCase(unittest.TestCase):
+    """Unit tests for the compute_areas_outlook function."""
+
+    def setUp(self):
+        super(ComputeAreasOutlookTestCase, self).setUp()
+        relocation.clear_cache()
+        self.database = mongomock.MongoClient().test
+        self.database.fhs_local_diagnosis.insert_many([
+            {'_id': '69123:A1234', 'unemploymentDuration': {'days': 400}},
+            {'_id': 'ghost-d69:A1234', 'unemploymentDuration': {'days': 10}},
+            {
+                '_id': 'd69:A1234',
+                'unemploymentDuration': {'days': 300},
+                'bestCity': {'regionId': '84'},
+            },
+            {
+                '_id': 'd38:A1234',
+                'unemploymentDuration': {'days': 100},
+                'bestCity': {'regionId': '84'},
+            },
+            {'_id': 'r84:A1234', 'unemploymentDuration': {'days': 90}},
+            {'_id': 'A1234', 'unemploymentDuration': {'days': 200}},
+            {'_id': 'A9999', 'unemploymentDuration': {'days': 20}},
+        ])
+        self.database.local_diagnosis.insert_many([
+            {
+                '_id': '69:A1234',
+                'imt': {'yearlyAvgOffersDenominator': 10, 'yearlyAvgOffersPer10Candidates': 2},
+            },
+            {
+                '_id': '38:A1234',
+                'imt': {'yearlyAvgOffersDenominator': 10, 'yearlyAvgOffersPer10Candidates': 4},
+            },
+            # No job offers at all.
+            {'_id': '75:A1234', 'imt': {'yearlyAvgOffersDenominator': 10}},
+            # Same unemployment time as 75 but better market.
+            {
+                '_id': '13:A1234',
+                'imt': {'yearlyAvgOffersDenominator': 10, 'yearlyAvgOffersPer10Candidates': 10},
+            },
+        ])
+        project = project_pb2.Project()
+        project.target_job.job_group.rome_id = 'A1234'
+        project.mobility.area_type = geo_pb2.CITY
+        project.mobility.city.city_id = '69123'
+        project.mobility.city.departement_id = '69'
+        project.mobility.city.region_id = '84'
+        self.scoring_project = scoring.ScoringProject(
+            project, user_pb2.UserProfile(), user_pb2.Features(), self.database)
+
+    def test_rank_departements(self):
+        """Départements are sorted by unemployment time then market stress."""
+        outlook = relocation.compute_areas_outlook(self.scoring_project, self.database)
+
+        self.assertEqual(
+            ['38', '13', '75', '69'], [area.departement_id for area in outlook.areas])
+        self.assertEqual(
+            [100, 200, 200, 300], [area.median_unemployment_days for area in outlook.areas])
+        self.assertEqual(
+            [2.5, 1, 1000, 5], [area.market_stress for area in outlook.areas])
+
+    def test_relocation_score(self):
+        """Relocation scores match the ones of the scoring model."""
+        outlook = relocation.compute_areas_outlook(self.scoring_project, self.database)
+
+        model = scoring.get_scoring_model('chantier-relocate(fra)')
+        self.assertAlmostEqual(
+            model.score_unemployment_times(400, 400, 100), outlook.areas[0].relocation_score,
+            places=5)
+        self.assertGreater(outlook.areas[0].relocation_score, outlook.areas[-1].relocation_score)
+
+    def test_unknown_job_group(self):
+        """No data for the job group."""
+        self.scoring_project.details.target_job.job_group.rome_id = 'B5678'
+        outlook = relocation.compute_areas_outlook(self.scoring_project, self.database)
+
+        self.assertFalse(outlook.areas)
+
+    def test_region_fallback(self):
+        """A département without data for a job group uses its région."""
+        self.database.fhs_local_diagnosis.insert_many([
+            # Paris is only known from a city for another job group.
+            {
+                '_id': '75056:A1234',
+                'unemploymentDuration': {'days': 150},
+                'bestCity': {'cityId': '75056', 'departementId': '75', 'regionId': '11'},
+            },
+            {'_id': 'r11:B5678', 'unemploymentDuration': {'days': 60}},
+            {'_id': 'B5678', 'unemploymentDuration': {'days': 120}},
+        ])
+        self.database.local_diagnosis.insert_many([
+            {'_id': '75:B5678', 'imt': {'yearlyAvgOffersDenominator': 10}},
+            {'_id': '13:B5678', 'imt': {'yearlyAvgOffersDenominator': 10}},
+        ])
+        self.scoring_project.details.target_job.job_group.rome_id = 'B5678'
+
+        outlook = relocation.compute_areas_outlook(self.scoring_project, self.database)
+
+        days = {area.departement_id: area.median_unemployment_days for area in outlook.areas}
+        # Paris uses the value of its région, Marseille the country one.
+        self.assertEqual(60, days['75'])
+        self.assertEqual(120, days['13'])
+
+    def test_cache(self):
+        """The markets are only loaded once per database."""
+        relocation.compute_areas_outlook(self.scoring_project, self.database)
+        self.database.local_diagnosis.drop()
+        self.database.fhs_local_diagnosis.drop()
+
+        outlook = relocation.compute_areas_outlook(self.scoring_project, self.database)
+        self.assertEqual(4, len(outlook.areas))
+
+        other_database = mongomock.MongoClient().other
+        outlook = relocation.compute_areas_outlook(self.scoring_project, other_database)
+        self.assertFalse(outlook.areas)
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
@@ -13,6 +13,7 @@ import re
 
 from bob_emploi.frontend import companies
 from bob_emploi.frontend import proto
+from bob_emploi.frontend import unemployment_index
 from bob_emploi.frontend.api import chantier_pb2
 from bob_emploi.frontend.api import geo_pb2
 from bob_emploi.frontend.api import job_pb2
@@ -63,33 +64,63 @@ class ScoringProject(object):
         self._job_group_info = None
         self._unemployment_durations = None
         self._local_diagnosis = None
+        self._local_market_scores = None
         self._jobboards = None
 
     # When scoring models need it, add methods to access data from DB:
     # project requirements from job offers, IMT, median unemployment duration
     # from FHS, etc.
 
+    def _local_id(self):
+        return '%s:%s' % (
+            self.details.mobility.city.departement_id,
+            self.details.target_job.job_group.rome_id)
+
     def local_diagnosis(self):
         """Get local stats for the project's job group and département."""
         if self._local_diagnosis is not None:
             return self._local_diagnosis
 
-        self._local_diagnosis = job_pb2.LocalJobStats()
-        local_id = '%s:%s' % (
-            self.details.mobility.city.departement_id,
-            self.details.target_job.job_group.rome_id)
+        # Populate a local proto before caching it, so that concurrent
+        # computations of extra data never see a partially parsed proto.
+        local_diagnosis = job_pb2.LocalJobStats()
         # TODO(pascal): Handle when return is False (no data).
         proto.parse_from_mongo(
-            self._db.local_diagnosis.find_one({'_id': local_id}), self._local_diagnosis)
+            self._db.local_diagnosis.find_one({'_id': self._local_id()}), local_diagnosis)
+        self._local_diagnosis = local_diagnosis
 
         return self._local_diagnosis
 
+    def local_market_scores(self):
+        """Get the precomputed market scores for the project's job group and département.
+
+        Returns:
+            a LocalMarketScores proto or None if they were not precomputed for
+            this market, in which case they need to be derived from the local
+            diagnosis.
+        """
+        if self._local_market_scores is None:
+            local_market_scores = job_pb2.LocalMarketScores()
+            proto.parse_from_mongo(
+                self._db.local_market_scores.find_one({'_id': self._local_id()}),
+                local_market_scores)
+            self._local_market_scores = local_market_scores
+
+        # The importer never creates empty market scores.
+        if not self._local_market_scores.ListFields():
+            return None
+        return self._local_market_scores
+
     def imt_proto(self):
         """Get IMT data for the project's job and département."""
         return self.local_diagnosis().imt
 
     def market_stress(self):
         """Get the ratio of # applicants / # job offers for the project."""
+        local_market_scores = self.local_market_scores()
+        if local_market_scores:
+            return local_market_scores.market_stress or None
+
         imt = self.imt_proto()
         if not imt.yearly_avg_offers_denominator:
             return None
@@ -99,6 +130,20 @@ class ScoringProject(object):
             return 1000
         return imt.yearly_avg_offers_denominator / offers
 
+    def application_modes(self, rank='first'):
+        """Get the application modes that come at a given rank for the project.
+
+        Args:
+            rank: 'first', 'second' or 'third'.
+        Returns:
+            a set of ApplicationMode values.
+        """
+        local_market_scores = self.local_market_scores()
+        if local_market_scores and rank != 'third':
+            return set(getattr(local_market_scores, '%s_application_modes' % rank))
+        imt = self.imt_proto()
+        return set(getattr(mode, rank) for mode in imt.application_modes.values())
+
     def _rome_id(self):
         return self.details.target_job.job_group.rome_id
 
@@ -107,10 +152,11 @@ class ScoringProject(object):
         if self._job_group_info is not None:
             return self._job_group_info
 
-        self._job_group_info = job_pb2.JobGroup()
+        job_group_info = job_pb2.JobGroup()
         proto.parse_from_mongo(
             self._db.job_group_info.find_one({'_id': self._rome_id()}),
-            self._job_group_info)
+            job_group_info)
+        self._job_group_info = job_group_info
 
         return self._job_group_info
 
@@ -132,31 +178,21 @@ class ScoringProject(object):
     def _unemployment_duration_at_level(self, area_type):
         """Get the median unemployment time for an area type if available.
 
-        This function loads the data from MongoDB and caches it. To be even
-        faster it directly loads all level of area type that are available.
+        This function gets the data for all levels of area type at once from
+        the in-memory index and caches it.
 
         Returns:
-            a UnemploymentDuration proto or None if it is not defined for this
+            a DurationEstimation proto or None if it is not defined for this
             area type.
         """
         if self._unemployment_durations is not None:
             return self._unemployment_durations.get(area_type)
-        city = self.details.mobility.city
-        rome_id = self._rome_id()
-        diagnosis_ids = {
-            '%s:%s' % (city.city_id, rome_id): geo_pb2.CITY,
-            'd%s:%s' % (city.departement_id, rome_id): geo_pb2.DEPARTEMENT,
-            'r%s:%s' % (city.region_id, rome_id): geo_pb2.REGION,
-            rome_id: geo_pb2.COUNTRY,
+        all_days = unemployment_index.get_index(self._db).lookup(
+            self._rome_id(), self.details.mobility.city)
+        self._unemployment_durations = {
+            duration_area_type: job_pb2.DurationEstimation(days=days)
+            for duration_area_type, days in all_days.items()
         }
-        mongo_diagnoses = self._db.fhs_local_diagnosis.find(
-            {'_id': {'$in': list(diagnosis_ids.keys())}})
-        self._unemployment_durations = {}
-        for mongo_diagnosis in mongo_diagnoses:
-            mongo_area_type = diagnosis_ids[mongo_diagnosis.pop('_id')]
-            stats = job_pb2.LocalJobStats()
-            if proto.parse_from_mongo(mongo_diagnosis, stats):
-                self._unemployment_durations[mongo_area_type] = stats.unemployment_duration
         return self._unemployment_durations.get(area_type)
 
     def median_unemployment_time(self, area_type=geo_pb2.UNKNOWN_AREA_TYPE, default=90):
@@ -191,10 +227,8 @@ class ScoringProject(object):
         the département could help them get those offers.
         """
         local_stats = job_pb2.LocalJobStats()
-        local_id = '%s:%s' % (
-            self.details.mobility.city.departement_id,
-            self.details.target_job.job_group.rome_id)
-        proto.parse_from_mongo(self._db.recent_job_offers.find_one({'_id': local_id}), local_stats)
+        proto.parse_from_mongo(
+            self._db.recent_job_offers.find_one({'_id': self._local_id()}), local_stats)
         return local_stats.num_available_job_offers
 
     def get_contract_type_percentages(self):
@@ -298,8 +332,7 @@ class _AdviceEventScoringModel(_ScoringModelBase):
     """A scoring model for Advice that user needs to go to events."""
 
     def score(self, project):
-        imt = project.imt_proto()
-        first_modes = set(mode.first for mode in imt.application_modes.values())
+        first_modes = project.application_modes('first')
         first_modes.discard(job_pb2.UNDEFINED_APPLICATION_MODE)
         if first_modes == {job_pb2.PERSONAL_OR_PROFESSIONAL_CONTACTS}:
             return _Score(2)
@@ -318,8 +351,7 @@ class _ImproveYourNetworkScoringModel(_ScoringModelBase):
         if project.details.network_estimate != self._network_level:
             return _Score(0)
 
-        imt = project.imt_proto()
-        first_modes = set(mode.first for mode in imt.application_modes.values())
+        first_modes = project.application_modes('first')
         first_modes.discard(job_pb2.UNDEFINED_APPLICATION_MODE)
         if first_modes == {job_pb2.PERSONAL_OR_PROFESSIONAL_CONTACTS}:
             return _Score(3)
@@ -417,13 +449,10 @@ class _SpontaneousApplicationScoringModel(_ScoringModelBase):
 
     def score(self, project):
         """Compute a score for the given ScoringProject."""
-        imt = project.imt_proto()
-        first_modes = set(mode.first for mode in imt.application_modes.values())
-        if job_pb2.SPONTANEOUS_APPLICATION in first_modes:
+        if job_pb2.SPONTANEOUS_APPLICATION in project.application_modes('first'):
             return _Score(3)
 
-        second_modes = set(mode.second for mode in imt.application_modes.values())
-        if job_pb2.SPONTANEOUS_APPLICATION in second_modes:
+        if job_pb2.SPONTANEOUS_APPLICATION in project.application_modes('second'):
             return _Score(2)
 
         return _Score(0)
@@ -549,15 +578,29 @@ class _RelocateScoringModel(_ScoringModelBase):
 
     def score(self, project):
         """Compute a score for the given ScoringProject."""
-        median_unemployment_time = project.median_unemployment_time()
-        if median_unemployment_time < 180:
-            return _Score(0)
-        score = 2 * self.scaling_factor * (
-            project.median_unemployment_time(area_type=geo_pb2.CITY) /
-            project.median_unemployment_time(area_type=self.target_area_type) - 1)
-        if median_unemployment_time >= 365:
+        return _Score(self.score_unemployment_times(
+            project.median_unemployment_time(),
+            project.median_unemployment_time(area_type=geo_pb2.CITY),
+            project.median_unemployment_time(area_type=self.target_area_type)))
+
+    def score_unemployment_times(self, median_time, local_time, target_time):
+        """Compute the score from unemployment times.
+
+        Args:
+            median_time: the median unemployment time for the project.
+            local_time: the median unemployment time in the project's city.
+            target_time: the median unemployment time in the area where the
+                job seeker would relocate. It can also be a NumPy array of
+                times to score several areas at once.
+        Returns:
+            the score, or an array of scores if target_time is an array.
+        """
+        if median_time < 180:
+            return 0 * target_time
+        score = 2 * self.scaling_factor * (local_time / target_time - 1)
+        if median_time >= 365:
             score += 1
-        return _Score(score)
+        return score
 
 
 class _ImproveCVScoringModel(_ScoringModelBase):
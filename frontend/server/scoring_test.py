@@ -169,6 +169,21 @@ class UseYourNetworkScoringModelTestCase(ScoringModelTestBase('chantier-use-netw
 
         self.assertLessEqual(5, score)
 
+    def test_precomputed_market_stress(self):
+        """Use the precomputed market stress instead of the IMT."""
+        persona = _PERSONAS['empty'].clone()
+        persona.project.network_estimate = 5
+        persona.project.mobility.city.departement_id = '69'
+        persona.project.target_job.job_group.rome_id = 'A1234'
+        self.database.local_market_scores.insert_one({
+            '_id': '69:A1234',
+            'marketStress': 10,
+        })
+
+        score = self._score_persona(persona)
+
+        self.assertLessEqual(5, score)
+
 
 class AdviceEventScoringModelTestCase(ScoringModelTestBase('advice-event')):
     """Unit test for the "Event Advice" scoring model."""
@@ -909,6 +924,22 @@ class SpontaneousApplicationScoringModelTestCase(
 
         self.assertEqual(score, 0, msg='Failed for "%s"' % persona.name)
 
+    def test_precomputed_second_best_channel(self):
+        """Spontaneous application is the second best channel in precomputed market scores."""
+        persona = self._random_persona().clone()
+        persona.project.target_job.job_group.rome_id = 'A1234'
+        persona.project.mobility.city.departement_id = '69'
+        persona.project.job_search_length_months = 2
+        persona.project.weekly_applications_estimate = project_pb2.LESS_THAN_2
+        self.database.local_market_scores.insert_one({
+            '_id': '69:A1234',
+            'firstApplicationModes': ['PLACEMENT_AGENCY'],
+            'secondApplicationModes': ['SPONTANEOUS_APPLICATION'],
+        })
+        score = self._score_persona(persona)
+
+        self.assertEqual(score, 2, msg='Failed for "%s"' % persona.name)
+
 
 class StayMotivatedScoringModelTestCase(ScoringModelTestBase('chantier-stay-motivated')):
     """Unit tests for the "Stay motivated" chantier."""
@@ -27,9 +27,12 @@ from werkzeug.contrib import fixers
 from bob_emploi.frontend import action
 from bob_emploi.frontend import advisor
 from bob_emploi.frontend import auth
+from bob_emploi.frontend import mailing_eligibility
 from bob_emploi.frontend import now
 from bob_emploi.frontend import proto
+from bob_emploi.frontend import relocation
 from bob_emploi.frontend import scoring
+from bob_emploi.frontend import unemployment_index
 from bob_emploi.frontend.api import action_pb2
 from bob_emploi.frontend.api import config_pb2
 from bob_emploi.frontend.api import chantier_pb2
@@ -105,6 +108,7 @@ def delete_user(user_data):
     filter_user = {'_id': _safe_object_id(user_data.user_id)}
     _DB.user_auth.delete_one(filter_user)
     _DB.user.delete_one(filter_user)
+    _DB.mailing_eligibility.delete_one(filter_user)
     return user_pb2.UserId(user_id=user_data.user_id)
 
 
@@ -291,8 +295,12 @@ def _save_user(user_data, is_new_user):
         user_dict['_id'] = _get_unguessable_object_id()
         result = _DB.user.insert_one(user_dict)
         user_data.user_id = str(result.inserted_id)
+        user_id = result.inserted_id
     else:
-        _DB.user.replace_one({'_id': _safe_object_id(user_data.user_id)}, user_dict)
+        user_id = _safe_object_id(user_data.user_id)
+        _DB.user.replace_one({'_id': user_id}, user_dict)
+    _tick('Update mailing eligibility')
+    mailing_eligibility.update(_DB.mailing_eligibility, user_id, user_data)
     _tick('Return user proto')
     return user_data
 
@@ -700,6 +708,17 @@ def project_jobboards(user_id, project_id):
     return jobboard_pb2.JobBoards(job_boards=sorted_jobboards)
 
 
+@app.route('/api/project/<user_id>/<project_id>/relocation', methods=['GET'])
+@proto.flask_api(out_type=project_pb2.AreasOutlook)
+def project_relocation(user_id, project_id):
+    """Compare the outlook of a project in all départements."""
+    user_proto = _get_user_data(user_id)
+    project = _get_project_data(user_proto, project_id)
+    scoring_project = scoring.ScoringProject(
+        project, user_proto.profile, user_proto.features_enabled, _DB)
+    return relocation.compute_areas_outlook(scoring_project, _DB)
+
+
 @app.route('/api/project/<user_id>/<project_id>/advice/<advice_id>/tips', methods=['GET'])
 @proto.flask_api(out_type=action_pb2.AdviceTips)
 def advice_tips(user_id, project_id, advice_id):
@@ -747,6 +766,8 @@ def clear_cache():
     _SHOW_UNVERIFIED_DATA_USERS.clear()
     action.clear_cache()
     advisor.clear_cache()
+    relocation.clear_cache()
+    unemployment_index.clear_cache()
     return 'Server cache cleared.'
 
 
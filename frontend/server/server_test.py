@@ -1227,6 +1227,35 @@ class ProjectJobBoardsTipsTestCase(base_test.ServerTestCase):
             [j.get('title') for j in jobboards.get('jobBoards', [])])
 
 
+class ProjectRelocationTestCase(base_test.ServerTestCase):
+    """Unit tests for the project/.../relocation endpoint."""
+
+    def setUp(self):
+        super(ProjectRelocationTestCase, self).setUp()
+        self.user_id = self.create_user(modifiers=[_add_project], advisor=True)
+        user_info = self.get_user_info(self.user_id)
+        self.project_id = user_info['projects'][0]['projectId']
+
+    def test_bad_project_id(self):
+        """Test with a non existing project ID."""
+        response = self.app.get('/api/project/%s/foo/relocation' % self.user_id)
+
+        self.assertEqual(404, response.status_code)
+
+    def test_sorted_departements(self):
+        """Départements with a shorter unemployment time come first."""
+        self._db.fhs_local_diagnosis.insert_many([
+            {'_id': 'd31:A1234', 'unemploymentDuration': {'days': 200}},
+            {'_id': 'd69:A1234', 'unemploymentDuration': {'days': 100}},
+        ])
+        response = self.app.get(
+            '/api/project/%s/%s/relocation' % (self.user_id, self.project_id))
+
+        outlook = self.json_from_response(response)
+        self.assertEqual(
+            ['69', '31'], [area.get('departementId') for area in outlook.get('areas', [])])
+
+
 class ProjectAdviceTipsTestCase(base_test.ServerTestCase):
     """Unit tests for the project/.../advice/.../tips endpoint."""
 
@@ -0,0 +1,143 @@
+"""Module to access unemployment durations from an in-memory index.
+
+The fhs_local_diagnosis collection contains the median unemployment duration
+for each job group in each city, département ('d' prefix), région ('r'
+prefix) and in the whole country (no area ID). Scoring a project needs the
+durations at all those levels, so instead of querying MongoDB each time, the
+whole collection is loaded once in a compact index: area IDs and job group
+IDs are interned as integers and combined in a single sorted array of keys,
+with a parallel array of durations.
+"""
+import numpy
+
+from bob_emploi.frontend.api import geo_pb2
+
+# Bits used by each part of the keys: the job group index is in the highest
+# bits, then the area type and finally the area index.
+_AREA_TYPE_SHIFT = 24
+_ROME_SHIFT = 32
+
+# Maximum duration that can be stored in the index.
+_MAX_DAYS = numpy.iinfo(numpy.uint16).max
+
+# Cache of the index, a list with at most one tuple: the database it was
+# loaded from, and the index itself.
+_INDEX = []
+
+
+def clear_cache():
+    """Clear the cached index."""
+    _INDEX.clear()
+
+
+def get_index(database):
+    """Get the index of unemployment durations for a database.
+
+    The index is loaded on first use and then kept in memory until the cache
+    is cleared or the index is requested for another database.
+    """
+    if not _INDEX or _INDEX[0][0] is not database:
+        _INDEX[:] = [(database, UnemploymentDurationIndex.from_mongo(
+            database.fhs_local_diagnosis))]
+    return _INDEX[0][1]
+
+
+def _parse_diagnosis_id(diagnosis_id):
+    """Parse the ID of a document of the fhs_local_diagnosis collection.
+
+    Returns:
+        a tuple with the job group ID, the area type and the area ID, or None
+        for ghost towns as they are never requested by projects.
+    """
+    area_id, unused_sep, rome_id = diagnosis_id.rpartition(':')
+    if not area_id:
+        return rome_id, geo_pb2.COUNTRY, ''
+    if area_id.startswith('ghost'):
+        return None
+    if area_id.startswith('d'):
+        return rome_id, geo_pb2.DEPARTEMENT, area_id[1:]
+    if area_id.startswith('r'):
+        return rome_id, geo_pb2.REGION, area_id[1:]
+    return rome_id, geo_pb2.CITY, area_id
+
+
+class UnemploymentDurationIndex(object):
+    """An index of unemployment durations by job group and area."""
+
+    def __init__(self, rome_indices, area_indices, keys, days):
+        """Create the index from its internal arrays, see from_mongo."""
+        self._rome_indices = rome_indices
+        self._area_indices = area_indices
+        self._keys = keys
+        self._days = days
+
+    @classmethod
+    def from_mongo(cls, collection):
+        """Build the index from the fhs_local_diagnosis collection."""
+        rome_indices = {}
+        area_indices = {}
+        keys = []
+        days = []
+        for diagnosis in collection.find({}, {'unemploymentDuration.days': 1}):
+            duration = diagnosis.get('unemploymentDuration', {}).get('days')
+            parsed_id = _parse_diagnosis_id(diagnosis['_id'])
+            if not duration or not parsed_id:
+                continue
+            rome_id, area_type, area_id = parsed_id
+            rome_index = rome_indices.setdefault(rome_id, len(rome_indices))
+            area_index = area_indices.setdefault(area_id, len(area_indices))
+            keys.append(_pack_key(rome_index, area_type, area_index))
+            days.append(duration)
+
+        keys = numpy.array(keys, dtype=numpy.int64)
+        order = numpy.argsort(keys)
+        return cls(
+            rome_indices, area_indices, keys[order],
+            numpy.minimum(numpy.array(days, dtype=numpy.int64), _MAX_DAYS)
+            .astype(numpy.uint16)[order])
+
+    def __len__(self):
+        return len(self._keys)
+
+    def lookup(self, rome_id, city):
+        """Get the unemployment durations around a city for a job group.
+
+        Args:
+            rome_id: the ID of the job group.
+            city: a FrenchCity proto with the IDs of the city, its département
+                and its région.
+        Returns:
+            a dict of durations in days keyed by area types. Area types without
+            any data are missing.
+        """
+        rome_index = self._rome_indices.get(rome_id)
+        if rome_index is None:
+            return {}
+        area_types = []
+        keys = []
+        for area_type, area_id in (
+                (geo_pb2.CITY, city.city_id),
+                (geo_pb2.DEPARTEMENT, city.departement_id),
+                (geo_pb2.REGION, city.region_id),
+                (geo_pb2.COUNTRY, '')):
+            area_index = self._area_indices.get(area_id)
+            if area_index is None:
+                continue
+            area_types.append(area_type)
+            keys.append(_pack_key(rome_index, area_type, area_index))
+        if not keys:
+            return {}
+
+        # Look up all area levels at once.
+        keys = numpy.array(keys, dtype=numpy.int64)
+        positions = numpy.minimum(numpy.searchsorted(self._keys, keys), len(self._keys) - 1)
+        found = self._keys[positions] == keys
+        return {
+            area_type: int(self._days[position])
+            for area_type, position, is_found in zip(area_types, positions, found)
+            if is_found
+        }
+
+
+def _pack_key(rome_index, area_type, area_index):
+    return (rome_index << _ROME_SHIFT) | (area_type << _AREA_TYPE_SHIFT) | area_index
@@ -0,0 +1,68 @@
+"""Unit tests for the bob_emploi.frontend.unemployment_index module."""
+import unittest
+
+import mongomock
+
+from bob_emploi.frontend import unemployment_index
+from bob_emploi.frontend.api import geo_pb2
+
+
+class UnemploymentDurationIndexTestCase(unittest.TestCase):
+    """Unit tests for the UnemploymentDurationIndex class."""
+
+    def setUp(self):
+        super(UnemploymentDurationIndexTestCase, self).setUp()
+        unemployment_index.clear_cache()
+        self.database = mongomock.MongoClient().test
+        self.database.fhs_local_diagnosis.insert_many([
+            {'_id': '69123:A1234', 'unemploymentDuration': {'days': 80}},
+            {'_id': '69123:B5678', 'unemploymentDuration': {'days': 81}},
+            {'_id': 'd69:A1234', 'unemploymentDuration': {'days': 70}},
+            {'_id': 'r84:A1234', 'unemploymentDuration': {'days': 60}},
+            {'_id': 'A1234', 'unemploymentDuration': {'days': 50}},
+            {'_id': 'ghost-d69:A1234', 'unemploymentDuration': {'days': 10}},
+            {'_id': 'ghost:A1234', 'unemploymentDuration': {'days': 10}},
+            # Same ID for a région and a département.
+            {'_id': 'd84:A1234', 'unemploymentDuration': {'days': 40}},
+            {'_id': '38185:A1234', 'unemploymentDuration': {}},
+        ])
+        self.city = geo_pb2.FrenchCity(city_id='69123', departement_id='69', region_id='84')
+
+    def test_all_levels(self):
+        """Get durations for all levels at once."""
+        index = unemployment_index.get_index(self.database)
+
+        self.assertEqual(
+            {geo_pb2.CITY: 80, geo_pb2.DEPARTEMENT: 70, geo_pb2.REGION: 60, geo_pb2.COUNTRY: 50},
+            index.lookup('A1234', self.city))
+        self.assertEqual({geo_pb2.CITY: 81}, index.lookup('B5678', self.city))
+
+    def test_ghosts_and_empty_ignored(self):
+        """Ghost towns and diagnoses without durations are not kept in the index."""
+        index = unemployment_index.get_index(self.database)
+
+        self.assertEqual(6, len(index))
+        self.assertEqual(
+            {geo_pb2.REGION: 60, geo_pb2.COUNTRY: 50},
+            index.lookup('A1234', geo_pb2.FrenchCity(
+                city_id='38185', departement_id='38', region_id='84')))
+
+    def test_unknown_job_group(self):
+        """Unknown job group."""
+        index = unemployment_index.get_index(self.database)
+
+        self.assertEqual({}, index.lookup('C0000', self.city))
+
+    def test_cache(self):
+        """The index is only loaded once per database."""
+        index = unemployment_index.get_index(self.database)
+        self.database.fhs_local_diagnosis.drop()
+
+        self.assertIs(index, unemployment_index.get_index(self.database))
+
+        other_database = mongomock.MongoClient().other
+        self.assertEqual(0, len(unemployment_index.get_index(other_database)))
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover